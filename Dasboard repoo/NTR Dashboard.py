@@ -5,6 +5,8 @@ import plotly.express as px
 import plotly.graph_objects as go
 from collections import Counter
 import re, os, logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pytz
 from collections import defaultdict, OrderedDict
@@ -80,6 +82,12 @@ try:
 except Exception:
     WORDCLOUD_OK = False
 
+try:
+    from scipy import sparse
+    SCIPY_OK = True
+except Exception:
+    SCIPY_OK = False
+
 # ----------------- 🚀 PERFORMANCE OPTIMIZATIONS -----------------
 # ----------------- 🚀 ULTRA PERFORMANCE OPTIMIZATIONS -----------------
 import os
@@ -692,6 +700,1831 @@ def extract_keywords(text: str):
     tokens = re.findall(r'[\u0600-\u06FF\w%+\-]+', text)
     return [t.strip().lower() for t in tokens if len(t.strip())>0]
 
+# ========================================
+# 🔤 ARABIC / PERSIAN SCRIPT NORMALIZATION
+# ========================================
+# Same letter folding as ARABIC_VARIATIONS in the preprocessing notebook
+# (hamza forms, Persian kaf/yeh/gaf/peh/tcheh/jeh, taa marbuta), plus Persian/Arabic-Indic digits
+ARABIC_VARIATIONS = {
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و',
+    'ة': 'ه',
+    'پ': 'ب', 'چ': 'ج', 'ژ': 'ز', 'گ': 'ك', 'ک': 'ك',
+    'ی': 'ي', 'ے': 'ي',
+}
+ARABIC_VARIATIONS.update({d: str(i) for i, d in enumerate('۰۱۲۳۴۵۶۷۸۹')})
+ARABIC_VARIATIONS.update({d: str(i) for i, d in enumerate('٠١٢٣٤٥٦٧٨٩')})
+
+# 🚀 One translate table: letter folding + drop tashkeel/tatweel in a single C-level pass
+_ARABIC_TRANSLATE_TABLE = str.maketrans({
+    **ARABIC_VARIATIONS,
+    **{chr(c): None for c in range(0x064B, 0x0653)},  # fathatan ... sukun
+    '\u0670': None,  # superscript alef
+    '\u0640': None,  # tatweel
+})
+
+def normalize_arabic_text(text: str) -> str:
+    """Fold Arabic/Persian orthographic variants so 'کولاجین' and 'كولاجين' share one key."""
+    if not isinstance(text, str):
+        return ""
+    return text.translate(_ARABIC_TRANSLATE_TABLE).strip().lower()
+
+def normalize_token_vocabulary(tokens):
+    """Vectorized normalization of a token vocabulary.
+
+    Returns (normalized_keys, codes): the distinct normalized keys and, for every
+    input token, the integer code of its key - so callers can collapse
+    duplicate-by-orthography tokens with a single grouped sum.
+    """
+    vocab = pd.Series(tokens, dtype='object').astype(str)
+    normalized = vocab.str.translate(_ARABIC_TRANSLATE_TABLE).str.strip().str.lower()
+    codes, keys = pd.factorize(normalized, sort=False)
+    return pd.Index(keys), codes
+
+@st.cache_data(ttl=7200, show_spinner=False)
+def normalize_master_dictionary(master_dict):
+    """Normalize variations/excluded terms of a master keyword dictionary once.
+
+    Variants that only differ by script collapse to one entry, which shrinks the
+    candidate set every fuzzy comparison has to walk.
+    """
+    normalized = {}
+    for master_keyword, info in master_dict.items():
+        entry = dict(info)
+        entry['variations'] = list(dict.fromkeys(
+            normalize_arabic_text(v) for v in info.get('variations', []) if normalize_arabic_text(v)
+        ))
+        entry['excluded_terms'] = list(dict.fromkeys(
+            normalize_arabic_text(v) for v in info.get('excluded_terms', []) if normalize_arabic_text(v)
+        ))
+        normalized[master_keyword] = entry
+    return normalized
+
+# ========================================
+# 📏 PRECOMPUTED QUERY TEXT FEATURES
+# ========================================
+LONG_TAIL_MIN_CHARS = 20
+QUERY_SCRIPT_LABELS = {0: 'Latin', 1: 'Arabic', 2: 'Mixed', 3: 'Other'}
+QUERY_LENGTH_BAND_EDGES = [0, 10, 20, 30, 50, 100]
+QUERY_LENGTH_BAND_LABELS = ['0-10', '11-20', '21-30', '31-50', '51-100']
+QUERY_WORD_BAND_LABELS = ['1 word', '2 words', '3 words', '4 words', '5+ words']
+
+def compute_query_text_features(query_text):
+    """Length / token / script / digit / long-tail features for a Series of distinct queries.
+
+    All outputs are compact integer (or bool) columns; bands are -1 when out of range.
+    """
+    text = pd.Series(query_text, dtype='object').astype(str)
+    length = text.str.len().to_numpy()
+    words = text.str.count(r'\S+').to_numpy()
+    has_arabic = text.str.contains(r'[؀-ۿ]', regex=True).to_numpy()
+    has_latin = text.str.contains(r'[A-Za-z]', regex=True).to_numpy()
+    
+    script = np.select([has_latin & has_arabic, has_arabic, has_latin], [2, 1, 0], default=3)
+    length_band = np.searchsorted(QUERY_LENGTH_BAND_EDGES, length, side='left') - 1
+    length_band[(length <= 0) | (length > QUERY_LENGTH_BAND_EDGES[-1])] = -1
+    word_band = np.where(words > 0, np.minimum(words, 5) - 1, -1)
+    
+    return pd.DataFrame({
+        'query_length': np.minimum(length, np.iinfo(np.uint16).max).astype('uint16'),
+        'query_word_count': np.minimum(words, np.iinfo(np.uint8).max).astype('uint8'),
+        'query_script': script.astype('int8'),
+        'query_has_digit': text.str.contains(r'\d', regex=True).to_numpy(),
+        'is_long_tail': length >= LONG_TAIL_MIN_CHARS,
+        'query_length_band': length_band.astype('int8'),
+        'query_word_band': word_band.astype('int8')
+    })
+
+def add_query_text_features(df):
+    """Compute text features once over distinct queries and broadcast them to rows (in place)."""
+    if df is None or df.empty:
+        return df
+    query_col = 'normalized_query' if 'normalized_query' in df.columns else 'search'
+    if query_col not in df.columns:
+        return df
+    
+    codes, distinct = pd.factorize(df[query_col].astype(str), sort=False)
+    features = compute_query_text_features(distinct)
+    for col in features.columns:
+        df[col] = features[col].to_numpy()[codes]
+    return df
+
+def ensure_query_text_features(df):
+    """Return df with the precomputed text-feature columns (computes them only if missing)."""
+    if df is None or df.empty or 'query_word_band' in df.columns:
+        return df
+    return add_query_text_features(df.copy(deep=False))
+
+# ========================================
+# 🗂️ SHARED QUERY / TOKEN INDEX
+# ========================================
+METRIC_COLS = ['Counts', 'clicks', 'conversions']
+
+def get_filter_fingerprint(df):
+    """Cheap cache key for the current dataset + filter state (shape, filter flag, totals)."""
+    if df is None or df.empty:
+        return "empty"
+    totals = tuple(int(df[c].sum()) for c in METRIC_COLS if c in df.columns)
+    return str(hash((df.shape, st.session_state.get('filters_applied', False), totals)))
+
+@st.cache_data(ttl=1800, max_entries=3, show_spinner=False)
+def build_query_token_index(_df, cache_key):
+    """Build the distinct-query table and its (query_code, token_code) postings once.
+
+    Returns a dict with:
+        queries:  DataFrame indexed by query_code with 'query' + summed Counts/clicks/conversions
+        tokens:   Index of normalized tokens (position = token_code)
+        postings: DataFrame[query_code, token_code, position] - one row per token occurrence
+    """
+    if _df is None or _df.empty or 'normalized_query' not in _df.columns:
+        return None
+    
+    # 🚀 Aggregate rows -> distinct queries with integer codes
+    query_codes, query_values = pd.factorize(_df['normalized_query'].astype(str), sort=False)
+    query_table = _df[METRIC_COLS].groupby(query_codes).sum()
+    query_table.index.name = 'query_code'
+    query_table.insert(0, 'query', np.asarray(query_values, dtype=object)[query_table.index])
+    
+    # 🚀 Tokenize each distinct query once (script-normalized)
+    token_lists = (pd.Series(query_values, dtype='object')
+                   .str.translate(_ARABIC_TRANSLATE_TABLE)
+                   .str.lower()
+                   .str.findall(_keyword_pattern))
+    exploded = token_lists.explode().dropna()
+    exploded = exploded[exploded.str.len() >= 2]
+    
+    token_codes, vocab = pd.factorize(exploded.to_numpy(), sort=False)
+    postings = pd.DataFrame({
+        'query_code': exploded.index.to_numpy().astype('int32'),
+        'token_code': token_codes.astype('int32'),
+        'position': exploded.groupby(level=0).cumcount().to_numpy().astype('int16')
+    })
+    
+    return {'queries': query_table, 'tokens': pd.Index(vocab), 'postings': postings}
+
+@st.cache_data(ttl=1800, max_entries=3, show_spinner=False)
+def compute_token_metrics(_df, cache_key):
+    """Per-keyword totals from the token index: volume, clicks, conversions and unique queries."""
+    index = build_query_token_index(_df, cache_key)
+    if index is None or index['postings'].empty:
+        return pd.DataFrame(columns=['keyword'] + METRIC_COLS + ['unique_queries'])
+    
+    post = index['postings'].drop_duplicates(['query_code', 'token_code'])
+    joined = post.join(index['queries'][METRIC_COLS], on='query_code')
+    token_table = joined.groupby('token_code').agg(
+        Counts=('Counts', 'sum'),
+        clicks=('clicks', 'sum'),
+        conversions=('conversions', 'sum'),
+        unique_queries=('query_code', 'size')
+    )
+    token_table.insert(0, 'keyword', index['tokens'][token_table.index.to_numpy()])
+    return token_table
+
+# ========================================
+# ⚡ PREFIX (TYPEAHEAD) INDEX
+# ========================================
+def _build_sorted_prefix_part(keys, volumes, ids):
+    """Sort (key, volume, id) triples by key so any prefix maps to one contiguous slice."""
+    keys = np.asarray(keys, dtype=object)
+    order = np.argsort(keys, kind='stable')
+    return {
+        'keys': keys[order],
+        'volumes': np.asarray(volumes, dtype=np.int64)[order],
+        'ids': np.asarray(ids, dtype=np.int64)[order]
+    }
+
+@st.cache_resource(max_entries=3, show_spinner=False)
+def build_prefix_index(_df, cache_key):
+    """Typeahead index over the keyword vocabulary and distinct queries.
+
+    Queries are indexed under every word start, so 'omega' also finds 'now omega 3'.
+    Stored as cache_resource: lookups read the arrays directly, no per-call copy.
+    """
+    index = build_query_token_index(_df, cache_key)
+    if index is None:
+        return None
+    
+    token_table = compute_token_metrics(_df, cache_key)
+    keyword_part = _build_sorted_prefix_part(
+        token_table['keyword'].to_numpy(), token_table['Counts'].to_numpy(), token_table.index.to_numpy()
+    )
+    
+    # Word-start suffixes of each normalized query: "now omega 3" -> ["now omega 3", "omega 3", "3"]
+    q = index['queries']
+    normalized = pd.Series(q['query'].to_numpy(), index=q.index, dtype='object').map(normalize_arabic_text)
+    words = normalized.str.split()
+    suffixes = words.map(lambda w: [' '.join(w[i:]) for i in range(len(w))]).explode().dropna()
+    query_part = _build_sorted_prefix_part(
+        suffixes.to_numpy(), q['Counts'].to_numpy()[suffixes.index.to_numpy()], suffixes.index.to_numpy()
+    )
+    
+    return {'keywords': keyword_part, 'queries': query_part}
+
+def prefix_lookup(part, prefix, top_k=10):
+    """Return (ids, volumes) of the top_k entries starting with prefix, best volume first."""
+    prefix = normalize_arabic_text(prefix)
+    if part is None or not prefix or len(part['keys']) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    
+    lo = np.searchsorted(part['keys'], prefix, side='left')
+    hi = np.searchsorted(part['keys'], prefix + '\U0010FFFF', side='left')
+    if hi <= lo:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    
+    ids = part['ids'][lo:hi]
+    volumes = part['volumes'][lo:hi]
+    
+    # A query can match at several word starts - keep its first hit only
+    ids, first = np.unique(ids, return_index=True)
+    volumes = volumes[first]
+    
+    # 🚀 Partial selection of the top_k, then sort just those
+    if len(ids) > top_k:
+        top = np.argpartition(-volumes, top_k - 1)[:top_k]
+        ids, volumes = ids[top], volumes[top]
+    order = np.argsort(-volumes, kind='stable')
+    return ids[order], volumes[order]
+
+# ========================================
+# 🔗 KEYWORD CO-OCCURRENCE & BIGRAM ENGINE
+# ========================================
+def _finalize_pair_table(pairs, top_n):
+    """Add CTR/CR to an aggregated keyword-pair table and keep the top N by volume."""
+    pairs['ctr'] = np.where(pairs['total_counts'] > 0, pairs['total_clicks'] / pairs['total_counts'] * 100, 0)
+    pairs['cr'] = np.where(pairs['total_counts'] > 0, pairs['total_conversions'] / pairs['total_counts'] * 100, 0)
+    return pairs.nlargest(top_n, 'total_counts').reset_index(drop=True)
+
+@st.cache_data(ttl=1800, max_entries=5, show_spinner=False)
+def compute_keyword_cooccurrence(_df, cache_key, top_n=50, min_queries=2):
+    """Keyword pairs appearing in the same queries, with combined volume, CTR and CR.
+
+    Built from a sparse query x keyword incidence matrix X: the pair measures are
+    X.T @ diag(w) @ X for w in (1, Counts, clicks, conversions), so the cost scales
+    with the number of co-occurrences rather than keywords².
+    """
+    index = build_query_token_index(_df, cache_key)
+    if index is None or index['postings'].empty:
+        return pd.DataFrame()
+    
+    q = index['queries']
+    post = index['postings'].drop_duplicates(['query_code', 'token_code'])
+    n_queries, n_tokens = len(q), len(index['tokens'])
+    
+    if SCIPY_OK:
+        X = sparse.csr_matrix(
+            (np.ones(len(post), dtype=np.float64), (post['query_code'].to_numpy(), post['token_code'].to_numpy())),
+            shape=(n_queries, n_tokens)
+        )
+        co = sparse.triu(X.T @ X, k=1).tocoo()
+        keep = co.data >= min_queries
+        rows, cols = co.row[keep], co.col[keep]
+        pairs = pd.DataFrame({'a': rows, 'b': cols, 'co_queries': co.data[keep].astype('int32')})
+        XT = X.T.tocsr()
+        for col, target in zip(METRIC_COLS, ['total_counts', 'total_clicks', 'total_conversions']):
+            weighted = (XT @ X.multiply(q[col].to_numpy(dtype=np.float64)[:, None]).tocsc()).tocsr()
+            pairs[target] = np.asarray(weighted[rows, cols]).ravel()
+    else:
+        # Fallback: self-join postings on query_code (fine for small vocabularies)
+        joined = post.merge(post, on='query_code', suffixes=('_a', '_b'))
+        joined = joined[joined['token_code_a'] < joined['token_code_b']]
+        joined = joined.join(q[METRIC_COLS], on='query_code')
+        pairs = joined.groupby(['token_code_a', 'token_code_b']).agg(
+            co_queries=('query_code', 'size'),
+            total_counts=('Counts', 'sum'),
+            total_clicks=('clicks', 'sum'),
+            total_conversions=('conversions', 'sum')
+        ).reset_index().rename(columns={'token_code_a': 'a', 'token_code_b': 'b'})
+        pairs = pairs[pairs['co_queries'] >= min_queries]
+    
+    if pairs.empty:
+        return pd.DataFrame()
+    
+    pairs = _finalize_pair_table(pairs, top_n)
+    vocab = index['tokens']
+    pairs.insert(0, 'keyword_a', vocab[pairs['a'].to_numpy()])
+    pairs.insert(1, 'keyword_b', vocab[pairs['b'].to_numpy()])
+    return pairs.drop(columns=['a', 'b'])
+
+@st.cache_data(ttl=1800, max_entries=5, show_spinner=False)
+def compute_keyword_bigrams(_df, cache_key, top_n=50, min_queries=2):
+    """Adjacent keyword pairs (bigrams) with combined volume, CTR and CR - fully vectorized."""
+    index = build_query_token_index(_df, cache_key)
+    if index is None or index['postings'].empty:
+        return pd.DataFrame()
+    
+    post = index['postings']
+    n_tokens = len(index['tokens'])
+    q_codes = post['query_code'].to_numpy()
+    t_codes = post['token_code'].to_numpy().astype(np.int64)
+    
+    # Next token in the same query = bigram partner
+    adjacent = q_codes[:-1] == q_codes[1:]
+    bigrams = pd.DataFrame({
+        'query_code': q_codes[:-1][adjacent],
+        'pair_code': t_codes[:-1][adjacent] * n_tokens + t_codes[1:][adjacent]
+    }).drop_duplicates()
+    if bigrams.empty:
+        return pd.DataFrame()
+    
+    bigrams = bigrams.join(index['queries'][METRIC_COLS], on='query_code')
+    pairs = bigrams.groupby('pair_code').agg(
+        co_queries=('query_code', 'size'),
+        total_counts=('Counts', 'sum'),
+        total_clicks=('clicks', 'sum'),
+        total_conversions=('conversions', 'sum')
+    ).reset_index()
+    pairs = pairs[pairs['co_queries'] >= min_queries]
+    if pairs.empty:
+        return pd.DataFrame()
+    
+    pairs = _finalize_pair_table(pairs, top_n)
+    vocab = index['tokens']
+    pairs.insert(0, 'keyword_a', vocab[(pairs['pair_code'] // n_tokens).to_numpy()])
+    pairs.insert(1, 'keyword_b', vocab[(pairs['pair_code'] % n_tokens).to_numpy()])
+    return pairs.drop(columns=['pair_code'])
+
+# ========================================
+# 🏷️ TOP-K KEYWORDS PER GROUP ENGINE
+# ========================================
+@st.cache_data(ttl=1800, max_entries=8, show_spinner=False)
+def compute_top_keywords_per_group(_df, group_col, top_k, cache_key, keyword_col=None, _base_df=None):
+    """Top-k keywords for every value of group_col in one vectorized pass.
+
+    Keywords are tokens from the shared query/token index (built on _base_df, defaulting to _df),
+    or the raw values of keyword_col when given (e.g. whole search terms).
+    Returns a long table: group, keyword, count, clicks, conversions, ctr, cr, rank, group_keywords.
+    """
+    empty = pd.DataFrame(columns=['group', 'keyword', 'count', 'clicks', 'conversions',
+                                  'ctr', 'cr', 'rank', 'group_keywords'])
+    if _df is None or _df.empty or group_col not in _df.columns:
+        return empty
+    
+    rows = _df[_df[group_col].notna()]
+    group_codes, group_values = pd.factorize(rows[group_col], sort=False)
+    metrics = rows[METRIC_COLS].apply(pd.to_numeric, errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    
+    if keyword_col is not None:
+        # Keyword = the column value itself: one (group, keyword) pair per row
+        keyword_codes, vocab = pd.factorize(rows[keyword_col], sort=False)
+        pairs = pd.DataFrame(metrics, columns=METRIC_COLS)
+        pairs['group_code'] = group_codes
+        pairs['kw_code'] = keyword_codes
+        pairs = pairs[pairs['kw_code'] >= 0]
+    else:
+        base = _df if _base_df is None else _base_df
+        index = build_query_token_index(base, get_filter_fingerprint(base))
+        if index is None or index['postings'].empty:
+            return empty
+        
+        # 🚀 Rows -> query codes of the shared index, then rows collapse to (group, query) sums
+        query_codes = pd.Index(index['queries']['query']).get_indexer(rows['normalized_query'].astype(str))
+        group_query = pd.DataFrame(metrics, columns=METRIC_COLS)
+        group_query['group_code'] = group_codes
+        group_query['query_code'] = query_codes
+        group_query = group_query[group_query['query_code'] >= 0]
+        group_query = group_query.groupby(['group_code', 'query_code'], sort=False)[METRIC_COLS].sum().reset_index()
+        
+        # Each (group, query) fans out to its distinct tokens
+        postings = index['postings'][['query_code', 'token_code']].drop_duplicates()
+        pairs = group_query.merge(postings, on='query_code').rename(columns={'token_code': 'kw_code'})
+        vocab = index['tokens']
+    
+    if pairs.empty:
+        return empty
+    
+    # 🚀 Grouped sums over (group_code, kw_code)
+    totals = pairs.groupby(['group_code', 'kw_code'], sort=False)[METRIC_COLS].sum().reset_index()
+    g = totals['group_code'].to_numpy()
+    counts = totals['Counts'].to_numpy()
+    
+    # Per-group ordering: group ascending, volume descending; rank = position inside the group
+    order = np.lexsort((-counts, g))
+    g_sorted = g[order]
+    group_start = np.searchsorted(g_sorted, g_sorted, side='left')
+    rank = np.arange(len(order)) - group_start
+    keep = order[rank < top_k]
+    
+    result = totals.iloc[keep].reset_index(drop=True)
+    result['rank'] = (rank[rank < top_k] + 1).astype(np.int32)
+    result['group_keywords'] = np.bincount(g, minlength=len(group_values))[result['group_code'].to_numpy()]
+    result.insert(0, 'group', np.asarray(group_values, dtype=object)[result['group_code'].to_numpy()])
+    result.insert(1, 'keyword', np.asarray(vocab, dtype=object)[result['kw_code'].to_numpy()])
+    result = result.rename(columns={'Counts': 'count'}).drop(columns=['group_code', 'kw_code'])
+    for col in ['count', 'clicks', 'conversions']:
+        result[col] = result[col].round().astype(np.int64)
+    result['ctr'] = np.where(result['count'] > 0, result['clicks'] / result['count'].clip(lower=1) * 100, 0)
+    result['cr'] = np.where(result['count'] > 0, result['conversions'] / result['count'].clip(lower=1) * 100, 0)
+    return result[empty.columns]
+
+# ========================================
+# 🧮 SPARSE DIMENSION × QUERY MATRIX
+# ========================================
+MATRIX_EXCLUDED_LABELS = ['other', 'others']
+MATRIX_MEASURES = METRIC_COLS + ['n_rows']
+
+def _top_k_indices(values, k):
+    """Indices of the k largest non-zero values, largest first (argpartition + small sort)."""
+    nonzero = np.flatnonzero(values > 0)
+    if len(nonzero) > k:
+        nonzero = nonzero[np.argpartition(-values[nonzero], k - 1)[:k]]
+    return nonzero[np.argsort(-values[nonzero], kind='stable')]
+
+@st.cache_data(ttl=1800, max_entries=8, show_spinner=False)
+def build_dimension_query_matrix(_df, dim_col, cache_key, query_col='search'):
+    """Sparse (dimension code, query code) matrix of summed measures - built once per filter state.
+
+    Stored in COO form: rows / cols label indexes plus parallel arrays row, col, Counts, clicks,
+    conversions and n_rows (source rows per cell). 'other' / 'others' labels are dropped on both axes.
+    row_totals holds the per-dimension sums (indexed by label) for metric cards.
+    """
+    if _df is None or _df.empty or dim_col not in _df.columns or query_col not in _df.columns:
+        return None
+    
+    row_codes, row_labels = pd.factorize(_df[dim_col], sort=False)
+    col_codes, col_labels = pd.factorize(_df[query_col], sort=False)
+    row_labels, col_labels = pd.Index(row_labels), pd.Index(col_labels)
+    
+    row_ok = np.append(~row_labels.astype(str).str.lower().isin(MATRIX_EXCLUDED_LABELS), False)
+    col_ok = np.append(~col_labels.astype(str).str.lower().isin(MATRIX_EXCLUDED_LABELS), False)
+    valid = row_ok[row_codes] & col_ok[col_codes]  # code -1 (missing) hits the trailing False
+    if not valid.any():
+        return None
+    
+    # 🚀 One grouped sum over flat cell ids = the sparse matrix
+    n_cols = len(col_labels)
+    flat = row_codes[valid].astype(np.int64) * n_cols + col_codes[valid]
+    cells = pd.DataFrame(
+        _df.loc[valid, METRIC_COLS].apply(pd.to_numeric, errors='coerce').fillna(0).to_numpy(dtype=np.float64),
+        columns=METRIC_COLS
+    )
+    cells['n_rows'] = 1
+    cells = cells.groupby(flat).sum()
+    keys = cells.index.to_numpy()
+    
+    matrix = {
+        'rows': row_labels,
+        'cols': col_labels,
+        'query_col': query_col,
+        'row': (keys // n_cols).astype(np.int64),
+        'col': (keys % n_cols).astype(np.int64)
+    }
+    for m in MATRIX_MEASURES:
+        matrix[m] = cells[m].to_numpy()
+    
+    row_totals = pd.DataFrame(
+        {m: np.bincount(matrix['row'], weights=matrix[m], minlength=len(row_labels)) for m in MATRIX_MEASURES},
+        index=row_labels
+    )
+    matrix['row_totals'] = row_totals[row_totals['n_rows'] > 0].drop(columns='n_rows').round().astype(np.int64)
+    return matrix
+
+def slice_dimension_query_matrix(matrix, top_rows=8, top_cols=12, rows=None, col_rank='Counts'):
+    """Dense top-k rows × top-k columns view of a build_dimension_query_matrix result.
+
+    rows: explicit dimension labels (otherwise the top_rows by volume).
+    col_rank: measure used to pick the top_cols queries inside the selected rows ('Counts' or 'n_rows').
+    Returns dict of row × column DataFrames (Counts, ctr, cr, classic_cr) and the long 'cells' table.
+    """
+    n_rows_total, n_cols_total = len(matrix['rows']), len(matrix['cols'])
+    if rows is None:
+        row_volume = np.bincount(matrix['row'], weights=matrix['Counts'], minlength=n_rows_total)
+        row_idx = _top_k_indices(row_volume, top_rows)
+    else:
+        row_idx = matrix['rows'].get_indexer(rows)
+        row_idx = row_idx[row_idx >= 0]
+    
+    row_pos = np.full(n_rows_total, -1)
+    row_pos[row_idx] = np.arange(len(row_idx))
+    in_rows = row_pos[matrix['row']] >= 0
+    
+    col_volume = np.bincount(matrix['col'][in_rows], weights=matrix[col_rank][in_rows], minlength=n_cols_total)
+    col_idx = _top_k_indices(col_volume, top_cols)
+    col_pos = np.full(n_cols_total, -1)
+    col_pos[col_idx] = np.arange(len(col_idx))
+    
+    sel = in_rows & (col_pos[matrix['col']] >= 0)
+    r, c = row_pos[matrix['row'][sel]], col_pos[matrix['col'][sel]]
+    shape = (len(row_idx), len(col_idx))
+    dense = {}
+    for m in METRIC_COLS:
+        dense[m] = np.zeros(shape)
+        dense[m][r, c] = matrix[m][sel]
+    
+    def _rate(num, den):
+        return np.round(np.divide(num, den, out=np.zeros(shape), where=den > 0) * 100, 2)
+    
+    row_labels, col_labels = matrix['rows'][row_idx], matrix['cols'][col_idx]
+    tables = {
+        'Counts': dense['Counts'],
+        'ctr': _rate(dense['clicks'], dense['Counts']),
+        'cr': _rate(dense['conversions'], dense['Counts']),
+        'classic_cr': _rate(dense['conversions'], dense['clicks'])
+    }
+    result = {k: pd.DataFrame(v, index=row_labels, columns=col_labels) for k, v in tables.items()}
+    
+    cells = pd.DataFrame({
+        'dimension': row_labels[r],
+        matrix['query_col']: col_labels[c],
+        **{m: dense[m][r, c].round().astype(np.int64) for m in METRIC_COLS},
+        **{k: tables[k][r, c] for k in ['ctr', 'cr', 'classic_cr']}
+    })
+    result['cells'] = cells.sort_values('Counts', ascending=False, kind='stable').reset_index(drop=True)
+    return result
+
+# ========================================
+# 📅 ENTITY × MONTH WIDE TABLE BUILDER
+# ========================================
+def sort_month_keys(months):
+    """Chronological order for month keys ('2025-06' or 'June 2025')."""
+    return sorted(months, key=lambda x: pd.to_datetime(x))
+
+@st.cache_data(ttl=1800, max_entries=10, show_spinner=False)
+def build_entity_month_table(_df, entity_col, month_names_dict, top_n, cache_key,
+                             entity_label='Entity', metric_cols=('Counts', 'clicks', 'conversions'),
+                             share_label='Share %', include_classic_cr=False):
+    """Top-N entities × month wide table in one grouped pass + unstack.
+
+    Columns: entity_label, Total Volume, share_label, Overall CTR, Overall CR, [Classic CR],
+    Total Clicks, Total Conversions, then '<Month> Vol' / '<Month> CTR' / '<Month> CR' per month.
+    Works for any entity column (query, brand, department, ...); metric_cols maps volume/clicks/conversions.
+    Returns (wide DataFrame sorted by Total Volume, sorted month keys).
+    """
+    vol_col, clicks_col, conv_col = metric_cols
+    if _df is None or _df.empty or entity_col not in _df.columns:
+        return pd.DataFrame(), []
+    
+    has_month = 'month' in _df.columns
+    # Totals from an entity-only pass so rows without a month still count toward Total / share
+    totals = _df.groupby(entity_col, observed=True, sort=False)[list(metric_cols)].sum()
+    
+    top = totals[vol_col].nlargest(top_n).index
+    totals = totals.loc[top]
+    vol = totals[vol_col].to_numpy(dtype=np.float64)
+    clicks = totals[clicks_col].to_numpy(dtype=np.float64)
+    conv = totals[conv_col].to_numpy(dtype=np.float64)
+    dataset_total = float(_df[vol_col].sum())
+    
+    def _pct(num, den):
+        return np.divide(num, den, out=np.zeros(len(num)), where=den > 0) * 100
+    
+    result = pd.DataFrame({
+        entity_label: np.asarray(top, dtype=object),
+        'Total Volume': vol.round().astype(np.int64),
+        share_label: vol / dataset_total * 100 if dataset_total > 0 else np.zeros(len(vol)),
+        'Overall CTR': _pct(clicks, vol),
+        'Overall CR': _pct(conv, vol)
+    })
+    if include_classic_cr:
+        result['Classic CR'] = _pct(conv, clicks)
+    result['Total Clicks'] = clicks.round().astype(np.int64)
+    result['Total Conversions'] = conv.round().astype(np.int64)
+    
+    unique_months = []
+    if has_month:
+        # 🚀 Entity × month cells for the top entities -> one unstack, no per-entity filtering
+        top_rows = _df[_df[entity_col].isin(top)]
+        monthly = top_rows.groupby([entity_col, 'month'], observed=True, sort=False)[list(metric_cols)].sum()
+        unique_months = sort_month_keys(monthly.index.get_level_values(1).dropna().unique())
+        wide = monthly.unstack('month', fill_value=0).reindex(index=top, fill_value=0)
+        for month in unique_months:
+            month_display = month_names_dict.get(month, month)
+            m_vol = wide[(vol_col, month)].to_numpy(dtype=np.float64)
+            result[f'{month_display} Vol'] = m_vol.round().astype(np.int64)
+            result[f'{month_display} CTR'] = _pct(wide[(clicks_col, month)].to_numpy(dtype=np.float64), m_vol)
+            result[f'{month_display} CR'] = _pct(wide[(conv_col, month)].to_numpy(dtype=np.float64), m_vol)
+    
+    result = result.sort_values('Total Volume', ascending=False, kind='stable').reset_index(drop=True)
+    return result[result['Total Volume'] > 0].reset_index(drop=True), unique_months
+
+# ========================================
+# 🌳 PRODUCT HIERARCHY TREE
+# ========================================
+# Department → Category → Sub Category → Class, as split from the '///' category path
+# in the preprocessing notebook; node ids reuse that separator
+HIERARCHY_LEVELS = [
+    ('Department', ['department', 'Department']),
+    ('Category', ['category', 'Category']),
+    ('Sub Category', ['sub_category', 'Sub Category', 'subcategory']),
+    ('Class', ['Class', 'class'])
+]
+HIERARCHY_SEPARATOR = '///'
+HIERARCHY_ROOT = 'All'
+
+def find_hierarchy_columns(columns):
+    """[(level name, column)] for the leading hierarchy levels present in columns."""
+    found = []
+    for level_name, candidates in HIERARCHY_LEVELS:
+        col = next((c for c in candidates if c in columns), None)
+        if col is None:
+            break
+        found.append((level_name, col))
+    return found
+
+@st.cache_data(ttl=1800, max_entries=3, show_spinner=False)
+def build_hierarchy_tree(_df, cache_key):
+    """Materialized hierarchy tree with metrics rolled up from the leaves.
+
+    Rows are aggregated once into leaf paths; each level above is summed from the level below.
+    Returns dict:
+        nodes:    DataFrame indexed by node id ('Dept///Cat///...', root = 'All') with label, level,
+                  depth, parent, Counts, clicks, conversions, ctr, cr, share, n_children
+        children: {node id: [child ids, largest volume first]}
+        levels:   level names present
+    """
+    if _df is None or _df.empty:
+        return None
+    level_cols = find_hierarchy_columns(_df.columns)
+    if not level_cols:
+        return None
+    
+    level_names = [name for name, _ in level_cols]
+    keys = [
+        _df[col].astype('string').str.strip().replace('', pd.NA).fillna('Unknown').rename(name)
+        for name, col in level_cols
+    ]
+    current = _df[METRIC_COLS].apply(pd.to_numeric, errors='coerce').fillna(0).groupby(keys, observed=True).sum()
+    
+    def _path_ids(index):
+        return index.map(HIERARCHY_SEPARATOR.join) if isinstance(index, pd.MultiIndex) else index.astype(str)
+    
+    # 🚀 Roll up level by level from the leaves (never back to row-level data)
+    frames = []
+    for depth in range(len(level_names), 0, -1):
+        index = current.index if isinstance(current.index, pd.MultiIndex) else pd.MultiIndex.from_arrays([current.index])
+        node_ids = _path_ids(index)
+        parent_ids = _path_ids(index.droplevel(-1)) if depth > 1 else pd.Index([HIERARCHY_ROOT] * len(index))
+        frame = current.copy()
+        frame.index = node_ids
+        frame.insert(0, 'label', index.get_level_values(-1))
+        frame.insert(1, 'level', level_names[depth - 1])
+        frame.insert(2, 'depth', depth)
+        frame.insert(3, 'parent', np.asarray(parent_ids))
+        frames.append(frame)
+        if depth > 1:
+            current = current.groupby(level=list(range(depth - 1)), observed=True).sum()
+    
+    root = current.sum().to_frame().T
+    root.index = [HIERARCHY_ROOT]
+    root.insert(0, 'label', HIERARCHY_ROOT)
+    root.insert(1, 'level', 'All')
+    root.insert(2, 'depth', 0)
+    root.insert(3, 'parent', '')
+    
+    nodes = pd.concat([root] + frames[::-1])
+    nodes.index.name = 'node_id'
+    volume = nodes['Counts'].to_numpy(dtype=np.float64)
+    nodes['ctr'] = np.divide(nodes['clicks'].to_numpy(dtype=np.float64), volume, out=np.zeros(len(nodes)), where=volume > 0) * 100
+    nodes['cr'] = np.divide(nodes['conversions'].to_numpy(dtype=np.float64), volume, out=np.zeros(len(nodes)), where=volume > 0) * 100
+    nodes['share'] = volume / volume[0] * 100 if volume[0] > 0 else 0.0
+    
+    ordered = nodes.iloc[1:].sort_values('Counts', ascending=False, kind='stable')
+    children = {parent: ids.tolist() for parent, ids in ordered.index.to_series().groupby(ordered['parent'], sort=False)}
+    nodes['n_children'] = [len(children.get(node_id, ())) for node_id in nodes.index]
+    
+    return {'nodes': nodes, 'children': children, 'levels': level_names}
+
+def hierarchy_subtree(tree, node_id, max_depth):
+    """Node ids under node_id (inclusive) down to max_depth levels below it - walks the children map only."""
+    subtree, frontier = [node_id], [node_id]
+    for _ in range(max_depth):
+        frontier = [child for parent in frontier for child in tree['children'].get(parent, [])]
+        if not frontier:
+            break
+        subtree.extend(frontier)
+    return subtree
+
+# ========================================
+# 🗄️ PER-ENTITY DEEP-DIVE LRU CACHE
+# ========================================
+DEEP_DIVE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # memory bound for all cached deep-dive results
+DEEP_DIVE_PREFETCH_COUNT = 3                   # next entities (by volume) warmed in the background
+
+@st.cache_resource(show_spinner=False)
+def get_deep_dive_cache():
+    """Process-wide LRU of deep-dive results, bounded by bytes, plus a single prefetch worker."""
+    return {
+        'entries': OrderedDict(),
+        'bytes': 0,
+        'lock': threading.Lock(),
+        'pending': set(),
+        'pool': ThreadPoolExecutor(max_workers=1, thread_name_prefix='deep-dive-prefetch')
+    }
+
+def compute_entity_deep_dive(df, entity_col, entity, keyword_col=None, metric_cols=tuple(METRIC_COLS)):
+    """Keyword and month breakdowns for one entity (pure pandas - safe off the script thread).
+
+    Returns dict with 'keywords' (top 15 by volume with keyword_ctr / keyword_cr) when keyword_col
+    is given, and 'monthly' (volume, clicks, conversions, ctr, cr per month) when df has a month column.
+    """
+    vol_col, clicks_col, conv_col = metric_cols
+    rows = df[df[entity_col] == entity]
+    measures = rows[list(metric_cols)].apply(pd.to_numeric, errors='coerce').fillna(0)
+    result = {}
+    
+    def _with_rates(table, ctr_name, cr_name):
+        volume = table[vol_col].to_numpy(dtype=np.float64)
+        table[ctr_name] = np.divide(table[clicks_col].to_numpy(dtype=np.float64), volume, out=np.zeros(len(table)), where=volume > 0) * 100
+        table[cr_name] = np.divide(table[conv_col].to_numpy(dtype=np.float64), volume, out=np.zeros(len(table)), where=volume > 0) * 100
+        return table
+    
+    if keyword_col is not None and keyword_col in rows.columns:
+        keywords = measures.groupby(rows[keyword_col], observed=True).sum().round().astype(np.int64)
+        keywords = keywords.nlargest(15, vol_col).rename_axis(keyword_col).reset_index()
+        result['keywords'] = _with_rates(keywords, 'keyword_ctr', 'keyword_cr')
+    
+    if 'month' in rows.columns:
+        monthly = measures.groupby(rows['month'], observed=True).sum().round().astype(np.int64)
+        monthly = monthly.reindex(sort_month_keys(monthly.index)).rename_axis('month').reset_index()
+        result['monthly'] = _with_rates(monthly, 'ctr', 'cr')
+    
+    return result
+
+def _deep_dive_store(cache, key, result):
+    """Insert into the LRU and evict least-recently-used entries over the byte budget."""
+    size = sum(int(v.memory_usage(deep=True).sum()) for v in result.values() if isinstance(v, pd.DataFrame))
+    with cache['lock']:
+        if key in cache['entries']:
+            return
+        cache['entries'][key] = (result, size)
+        cache['bytes'] += size
+        while cache['bytes'] > DEEP_DIVE_CACHE_MAX_BYTES and len(cache['entries']) > 1:
+            _, (_, evicted_size) = cache['entries'].popitem(last=False)
+            cache['bytes'] -= evicted_size
+
+def get_entity_deep_dive(df, panel, entity_col, entity, cache_key, keyword_col=None,
+                         metric_cols=tuple(METRIC_COLS), prefetch=()):
+    """Deep-dive result for one entity from the LRU (key: dataset version, filter fingerprint, panel, entity).
+
+    Computes on a miss; entities listed in prefetch are computed in the background so the next
+    selections are instant. Returned tables are shared - copy before modifying.
+    """
+    cache = get_deep_dive_cache()
+    version = st.session_state.get('dataset_version', '')
+    
+    def _key(name):
+        return (version, cache_key, panel, name)
+    
+    def _compute(name):
+        result = compute_entity_deep_dive(df, entity_col, name, keyword_col, metric_cols)
+        _deep_dive_store(cache, _key(name), result)
+        return result
+    
+    def _prefetch(name):
+        try:
+            _compute(name)
+        except Exception:
+            pass  # prefetch is best-effort; a miss recomputes on demand
+        finally:
+            with cache['lock']:
+                cache['pending'].discard(_key(name))
+    
+    with cache['lock']:
+        hit = cache['entries'].get(_key(entity))
+        if hit is not None:
+            cache['entries'].move_to_end(_key(entity))
+    result = hit[0] if hit is not None else _compute(entity)
+    
+    for name in prefetch:
+        key = _key(name)
+        with cache['lock']:
+            if key in cache['entries'] or key in cache['pending']:
+                continue
+            cache['pending'].add(key)
+        cache['pool'].submit(_prefetch, name)
+    
+    return result
+
+# ========================================
+# 📐 BATCH SIGNIFICANCE FLAGS
+# ========================================
+SIGNIFICANCE_Z = 1.96                # 95% two-sided
+SIGNIFICANCE_LABELS = {1: '▲ Above', -1: '▼ Below', 0: '≈ Noise'}
+
+def wilson_interval(successes, trials, z=SIGNIFICANCE_Z):
+    """Wilson score interval (in %) for every row at once; NaN where trials == 0."""
+    trials = np.asarray(trials, dtype=np.float64)
+    valid = trials > 0
+    safe_trials = np.where(valid, trials, 1.0)
+    p = np.clip(np.asarray(successes, dtype=np.float64) / safe_trials, 0, 1)
+    z2 = z * z
+    denom = 1 + z2 / safe_trials
+    center = (p + z2 / (2 * safe_trials)) / denom
+    half = z * np.sqrt(p * (1 - p) / safe_trials + z2 / (4 * safe_trials ** 2)) / denom
+    low = np.where(valid, np.clip(center - half, 0, 1) * 100, np.nan)
+    high = np.where(valid, np.clip(center + half, 0, 1) * 100, np.nan)
+    return low, high
+
+def two_proportion_z(successes, trials, total_successes, total_trials):
+    """Pooled two-proportion z-score of each row against the rest of the population (row vs total - row)."""
+    trials = np.asarray(trials, dtype=np.float64)
+    successes = np.minimum(np.asarray(successes, dtype=np.float64), trials)
+    rest_trials = total_trials - trials
+    rest_successes = np.clip(total_successes - successes, 0, None)
+    pooled = min(max(total_successes / total_trials, 0.0), 1.0) if total_trials > 0 else 0.0
+    valid = (trials > 0) & (rest_trials > 0)
+    se = np.sqrt(pooled * (1 - pooled) * (1 / np.where(valid, trials, 1.0) + 1 / np.where(valid, rest_trials, 1.0)))
+    diff = successes / np.where(valid, trials, 1.0) - np.minimum(rest_successes / np.where(valid, rest_trials, 1.0), 1)
+    return np.where(valid & (se > 0), diff / np.where(se > 0, se, 1.0), np.nan)
+
+def add_significance_columns(table, totals=None, metric_cols=tuple(METRIC_COLS), z=SIGNIFICANCE_Z):
+    """Copy of an aggregated table with CTR / CR confidence intervals and z-test flags per row.
+
+    Adds ctr_low / ctr_high / cr_low / cr_high (Wilson, %), ctr_z / cr_z (each row vs the rest of the
+    population) and ctr_flag / cr_flag (+1 significantly above, -1 below, 0 indistinguishable from noise).
+    totals = (volume, clicks, conversions) of the population; defaults to the table's own sums.
+    """
+    vol_col, clicks_col, conv_col = metric_cols
+    out = table.copy()
+    volume = out[vol_col].to_numpy(dtype=np.float64)
+    if totals is None:
+        totals = [out[col].to_numpy(dtype=np.float64).sum() for col in metric_cols]
+    for name, col, total in (('ctr', clicks_col, totals[1]), ('cr', conv_col, totals[2])):
+        successes = out[col].to_numpy(dtype=np.float64)
+        out[f'{name}_low'], out[f'{name}_high'] = wilson_interval(successes, volume, z)
+        out[f'{name}_z'] = two_proportion_z(successes, volume, float(total), float(totals[0]))
+        z_scores = np.nan_to_num(out[f'{name}_z'].to_numpy())
+        out[f'{name}_flag'] = np.select([z_scores >= z, z_scores <= -z], [1, -1], 0).astype(np.int8)
+    return out
+
+def significance_display_columns(table):
+    """Formatted 'CTR 95% CI' / 'CTR vs Rest' / 'CR 95% CI' / 'CR vs Rest' columns for a table from add_significance_columns."""
+    def interval(low, high):
+        return [f"{lo:.1f}-{hi:.1f}%" if pd.notna(lo) else "-" for lo, hi in zip(low, high)]
+    return pd.DataFrame({
+        'CTR 95% CI': interval(table['ctr_low'], table['ctr_high']),
+        'CTR vs Rest': table['ctr_flag'].map(SIGNIFICANCE_LABELS).to_numpy(),
+        'CR 95% CI': interval(table['cr_low'], table['cr_high']),
+        'CR vs Rest': table['cr_flag'].map(SIGNIFICANCE_LABELS).to_numpy()
+    })
+
+# ========================================
+# 🧮 EMPIRICAL-BAYES SMOOTHED RATES
+# ========================================
+EB_MIN_GROUP_ROWS = 3                # parents with fewer rows borrow the global prior
+EB_MAX_PRIOR_STRENGTH = 1e6          # cap when rates show no spread beyond binomial noise
+
+def _beta_binomial_prior(successes, trials, codes, n_groups):
+    """Method-of-moments beta prior per group: (mean, strength in pseudo-trials, row count).
+
+    The spread of observed rates (volume-weighted) minus the binomial noise expected at each
+    row's volume gives the between-row variance tau²; strength = m(1-m)/tau² - 1.
+    """
+    total_trials = np.bincount(codes, weights=trials, minlength=n_groups)
+    total_successes = np.bincount(codes, weights=successes, minlength=n_groups)
+    rows = np.bincount(codes, weights=(trials > 0).astype(np.float64), minlength=n_groups)
+    mean = np.divide(total_successes, total_trials, out=np.zeros(n_groups), where=total_trials > 0)
+    rates = np.divide(successes, trials, out=np.zeros(len(trials)), where=trials > 0)
+    spread = np.bincount(codes, weights=trials * (rates - mean[codes]) ** 2, minlength=n_groups)
+    spread = np.divide(spread, total_trials, out=np.zeros(n_groups), where=total_trials > 0)
+    noise = np.divide(rows * mean * (1 - mean), total_trials, out=np.zeros(n_groups), where=total_trials > 0)
+    tau2 = spread - noise
+    strength = np.divide(mean * (1 - mean), tau2, out=np.full(n_groups, EB_MAX_PRIOR_STRENGTH + 1), where=tau2 > 0) - 1
+    return mean, np.clip(strength, 0, EB_MAX_PRIOR_STRENGTH), rows
+
+def add_smoothed_rates(table, parent_col=None, metric_cols=tuple(METRIC_COLS)):
+    """Copy of an aggregated table with beta-binomial shrunk ctr_smoothed / cr_smoothed (in %).
+
+    Each row's rate is pulled toward its parent's rate (parent_col, e.g. brand or category; the
+    whole table when None) by a prior fitted in closed form per parent: (x + k·m) / (n + k).
+    Low-volume rows move most, high-volume rows barely move, so rankings can use every row.
+    """
+    vol_col, clicks_col, conv_col = metric_cols
+    out = table.copy()
+    trials = out[vol_col].to_numpy(dtype=np.float64)
+    if parent_col is not None and parent_col in out.columns:
+        codes, parents = pd.factorize(out[parent_col].astype(str), sort=False)
+        n_groups = len(parents)
+    else:
+        codes, n_groups = np.zeros(len(out), dtype=np.intp), 1
+    global_codes = np.zeros(len(out), dtype=np.intp)
+    
+    for name, col in (('ctr', clicks_col), ('cr', conv_col)):
+        successes = np.minimum(out[col].to_numpy(dtype=np.float64), trials)
+        mean, strength, rows = _beta_binomial_prior(successes, trials, codes, n_groups)
+        global_mean, global_strength, _ = _beta_binomial_prior(successes, trials, global_codes, 1)
+        # Thin parents fall back to the global prior
+        thin = rows < EB_MIN_GROUP_ROWS
+        mean = np.where(thin, global_mean[0], mean)
+        strength = np.where(thin, global_strength[0], strength)
+        prior_mean, prior_strength = mean[codes], strength[codes]
+        denom = trials + prior_strength
+        out[f'{name}_smoothed'] = np.divide(successes + prior_strength * prior_mean, denom,
+                                            out=prior_mean.copy(), where=denom > 0) * 100
+    return out
+
+# ========================================
+# ⚖️ BATCH ENTITY COMPARISON
+# ========================================
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=32)
+def compare_entities(_df, entity_col, entities, cache_key, metric_cols=tuple(METRIC_COLS)):
+    """Metrics, shares and monthly series for N entities from one grouped pass.
+
+    Rows are coded once against the selected entities (others -> -1) and summed with bincount
+    per entity and per entity × month, so comparing 20 entities costs about the same as 2.
+    Returns dict with 'summary' (one row per entity, in the given order: totals, ctr, cr,
+    classic_cr, share, click_share, conversion_share - shares against all rows of _df - plus the
+    add_significance_columns CI / z-test columns against the rest of _df) and
+    'monthly' (long entity × month table with ctr / cr, months sorted chronologically).
+    """
+    vol_col, clicks_col, conv_col = metric_cols
+    entities = list(dict.fromkeys(entities))
+    n_entities = len(entities)
+    
+    measures = _df[list(metric_cols)].apply(pd.to_numeric, errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    totals = measures.sum(axis=0)
+    codes = pd.Categorical(_df[entity_col], categories=entities).codes
+    selected = codes >= 0
+    codes, measures = codes[selected].astype(np.int64), measures[selected]
+    
+    def _rates(table):
+        volume = table[vol_col].to_numpy(dtype=np.float64)
+        clicks = table[clicks_col].to_numpy(dtype=np.float64)
+        table['ctr'] = np.divide(clicks, volume, out=np.zeros(len(table)), where=volume > 0) * 100
+        table['cr'] = np.divide(table[conv_col].to_numpy(dtype=np.float64), volume, out=np.zeros(len(table)), where=volume > 0) * 100
+        return table
+    
+    sums = np.column_stack([np.bincount(codes, weights=measures[:, j], minlength=n_entities) for j in range(3)])
+    summary = _rates(pd.DataFrame(np.round(sums).astype(np.int64), columns=list(metric_cols)))
+    summary.insert(0, entity_col, entities)
+    summary['classic_cr'] = np.divide(sums[:, 2], sums[:, 1], out=np.zeros(n_entities), where=sums[:, 1] > 0) * 100
+    for name, j in (('share', 0), ('click_share', 1), ('conversion_share', 2)):
+        summary[name] = sums[:, j] / totals[j] * 100 if totals[j] > 0 else 0.0
+    summary = add_significance_columns(summary, totals=totals, metric_cols=metric_cols)
+    
+    monthly = pd.DataFrame(columns=[entity_col, 'month', *metric_cols, 'ctr', 'cr'])
+    if 'month' in _df.columns and selected.any():
+        month_values = _df['month'].to_numpy()[selected]
+        month_keys = sort_month_keys(pd.unique(month_values[pd.notna(month_values)]))
+        month_codes = pd.Categorical(month_values, categories=month_keys).codes.astype(np.int64)
+        valid = month_codes >= 0
+        cells = codes[valid] * len(month_keys) + month_codes[valid]
+        n_cells = n_entities * len(month_keys)
+        rows = np.bincount(cells, minlength=n_cells)
+        cell_sums = np.column_stack([np.bincount(cells, weights=measures[valid, j], minlength=n_cells) for j in range(3)])
+        present = rows > 0
+        monthly = pd.DataFrame(np.round(cell_sums[present]).astype(np.int64), columns=list(metric_cols))
+        monthly.insert(0, 'month', np.tile(np.asarray(month_keys, dtype=object), n_entities)[present])
+        monthly.insert(0, entity_col, np.repeat(np.asarray(entities, dtype=object), len(month_keys))[present])
+        monthly = _rates(monthly)
+    
+    return {'summary': summary, 'monthly': monthly}
+
+# ========================================
+# 🔢 SORT-PERMUTATION CACHE FOR RANKED TABLES
+# ========================================
+SORTABLE_METRICS = ('Counts', 'count', 'clicks', 'Clicks', 'conversions', 'Conversions',
+                    'ctr', 'cr', 'conversion_rate', 'classic_cr', 'classic_cvr', 'share_pct')
+
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=32)
+def build_sort_permutations(_table, cache_key, sort_cols=None):
+    """Descending stable argsort per sortable metric of an aggregated table, computed once.
+
+    Returns {column: (order, n_valid)} - positions sorted high-to-low with NaNs last,
+    n_valid = non-NaN count. Pair with ranked_view() so re-sorting is an index slice.
+    """
+    sort_cols = [c for c in (sort_cols or SORTABLE_METRICS) if c in _table.columns]
+    permutations = {}
+    for col in sort_cols:
+        values = pd.to_numeric(_table[col], errors='coerce').to_numpy(dtype=np.float64)
+        nan_mask = np.isnan(values)
+        order = np.argsort(np.where(nan_mask, np.inf, -values), kind='stable')
+        permutations[col] = (order, int(len(values) - nan_mask.sum()))
+    return permutations
+
+def ranked_view(table, permutations, sort_col, ascending=False, top_n=None, mask=None):
+    """Rows of table ordered by a cached permutation - sort column, direction, filter and top-N
+    are all index slices (same order as a stable sort_values, NaNs last; ascending ties keep
+    reverse table order). mask is an optional boolean array aligned to table rows."""
+    order, n_valid = permutations[sort_col]
+    if ascending:
+        order = np.concatenate([order[:n_valid][::-1], order[n_valid:]])
+    if mask is not None:
+        order = order[np.asarray(mask, dtype=bool)[order]]
+    if top_n is not None:
+        order = order[:top_n]
+    return table.take(order)
+
+# ========================================
+# 🔁 PERIOD-OVER-PERIOD DIFF ENGINE
+# ========================================
+def previous_period(start, end):
+    """The equal-length date range immediately before [start, end] (inclusive days)."""
+    start, end = pd.Timestamp(start).normalize(), pd.Timestamp(end).normalize()
+    length = end - start + pd.Timedelta(days=1)
+    return start - length, start - pd.Timedelta(days=1)
+
+def month_period(month):
+    """Inclusive (first day, last day) of a month key ('June 2025' or '2025-06')."""
+    period = pd.Timestamp(pd.to_datetime(month)).to_period('M')
+    return period.start_time.normalize(), period.end_time.normalize()
+
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=16)
+def compute_period_diff(_df, dim_col, period_a, period_b, cache_key, date_col='Date',
+                        metric_cols=tuple(METRIC_COLS)):
+    """Aligned per-entity aggregates for two date ranges and their deltas, in one pass.
+
+    period_a (baseline) and period_b (comparison) are inclusive (start, end) dates. Rows in
+    either range are factorized on dim_col once and summed per period with bincount, so an
+    entity missing from one period aligns as zeros. Returns dict with 'diff' (dim_col,
+    <metric>_a / <metric>_b, ctr_a/b, cr_a/b, delta_volume, delta_volume_pct - NaN when the
+    baseline volume is 0 - and delta_clicks, delta_conversions, delta_ctr / delta_cr in
+    percentage points) and 'totals' (the same fields for the whole ranges).
+    """
+    vol_col, clicks_col, conv_col = metric_cols
+    dates = pd.to_datetime(_df[date_col], errors='coerce').dt.normalize().to_numpy()
+    in_period = [
+        (dates >= np.datetime64(pd.Timestamp(start).normalize())) & (dates <= np.datetime64(pd.Timestamp(end).normalize()))
+        for start, end in (period_a, period_b)
+    ]
+    selected = in_period[0] | in_period[1]
+    codes, labels = pd.factorize(_df[dim_col].to_numpy()[selected])
+    measures = _df.loc[selected, list(metric_cols)].apply(pd.to_numeric, errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    valid = codes >= 0
+    
+    diff = pd.DataFrame({dim_col: labels})
+    totals = {}
+    for suffix, mask in zip(('_a', '_b'), in_period):
+        period_rows = mask[selected] & valid
+        for j, col in enumerate(metric_cols):
+            sums = np.bincount(codes[period_rows], weights=measures[period_rows, j], minlength=len(labels))
+            diff[col + suffix] = np.round(sums).astype(np.int64)
+            totals[col + suffix] = int(round(measures[mask[selected], j].sum()))
+    
+    def _rate(num, den):
+        num, den = np.asarray(num, dtype=np.float64), np.asarray(den, dtype=np.float64)
+        return np.divide(num, den, out=np.zeros(np.shape(den)), where=den > 0) * 100
+    
+    for target in (diff, totals):
+        for suffix in ('_a', '_b'):
+            target['ctr' + suffix] = _rate(target[clicks_col + suffix], target[vol_col + suffix])
+            target['cr' + suffix] = _rate(target[conv_col + suffix], target[vol_col + suffix])
+        base_volume = np.asarray(target[vol_col + '_a'], dtype=np.float64)
+        target['delta_volume'] = np.asarray(target[vol_col + '_b']) - np.asarray(target[vol_col + '_a'])
+        target['delta_volume_pct'] = np.divide(
+            np.asarray(target['delta_volume'], dtype=np.float64), base_volume,
+            out=np.full(np.shape(base_volume), np.nan), where=base_volume > 0
+        ) * 100
+        target['delta_clicks'] = np.asarray(target[clicks_col + '_b']) - np.asarray(target[clicks_col + '_a'])
+        target['delta_conversions'] = np.asarray(target[conv_col + '_b']) - np.asarray(target[conv_col + '_a'])
+        target['delta_ctr'] = np.asarray(target['ctr_b']) - np.asarray(target['ctr_a'])
+        target['delta_cr'] = np.asarray(target['cr_b']) - np.asarray(target['cr_a'])
+    totals = {key: np.asarray(value).item() for key, value in totals.items()}
+    
+    return {'diff': diff, 'totals': totals}
+
+# ========================================
+# 🚨 MOVER / ANOMALY DETECTION
+# ========================================
+MOVER_Z_THRESHOLD = 3.0  # |z| at or above this is flagged as a significant move / spike
+MOVER_SPIKE_MIN_MONTHS = 3  # a spike month needs at least two other months to compare against
+
+def _entity_month_matrix(_df, entity_col, metric_col='Counts', month_col='month'):
+    """Dense (entities × months) sums of metric_col via one factorize + bincount.
+
+    Returns (matrix, entities, months) with months in chronological order.
+    """
+    rows = _df[[entity_col, month_col]].notna().all(axis=1).to_numpy()
+    entity_codes, entities = pd.factorize(_df[entity_col].to_numpy()[rows])
+    months = sort_month_keys(pd.unique(_df[month_col].to_numpy()[rows]))
+    month_codes = pd.Categorical(_df[month_col].to_numpy()[rows], categories=months).codes.astype(np.int64)
+    values = pd.to_numeric(_df[metric_col], errors='coerce').fillna(0).to_numpy(dtype=np.float64)[rows]
+    
+    n_entities, n_months = len(entities), len(months)
+    matrix = np.bincount(entity_codes * n_months + month_codes, weights=values,
+                         minlength=n_entities * n_months).reshape(n_entities, n_months)
+    return matrix, entities, months
+
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=8)
+def detect_entity_movers(_df, entity_col, cache_key, metric_col='Counts', month_col='month', min_volume=100):
+    """Month-over-month movers and spikes for every entity from one entity × month matrix.
+
+    The dense matrix is built with a single factorize + bincount, then every score is a
+    column-wise numpy operation (no per-entity loop), so 100k+ queries stay fast. Per entity:
+    prev / last month volume, mom_change, mom_pct (NaN when prev is 0), mom_z (Poisson-style
+    (last - prev) / sqrt(last + prev)), trend_pct (least-squares slope per month as % of the
+    entity's mean), spike_z / spike_month / spike_volume / spike_baseline (largest deviation of a
+    month from the mean of the entity's *other* months, in units of their std floored at the
+    Poisson sd of that difference - so a single month can reach MOVER_Z_THRESHOLD even with 3 months;
+    0 with fewer than MOVER_SPIKE_MIN_MONTHS months), and direction - 'Riser' / 'Faller' when
+    |mom_z| >= MOVER_Z_THRESHOLD and max(prev, last) >= min_volume, else 'Stable'.
+    Returns (movers, months).
+    """
+    matrix, entities, months = _entity_month_matrix(_df, entity_col, metric_col, month_col)
+    n_entities, n_months = matrix.shape
+    
+    movers = pd.DataFrame({entity_col: entities, 'total': matrix.sum(axis=1).round().astype(np.int64)})
+    if n_months < 2:
+        return movers.iloc[0:0], months
+    
+    prev, last = matrix[:, -2], matrix[:, -1]
+    movers['prev'] = prev.round().astype(np.int64)
+    movers['last'] = last.round().astype(np.int64)
+    movers['mom_change'] = movers['last'] - movers['prev']
+    movers['mom_pct'] = np.divide(last - prev, prev, out=np.full(n_entities, np.nan), where=prev > 0) * 100
+    movers['mom_z'] = np.divide(last - prev, np.sqrt(last + prev), out=np.zeros(n_entities), where=(last + prev) > 0)
+    
+    # Least-squares slope over month positions, relative to the entity mean
+    mean = matrix.mean(axis=1)
+    t = np.arange(n_months, dtype=np.float64) - (n_months - 1) / 2
+    slope = matrix @ t / (t @ t)
+    movers['trend_pct'] = np.divide(slope, mean, out=np.zeros(n_entities), where=mean > 0) * 100
+    
+    # Spike: each month against the mean / std of the other months (leave-one-out, std floored at
+    # the Poisson sd of month - baseline) - scoring against a mean that includes the month caps |z| at sqrt(n-1)
+    if n_months >= MOVER_SPIKE_MIN_MONTHS:
+        others = n_months - 1
+        other_mean = (matrix.sum(axis=1)[:, None] - matrix) / others
+        other_var = np.clip(((matrix ** 2).sum(axis=1)[:, None] - matrix ** 2) / others - other_mean ** 2, 0, None)
+        other_std = np.maximum(np.sqrt(other_var), np.sqrt(other_mean * (1 + 1 / others)))
+        deviations = np.divide(matrix - other_mean, other_std, out=np.zeros_like(matrix), where=other_std > 0)
+    else:
+        other_mean, deviations = np.repeat(mean[:, None], n_months, axis=1), np.zeros_like(matrix)
+    spike_pos = np.abs(deviations).argmax(axis=1)
+    rows = np.arange(n_entities)
+    movers['spike_z'] = deviations[rows, spike_pos]
+    movers['spike_month'] = np.asarray(months, dtype=object)[spike_pos]
+    movers['spike_volume'] = matrix[rows, spike_pos].round().astype(np.int64)
+    movers['spike_baseline'] = other_mean[rows, spike_pos]
+    
+    significant = (np.abs(movers['mom_z'].to_numpy()) >= MOVER_Z_THRESHOLD) & (np.maximum(prev, last) >= min_volume)
+    movers['direction'] = np.where(significant, np.where(last > prev, 'Riser', 'Faller'), 'Stable')
+    
+    return movers, months
+
+# ========================================
+# 🕒 TIME-BUCKET SERIES ENGINE (DAY / WEEK / MONTH)
+# ========================================
+TIME_GRANULARITIES = ('Daily', 'Weekly', 'Monthly')
+
+def _to_datetime_column(values):
+    """Datetime view of a date column that may hold datetimes, Excel serials or strings."""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    serials = pd.to_numeric(values, errors='coerce')
+    if serials.notna().any():
+        return pd.to_datetime(serials, unit='D', origin='1899-12-30', errors='coerce')
+    return pd.to_datetime(values, errors='coerce')
+
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=4)
+def build_time_buckets(_df, cache_key, date_col='Date', end_col='end_date', entity_cols=(),
+                       metric_cols=tuple(METRIC_COLS)):
+    """Day-level cube with integer day / week / month bucket codes, built once per filter state.
+
+    Rows are coded to days since the first date (start of the row's range), summed into a daily
+    (n_days × metrics) array and, per entity column, a sparse (entity, day) table. Coarser buckets
+    are day -> bucket code maps, so resample_time_series() never touches the row-level frame.
+    span_days is the median start-to-end length of a row (1 without end_col): buckets finer than
+    the source rows are reported as unavailable in 'granularities'.
+    """
+    dates = _to_datetime_column(_df[date_col]).dt.normalize()
+    valid = dates.notna().to_numpy()
+    if not valid.any():
+        return None
+    
+    origin = dates[valid].min()
+    day_codes = ((dates[valid] - origin).dt.days).to_numpy(dtype=np.int64)
+    n_days = int(day_codes.max()) + 1
+    measures = _df.loc[valid, list(metric_cols)].apply(pd.to_numeric, errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+    
+    days = pd.date_range(origin, periods=n_days, freq='D')
+    week_starts = days - pd.to_timedelta(days.dayofweek, unit='D')
+    month_starts = days.to_period('M').to_timestamp()
+    bucket_codes, bucket_labels = {'Daily': np.arange(n_days)}, {'Daily': days}
+    for name, starts in (('Weekly', week_starts), ('Monthly', month_starts)):
+        codes, labels = pd.factorize(starts, sort=True)
+        bucket_codes[name], bucket_labels[name] = codes, pd.DatetimeIndex(labels)
+    
+    span_days = 1
+    if end_col in _df.columns:
+        ends = _to_datetime_column(_df.loc[valid, end_col]).dt.normalize()
+        spans = (ends - dates[valid]).dt.days.dropna()
+        if len(spans):
+            span_days = max(int(spans.median()) + 1, 1)
+    granularities = [g for g, width in zip(TIME_GRANULARITIES, (1, 7, 28)) if span_days <= width] or ['Monthly']
+    
+    daily = np.column_stack([np.bincount(day_codes, weights=measures[:, j], minlength=n_days) for j in range(len(metric_cols))])
+    
+    entity_daily = {}
+    for col in entity_cols:
+        if col not in _df.columns:
+            continue
+        entity_codes, entities = pd.factorize(_df.loc[valid, col].to_numpy())
+        keep = entity_codes >= 0
+        keys, key_codes = np.unique(entity_codes[keep] * n_days + day_codes[keep], return_inverse=True)
+        sums = np.column_stack([np.bincount(key_codes, weights=measures[keep, j], minlength=len(keys)) for j in range(len(metric_cols))])
+        entity_daily[col] = {'entities': entities, 'entity': keys // n_days, 'day': keys % n_days, 'sums': sums}
+    
+    return {
+        'days': days, 'bucket_codes': bucket_codes, 'bucket_labels': bucket_labels, 'daily': daily,
+        'entity_daily': entity_daily, 'metric_cols': tuple(metric_cols),
+        'span_days': span_days, 'granularities': granularities
+    }
+
+def resample_time_series(buckets, granularity='Monthly', entity_col=None, entities=None):
+    """Per-bucket totals (or per entity × bucket) from the day-level cube with ctr / cr.
+
+    Returns a long DataFrame: 'period' (bucket start), [entity_col], metric columns, ctr, cr.
+    entities limits the entity rows (default: all entities of entity_col).
+    """
+    vol_col, clicks_col, conv_col = buckets['metric_cols']
+    codes = buckets['bucket_codes'][granularity]
+    labels = buckets['bucket_labels'][granularity]
+    n_buckets = len(labels)
+    
+    if entity_col is None:
+        sums = np.column_stack([np.bincount(codes, weights=buckets['daily'][:, j], minlength=n_buckets) for j in range(3)])
+        series = pd.DataFrame(np.round(sums).astype(np.int64), columns=list(buckets['metric_cols']))
+        series.insert(0, 'period', labels)
+    else:
+        cube = buckets['entity_daily'][entity_col]
+        names = cube['entities']
+        rows = np.ones(len(cube['entity']), dtype=bool)
+        if entities is not None:
+            wanted = pd.Index(names).get_indexer(list(entities))
+            rows = np.isin(cube['entity'], wanted[wanted >= 0])
+        cells = cube['entity'][rows] * n_buckets + codes[cube['day'][rows]]
+        keys, key_codes = np.unique(cells, return_inverse=True)
+        sums = np.column_stack([np.bincount(key_codes, weights=cube['sums'][rows, j], minlength=len(keys)) for j in range(3)])
+        series = pd.DataFrame(np.round(sums).astype(np.int64), columns=list(buckets['metric_cols']))
+        series.insert(0, entity_col, np.asarray(names, dtype=object)[keys // n_buckets])
+        series.insert(0, 'period', labels[keys % n_buckets])
+    
+    volume = series[vol_col].to_numpy(dtype=np.float64)
+    series['ctr'] = np.divide(series[clicks_col].to_numpy(dtype=np.float64), volume, out=np.zeros(len(series)), where=volume > 0) * 100
+    series['cr'] = np.divide(series[conv_col].to_numpy(dtype=np.float64), volume, out=np.zeros(len(series)), where=volume > 0) * 100
+    return series
+
+# ========================================
+# 🔮 BATCH SERIES FORECASTING
+# ========================================
+FORECAST_SMOOTHING_GRID = (0.2, 0.5, 0.8)  # candidate Holt alpha / beta values, picked per series
+FORECAST_INTERVAL_Z = 1.96                  # ~95% prediction interval
+FORECAST_MIN_INTERVAL_MONTHS = 6            # fewer months -> too few real errors, intervals are approximate
+
+def _holt_one_step(series, alpha, beta):
+    """Holt linear smoothing over all rows at once; returns (level, trend, one-step errors).
+
+    Level / trend are initialised from the first two points, so the first real one-step error is
+    at t = 2; errors has n_months - 2 columns (no structural zero from the initialisation).
+    """
+    level, trend = series[:, 1].copy(), series[:, 1] - series[:, 0]
+    errors = np.zeros((series.shape[0], series.shape[1] - 2))
+    for t in range(2, series.shape[1]):
+        predicted = level + trend
+        errors[:, t - 2] = series[:, t] - predicted
+        new_level = alpha * series[:, t] + (1 - alpha) * predicted
+        trend = beta * (new_level - level) + (1 - beta) * trend
+        level = new_level
+    return level, trend, errors
+
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=8)
+def forecast_entity_series(_df, entity_col, cache_key, top_n=200, horizon=1, metric_col='Counts', month_col='month'):
+    """Next-month volume forecasts for the top_n entities (by volume) from the entity × month matrix.
+
+    Every series is fitted at once - the loops run over months and a small alpha/beta grid, never
+    over entities. Holt linear trend with alpha/beta chosen per series by one-step squared error;
+    with 24+ months the series are first deseasonalized by a month-of-year index. Intervals use
+    the RMSE of the real one-step errors (t >= 2), widened by sqrt(step). Returns (forecasts,
+    history, months, future): forecasts has entity_col, total, last, forecast_<k> / lower_<k> /
+    upper_<k> per step, change_pct (step 1 vs last month), mape, model and interval_approx (True
+    with fewer than FORECAST_MIN_INTERVAL_MONTHS months); history is the (top_n × months) matrix.
+    """
+    matrix, entities, months = _entity_month_matrix(_df, entity_col, metric_col, month_col)
+    n_months = len(months)
+    future = [(pd.Timestamp(pd.to_datetime(months[-1])) + pd.DateOffset(months=k)).strftime('%B %Y')
+              for k in range(1, horizon + 1)] if n_months else []
+    if n_months < 3 or len(entities) == 0:
+        return pd.DataFrame(), pd.DataFrame(), months, future
+    
+    order = np.argsort(-matrix.sum(axis=1), kind='stable')[:top_n]
+    matrix, entities = matrix[order], np.asarray(entities, dtype=object)[order]
+    
+    # Month-of-year seasonal index (needs two full years of history)
+    seasonal = n_months >= 24
+    if seasonal:
+        positions = np.arange(n_months) % 12
+        yearly_mean = np.stack([matrix[:, max(0, t - 11):t + 1].mean(axis=1) for t in range(n_months)], axis=1)
+        ratios = np.divide(matrix, yearly_mean, out=np.ones_like(matrix), where=yearly_mean > 0)
+        index = np.stack([ratios[:, positions == p].mean(axis=1) for p in range(12)], axis=1)
+        index = np.where(index > 0, index, 1.0)
+        index = index / index.mean(axis=1, keepdims=True)
+        fit_series = matrix / index[:, positions]
+    else:
+        fit_series = matrix
+    
+    best = None
+    for alpha in FORECAST_SMOOTHING_GRID:
+        for beta in FORECAST_SMOOTHING_GRID:
+            level, trend, errors = _holt_one_step(fit_series, alpha, beta)
+            sse = (errors ** 2).sum(axis=1)
+            if best is None:
+                best = [sse, level, trend, errors]
+            else:
+                better = sse < best[0]
+                for slot, value in enumerate((sse, level, trend, errors)):
+                    best[slot] = np.where(better[:, None], value, best[slot]) if value.ndim == 2 else np.where(better, value, best[slot])
+    _, level, trend, errors = best
+    error_rmse = np.sqrt((errors ** 2).mean(axis=1))
+    
+    forecasts = pd.DataFrame({entity_col: entities, 'total': matrix.sum(axis=1).round().astype(np.int64),
+                              'last': matrix[:, -1].round().astype(np.int64)})
+    for step in range(1, horizon + 1):
+        point = level + step * trend
+        if seasonal:
+            point = point * index[:, (n_months - 1 + step) % 12]
+        point = np.maximum(point, 0)
+        spread = FORECAST_INTERVAL_Z * error_rmse * np.sqrt(step)
+        forecasts[f'forecast_{step}'] = point
+        forecasts[f'lower_{step}'] = np.maximum(point - spread, 0)
+        forecasts[f'upper_{step}'] = point + spread
+    
+    last = matrix[:, -1]
+    forecasts['change_pct'] = np.divide(forecasts['forecast_1'].to_numpy() - last, last, out=np.full(len(last), np.nan), where=last > 0) * 100
+    actual = fit_series[:, 2:]
+    pct_errors = np.divide(np.abs(errors), actual, out=np.full(actual.shape, np.nan), where=actual > 0)
+    forecasts['mape'] = np.nanmean(np.where(np.isnan(pct_errors).all(axis=1, keepdims=True), 0.0, pct_errors), axis=1) * 100
+    forecasts['model'] = 'Holt + seasonal' if seasonal else 'Holt trend'
+    forecasts['interval_approx'] = n_months < FORECAST_MIN_INTERVAL_MONTHS
+    history = pd.DataFrame(matrix, columns=months)
+    history.insert(0, entity_col, entities)
+    
+    return forecasts, history, months, future
+
+# ========================================
+# 🎯 CONCENTRATION & DISTRIBUTION METRICS
+# ========================================
+CONCENTRATION_DIMENSIONS = {
+    'normalized_query': 'Query', 'brand': 'Brand', 'department': 'Department',
+    'category': 'Category', 'sub_category': 'Subcategory', 'Class': 'Class'
+}
+CONCENTRATION_TOP_KS = (1, 3, 5, 10)
+PARETO_SHARE = 0.8
+
+def _concentration_stats(matrix):
+    """Gini, HHI (0-1), top-k shares and the 80% Pareto cutoff for every column of an
+    (entities × groups) volume matrix - one descending sort, all columns at once."""
+    ordered = -np.sort(-matrix, axis=0)
+    totals = ordered.sum(axis=0)
+    present = (ordered > 0).sum(axis=0)
+    safe_totals = np.where(totals > 0, totals, 1.0)
+    cum_share = np.cumsum(ordered, axis=0) / safe_totals
+    ranks = np.arange(1, ordered.shape[0] + 1, dtype=np.float64)[:, None]
+    
+    # Gini on the non-zero entities: ascending cumulative sums == descending values × rank
+    n = np.where(present > 0, present, 1)
+    stats = {
+        'n_entities': present,
+        'total': totals.round().astype(np.int64),
+        'gini': np.where(present > 1, (n + 1 - 2 * (ordered * ranks).sum(axis=0) / safe_totals) / n, 0.0),
+        'hhi': ((ordered / safe_totals) ** 2).sum(axis=0)
+    }
+    for k in CONCENTRATION_TOP_KS:
+        stats[f'top_{k}_share'] = cum_share[min(k, ordered.shape[0]) - 1] * 100
+    stats['pareto_count'] = np.minimum((cum_share < PARETO_SHARE - 1e-12).sum(axis=0) + 1, present)
+    stats['pareto_pct'] = np.divide(stats['pareto_count'], present, out=np.zeros(len(present)), where=present > 0) * 100
+    return stats
+
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=8)
+def compute_concentration_table(_df, cache_key, dimensions=None, metric_col='Counts', month_col='month',
+                                excluded_labels=tuple(MATRIX_EXCLUDED_LABELS)):
+    """Concentration of metric_col across the entities of every dimension, overall and per month.
+
+    dimensions maps column -> label (default CONCENTRATION_DIMENSIONS, present columns only);
+    labels in excluded_labels (case-insensitive, e.g. the 'Other' brand bucket) are left out.
+    The month column itself is added as a dimension (distribution of volume across months).
+    Long table: dimension, column, month ('All' for the whole range), n_entities, total, gini,
+    hhi (0-1), top_<k>_share %, pareto_count / pareto_pct (entities holding 80% of volume).
+    """
+    dimensions = {col: label for col, label in (dimensions or CONCENTRATION_DIMENSIONS).items() if col in _df.columns}
+    has_month = month_col in _df.columns
+    excluded = {str(label).lower() for label in excluded_labels}
+    frames = []
+    
+    for col, label in dimensions.items():
+        if has_month:
+            matrix, entities, months = _entity_month_matrix(_df, col, metric_col, month_col)
+        else:
+            codes, entities = pd.factorize(_df[col].to_numpy())
+            values = pd.to_numeric(_df[metric_col], errors='coerce').fillna(0).to_numpy(dtype=np.float64)
+            matrix, months = np.bincount(codes[codes >= 0], weights=values[codes >= 0], minlength=len(entities))[:, None], []
+        if excluded:
+            keep = ~pd.Index(entities).astype(str).str.lower().isin(excluded)
+            matrix = matrix[keep]
+        if matrix.shape[0] == 0:
+            continue
+        if has_month:
+            matrix = np.column_stack([matrix.sum(axis=1), matrix])
+        stats = _concentration_stats(matrix)
+        frame = pd.DataFrame(stats)
+        frame.insert(0, 'month', ['All'] + list(months) if has_month else ['All'])
+        frame.insert(0, 'column', col)
+        frame.insert(0, 'dimension', label)
+        frames.append(frame)
+    
+    if has_month:
+        monthly = _df.groupby(month_col, observed=True)[metric_col].sum()
+        if len(monthly):
+            frame = pd.DataFrame(_concentration_stats(monthly.to_numpy(dtype=np.float64)[:, None]))
+            frame.insert(0, 'month', 'All')
+            frame.insert(0, 'column', month_col)
+            frame.insert(0, 'dimension', 'Month')
+            frames.append(frame)
+    
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+def concentration_metrics(table, column, month='All'):
+    """One row of the concentration table as a dict (empty dict when absent)."""
+    if table is None or table.empty:
+        return {}
+    row = table[(table['column'] == column) & (table['month'] == month)]
+    return row.iloc[0].to_dict() if len(row) else {}
+
+# ========================================
+# 🧮 CUSTOM PIVOT ENGINE (CATEGORICAL CODES + CARDINALITY GUARD)
+# ========================================
+PIVOT_MAX_CELLS = 200_000     # dense pivots above this many cells go through the guard
+PIVOT_MAX_COLUMNS = 50        # column budget when truncating to top-k rows × columns
+PIVOT_RATIO_MEASURES = {'ctr': ('clicks', 'Counts'), 'conversion_rate': ('conversions', 'Counts'),
+                        'classic_cvr': ('conversions', 'clicks')}
+PIVOT_GUARD_MODES = ('truncate', 'sparse', 'refuse')
+
+def _pivot_source(_df):
+    """Rows eligible for the custom pivot (the 'Other' brand bucket is excluded)."""
+    if 'brand' in _df.columns:
+        return _df[~_df['brand'].astype(str).str.lower().isin(['other'])]
+    return _df
+
+def _pivot_key_frame(data, keys):
+    """Pivot key columns as categoricals, shared by the size estimate and the build.
+
+    A missing brand becomes '' and is kept (as the original pivot did); rows with any other
+    missing key are dropped, matching groupby's default dropna=True.
+    """
+    frame = data[list(keys)].astype('category')
+    if 'brand' in frame.columns and frame['brand'].isna().any():
+        brand = frame['brand']
+        if '' not in brand.cat.categories:
+            brand = brand.cat.add_categories([''])
+        frame['brand'] = brand.fillna('')
+    return frame.dropna()
+
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=16)
+def estimate_pivot_cardinality(_df, idx_cols, col_cols, cache_key):
+    """Output (rows, columns) of a pivot before building it - distinct observed key combinations."""
+    frame = _pivot_key_frame(_pivot_source(_df), list(idx_cols) + list(col_cols))
+    return tuple(
+        int(frame.groupby(list(keys), observed=True, sort=False).ngroups) if keys else 1
+        for keys in (idx_cols, col_cols)
+    )
+
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=5)
+def build_custom_pivot(_df, idx_cols, col_cols, val_col, agg_func, cache_key, guard='truncate',
+                       max_cells=PIVOT_MAX_CELLS):
+    """Custom pivot grouped on categorical codes (observed=True) with a cardinality guard.
+
+    Base measures are aggregated once per observed (row key, column key) cell; ratio measures
+    (ctr, conversion_rate, classic_cvr) are computed from the summed parts after aggregation.
+    When rows × columns would exceed max_cells, guard decides: 'truncate' keeps the top rows and
+    columns by search volume, 'sparse' returns the non-empty cells as a long table, 'refuse'
+    builds nothing. Returns dict: pivot (None when refused), mode ('dense' / 'truncated' /
+    'sparse' / 'refused'), n_rows, n_cols, cells, kept_rows, kept_cols.
+    """
+    idx_cols, col_cols = list(idx_cols), list(col_cols)
+    n_rows, n_cols = estimate_pivot_cardinality(_df, tuple(idx_cols), tuple(col_cols), cache_key)
+    if guard == 'refuse' and n_rows * n_cols > max_cells:
+        return {'pivot': None, 'mode': 'refused', 'n_rows': n_rows, 'n_cols': n_cols, 'cells': None,
+                'kept_rows': 0, 'kept_cols': 0}
+    
+    data = _pivot_source(_df)
+    keys = idx_cols + col_cols
+    measures = ['Counts'] + [c for c in dict.fromkeys(PIVOT_RATIO_MEASURES.get(val_col, (val_col,))) if c != 'Counts']
+    frame = _pivot_key_frame(data, keys)
+    for col in measures:
+        frame[col] = pd.to_numeric(data[col], errors='coerce').fillna(0).reindex(frame.index)
+    
+    grouped = frame.groupby(keys, observed=True, sort=False)
+    if val_col in PIVOT_RATIO_MEASURES:
+        cells = grouped[measures].sum()
+        numerator, denominator = PIVOT_RATIO_MEASURES[val_col]
+        num, den = cells[numerator].to_numpy(dtype=np.float64), cells[denominator].to_numpy(dtype=np.float64)
+        values = np.divide(num, den, out=np.zeros(len(cells)), where=den > 0) * 100
+        if agg_func == 'count':
+            values = grouped.size().reindex(cells.index).to_numpy(dtype=np.float64)
+        cells = pd.DataFrame({val_col: values, 'Counts': cells['Counts'].to_numpy()}, index=cells.index)
+    else:
+        cells = grouped.agg(**{val_col: (val_col, agg_func), '_volume': ('Counts', 'sum')})
+        if val_col != 'Counts':
+            cells = cells.rename(columns={'_volume': 'Counts'})
+        else:
+            cells = cells.drop(columns='_volume').assign(Counts=cells[val_col])
+    
+    def _keys(level_names):
+        return cells.index.droplevel([k for k in keys if k not in level_names]) if len(keys) > 1 else cells.index
+    
+    row_keys, col_keys = _keys(idx_cols), _keys(col_cols)
+    row_volume = cells['Counts'].groupby(row_keys, observed=True).sum().sort_values(ascending=False)
+    col_volume = cells['Counts'].groupby(col_keys, observed=True).sum().sort_values(ascending=False)
+    n_rows, n_cols = len(row_volume), len(col_volume)
+    result = {'n_rows': n_rows, 'n_cols': n_cols, 'cells': len(cells), 'kept_rows': n_rows, 'kept_cols': n_cols}
+    
+    def _dense(table):
+        return table[val_col].unstack(col_cols, fill_value=0)
+    
+    if n_rows * n_cols <= max_cells:
+        return {**result, 'pivot': _dense(cells), 'mode': 'dense'}
+    if guard == 'sparse':
+        long_cells = cells.reset_index().sort_values('Counts', ascending=False, kind='stable')
+        for col in keys:
+            long_cells[col] = long_cells[col].astype(str)
+        return {**result, 'pivot': long_cells.reset_index(drop=True), 'mode': 'sparse'}
+    
+    kept_cols = min(n_cols, PIVOT_MAX_COLUMNS)
+    kept_rows = max(1, min(n_rows, max_cells // kept_cols))
+    keep = row_keys.isin(row_volume.index[:kept_rows]) & col_keys.isin(col_volume.index[:kept_cols])
+    pivot = _dense(cells[keep]).reindex(index=row_volume.index[:kept_rows], columns=col_volume.index[:kept_cols], fill_value=0)
+    return {**result, 'pivot': pivot, 'mode': 'truncated', 'kept_rows': kept_rows, 'kept_cols': kept_cols}
+
+# ========================================
+# 🧠 SHARED INSIGHTS ENGINE
+# ========================================
+INSIGHTS_MIN_VOLUME = 200            # "Search Volume >= 200" filter used by most questions
+INSIGHTS_HIGH_VOLUME = 500           # Q15 untapped-potential volume floor
+INSIGHTS_MIN_CLICKS = 50             # Q14 classic-CVR click floor
+INSIGHTS_TOP_N = 20
+INSIGHTS_VOLUME_BINS = [0, 100, 500, 1000, 5000, float('inf')]
+INSIGHTS_VOLUME_LABELS = ['0-100', '101-500', '501-1K', '1K-5K', '5K+']
+INSIGHTS_QUERY_COLS = ['search', 'brand', 'Counts', 'clicks', 'conversions', 'ctr', 'cr', 'ctr_smoothed', 'cr_smoothed']
+
+def _insights_brand_labels(values):
+    """Brand labels with blanks / nan / None folded into 'Other' (generic items)."""
+    labels = values.astype('object')
+    text = labels.astype(str).str.strip()
+    missing = labels.isna().to_numpy() | text.str.lower().isin(['', 'nan', 'none', 'other']).to_numpy()
+    return np.where(missing, 'Other', text.to_numpy())
+
+def _insights_rate_table(keys, key_name, counts, clicks, conversions, n_queries=None):
+    """Summed totals + ratio-of-sums CTR / CR for an already-aggregated key column."""
+    table = pd.DataFrame({key_name: keys, 'Counts': counts, 'clicks': clicks, 'conversions': conversions})
+    if n_queries is not None:
+        table.insert(1, 'n_queries', n_queries)
+    table['ctr'] = np.divide(table['clicks'] * 100.0, table['Counts'], out=np.zeros(len(table)), where=table['Counts'].to_numpy() > 0)
+    table['cr'] = np.divide(table['conversions'] * 100.0, table['Counts'], out=np.zeros(len(table)), where=table['Counts'].to_numpy() > 0)
+    return table
+
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=4)
+def build_insights_engine(_df, cache_key, min_volume=INSIGHTS_MIN_VOLUME, top_n=INSIGHTS_TOP_N):
+    """Answer every Insights question (Q1-Q15) from one per-query aggregation.
+
+    Rows are summed once to (query, brand) totals with ratio-of-sums CTR / CR; the shared masks
+    (branded = brand != 'Other', core = branded & Counts >= min_volume) are built once and every
+    answer is a slice / top-n of those tables. Per-query rates also get empirical-Bayes
+    ctr_smoothed / cr_smoothed (shrunk toward the query's brand), brand rates toward all brands.
+    Returns a dict with 'queries' (per-query table), 'brands' (per-brand table), 'q1' .. 'q15'
+    (DataFrame or None when nothing qualifies) and 'smoothed' ('q1' .. 'q4' ranked by smoothed
+    rates over every branded query, no volume cut-off).
+    """
+    empty = {f'q{i}': None for i in range(1, 16)}
+    if _df is None or _df.empty or 'search' not in _df.columns:
+        return {'queries': pd.DataFrame(columns=INSIGHTS_QUERY_COLS), 'brands': None,
+                'smoothed': {f'q{i}': None for i in range(1, 5)}, **empty}
+    
+    # 🚀 Rows -> (query, brand) codes -> summed totals
+    query_codes, query_labels = pd.factorize(_df['search'].astype(str), sort=False)
+    brand_col = 'brand' if 'brand' in _df.columns else 'Brand' if 'Brand' in _df.columns else None
+    if brand_col is None:
+        brand_codes, brand_labels = np.zeros(len(_df), dtype=np.intp), np.array(['Other'], dtype=object)
+    else:
+        # Fold blanks into 'Other' on the distinct labels only (NaN code -1 picks the appended 'Other')
+        raw_codes, raw_labels = pd.factorize(_df[brand_col], sort=False)
+        folded = np.append(_insights_brand_labels(pd.Series(np.asarray(raw_labels, dtype=object))), 'Other')
+        folded_codes, brand_labels = pd.factorize(folded, sort=False)
+        brand_codes = folded_codes[raw_codes]
+    pair_codes, pairs = pd.factorize(query_codes.astype(np.int64) * len(brand_labels) + brand_codes, sort=False)
+    n_pairs = len(pairs)
+    sums = {col: np.rint(np.bincount(pair_codes, weights=pd.to_numeric(_df[col], errors='coerce').fillna(0).to_numpy(np.float64),
+                                     minlength=n_pairs)).astype(np.int64) for col in METRIC_COLS}
+    
+    per_query = _insights_rate_table(
+        query_labels[pairs // len(brand_labels)], 'search',
+        sums['Counts'], sums['clicks'], sums['conversions']
+    )
+    per_query.insert(1, 'brand', brand_labels[pairs % len(brand_labels)])
+    per_query['classic_cvr'] = np.divide(per_query['conversions'] * 100.0, per_query['clicks'],
+                                         out=np.zeros(n_pairs), where=per_query['clicks'].to_numpy() > 0)
+    per_query['query_word_band'] = compute_query_text_features(per_query['search'])['query_word_band'].to_numpy()
+    per_query = add_smoothed_rates(per_query, parent_col='brand')
+    if 'averageClickPosition' in _df.columns:
+        # Volume-weighted average click position per query
+        position = pd.to_numeric(_df['averageClickPosition'], errors='coerce').to_numpy(np.float64)
+        has_position = ~np.isnan(position)
+        weights = np.where(has_position, _df['Counts'].to_numpy(np.float64), 0)
+        weighted = np.bincount(pair_codes, weights=np.where(has_position, position, 0) * weights, minlength=n_pairs)
+        total_weight = np.bincount(pair_codes, weights=weights, minlength=n_pairs)
+        per_query['avg_position'] = np.divide(weighted, total_weight, out=np.full(n_pairs, np.nan), where=total_weight > 0)
+    
+    # ✅ Shared masks, built once
+    branded_mask = (per_query['brand'] != 'Other').to_numpy()
+    counts = per_query['Counts'].to_numpy()
+    branded = per_query[branded_mask]
+    core = per_query[branded_mask & (counts >= min_volume)]
+    
+    def top(frame, by, n=top_n, smallest=False, cols=INSIGHTS_QUERY_COLS):
+        if frame is None or frame.empty:
+            return None
+        picked = frame.nsmallest(n, by) if smallest else frame.nlargest(n, by)
+        return picked[cols].reset_index(drop=True)
+    
+    answers = dict(empty)
+    answers['q1'] = top(core, ['ctr', 'cr'])
+    answers['q2'] = top(core, ['ctr', 'cr'], smallest=True)
+    answers['q3'] = top(core, 'cr')
+    answers['q4'] = top(core, 'ctr')
+    # Smoothed rankings use every branded query - shrinkage replaces the volume cut-off
+    smoothed = {
+        'q1': top(branded, ['ctr_smoothed', 'cr_smoothed']),
+        'q2': top(branded, ['ctr_smoothed', 'cr_smoothed'], smallest=True),
+        'q3': top(branded, 'cr_smoothed'),
+        'q4': top(branded, 'ctr_smoothed')
+    }
+    
+    if not core.empty:
+        # Q5: top-30% volume with below-median CR
+        volume_cut = core['Counts'].quantile(0.70)
+        answers['q5'] = top(core[(core['Counts'] >= volume_cut) & (core['cr'] < core['cr'].median())], 'Counts',
+                            cols=['search', 'brand', 'Counts', 'clicks', 'conversions', 'cr'])
+        # Q6: CTR >= 70th pct, CR <= 30th pct
+        answers['q6'] = top(core[(core['ctr'] >= core['ctr'].quantile(0.70)) & (core['cr'] <= core['cr'].quantile(0.30))],
+                            'Counts', n=30)
+        # Q10: CTR < 1%
+        answers['q10'] = top(core[core['ctr'] < 1.0], 'Counts',
+                             cols=['search', 'brand', 'Counts', 'clicks', 'conversions', 'ctr'])
+        # Q11: top-5 position, below-median CTR
+        if 'avg_position' in core.columns:
+            ranked_well = core[core['avg_position'] <= 5]
+            if not ranked_well.empty:
+                answers['q11'] = top(ranked_well[ranked_well['ctr'] < ranked_well['ctr'].median()], 'Counts',
+                                     cols=['search', 'brand', 'Counts', 'clicks', 'conversions', 'avg_position', 'ctr'])
+    
+    # Q7: branded vs generic totals
+    brand_type = np.where(branded_mask, 'Branded', 'Generic')
+    type_totals = per_query.groupby(brand_type, sort=False)[METRIC_COLS].sum()
+    q7 = _insights_rate_table(type_totals.index.to_numpy(), 'brand_type', *(type_totals[c].to_numpy() for c in METRIC_COLS))
+    total_volume = q7['Counts'].sum()
+    q7['search_share'] = q7['Counts'] / total_volume * 100 if total_volume > 0 else 0.0
+    answers['q7'] = q7.sort_values('Counts', ascending=False).reset_index(drop=True)
+    
+    # Q8: calendar-month totals from start_date
+    if 'start_date' in _df.columns:
+        start = _to_datetime_column(_df['start_date'])
+        valid = start.notna().to_numpy()
+        if valid.any():
+            month_codes, month_labels = pd.factorize(start[valid].dt.to_period('M').astype(str), sort=True)
+            month_sums = [np.rint(np.bincount(month_codes, weights=_df[col].to_numpy(np.float64)[valid],
+                                              minlength=len(month_labels))).astype(np.int64) for col in METRIC_COLS]
+            answers['q8'] = _insights_rate_table(np.asarray(month_labels), 'month', *month_sums)
+    
+    # Q9: per-brand totals over distinct queries
+    brands = None
+    if not branded.empty:
+        brand_groups = branded.groupby('brand', sort=False)
+        brand_totals = brand_groups[METRIC_COLS].sum()
+        brands = _insights_rate_table(brand_totals.index.to_numpy(), 'brand',
+                                      *(brand_totals[c].to_numpy() for c in METRIC_COLS),
+                                      n_queries=brand_groups.size().to_numpy())
+        brands['avg_volume'] = (brands['Counts'] / brands['n_queries']).round(0)
+        brands = add_smoothed_rates(brands)
+        answers['q9'] = brands.nlargest(top_n, 'Counts').reset_index(drop=True)
+        
+        # Q12: per-query volume segments
+        segment = pd.cut(branded['Counts'], bins=INSIGHTS_VOLUME_BINS, labels=INSIGHTS_VOLUME_LABELS)
+        seg_groups = branded.groupby(segment, observed=True)
+        seg_totals = seg_groups[METRIC_COLS].sum()
+        q12 = _insights_rate_table(seg_totals.index, 'segment', *(seg_totals[c].to_numpy() for c in METRIC_COLS),
+                                   n_queries=seg_groups.size().to_numpy())
+        q12['avg_volume'] = (q12['Counts'] / q12['n_queries']).round(0)
+        answers['q12'] = q12
+        
+        # Q13: word-count bands
+        words = branded[branded['query_word_band'] >= 0]
+        if not words.empty:
+            word_groups = words.groupby('query_word_band', sort=True)
+            word_totals = word_groups[METRIC_COLS].sum()
+            q13 = _insights_rate_table(word_totals.index.map(dict(enumerate(QUERY_WORD_BAND_LABELS))), 'length',
+                                       *(word_totals[c].to_numpy() for c in METRIC_COLS),
+                                       n_queries=word_groups.size().to_numpy())
+            q13['avg_volume'] = (q13['Counts'] / q13['n_queries']).round(0)
+            answers['q13'] = q13
+        
+        # Q14: best classic CVR with enough clicks
+        answers['q14'] = top(branded[branded['clicks'] >= INSIGHTS_MIN_CLICKS], 'classic_cvr',
+                             cols=INSIGHTS_QUERY_COLS + ['classic_cvr'])
+        
+        # Q15: high volume, CTR and CR both below median -> missed clicks / conversions at median rates
+        high_volume = branded[branded['Counts'] >= INSIGHTS_HIGH_VOLUME]
+        if not high_volume.empty:
+            median_ctr, median_cr = high_volume['ctr'].median(), high_volume['cr'].median()
+            untapped = high_volume[(high_volume['ctr'] < median_ctr) & (high_volume['cr'] < median_cr)].copy()
+            if not untapped.empty:
+                untapped['potential_clicks'] = (untapped['Counts'] * median_ctr / 100).round(0)
+                untapped['potential_conversions'] = (untapped['Counts'] * median_cr / 100).round(0)
+                untapped['missed_clicks'] = untapped['potential_clicks'] - untapped['clicks']
+                untapped['missed_conversions'] = untapped['potential_conversions'] - untapped['conversions']
+                answers['q15'] = top(untapped, 'missed_conversions',
+                                     cols=INSIGHTS_QUERY_COLS + ['potential_clicks', 'potential_conversions',
+                                                                 'missed_clicks', 'missed_conversions'])
+    
+    return {'queries': per_query, 'brands': brands, 'smoothed': smoothed, **answers}
+
+
+# ========================================
+# 🎯 COMPOSITE OPPORTUNITY SCORING
+# ========================================
+OPPORTUNITY_SIGNALS = {
+    'volume': 'Search volume',
+    'low_ctr': 'Low CTR',
+    'low_cr': 'Low CR',
+    'high_ctr': 'High CTR',
+    'high_classic_cvr': 'High click-to-conversion',
+    'missed_clicks': 'Missed clicks',
+    'missed_conversions': 'Missed conversions'
+}
+OPPORTUNITY_PRESETS = {
+    'High volume, low CR (Q5)': {'volume': 0.5, 'low_cr': 0.5},
+    'High CTR, low CR (Q6)': {'high_ctr': 0.4, 'low_cr': 0.4, 'volume': 0.2},
+    'Zero / low-click (Q10)': {'low_ctr': 0.6, 'volume': 0.4},
+    'Click-to-conversion efficiency (Q14)': {'high_classic_cvr': 0.7, 'volume': 0.3},
+    'Untapped potential (Q15)': {'missed_conversions': 0.5, 'missed_clicks': 0.3, 'volume': 0.2}
+}
+
+def _percentile_rank(values):
+    """0-1 percentile rank (ties averaged); constant columns map to 0.5."""
+    ranks = pd.Series(values).rank(pct=True, method='average').to_numpy()
+    return ranks if np.nanmax(ranks) > np.nanmin(ranks) else np.full(len(ranks), 0.5)
+
+def _log_min_max(values):
+    """log1p then min-max to 0-1 so a few head terms don't flatten everything else."""
+    logged = np.log1p(np.clip(values, 0, None))
+    span = logged.max() - logged.min() if len(logged) else 0
+    return (logged - logged.min()) / span if span > 0 else np.zeros(len(logged))
+
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=8)
+def build_opportunity_signals(_table, cache_key):
+    """Normalized (0-1, higher = bigger opportunity) signal matrix for every row of a totals table.
+
+    _table needs Counts / clicks / conversions (per query or per brand). Ratios are ratio-of-sums,
+    or the empirical-Bayes ctr_smoothed / cr_smoothed when present so low-volume rows don't top the
+    CTR / CR signals by noise; missed clicks / conversions are what each row would gain at the
+    population's median CTR / CR.
+    Returns a float32 DataFrame with one column per OPPORTUNITY_SIGNALS key, aligned to _table rows.
+    """
+    counts = _table['Counts'].to_numpy(np.float64)
+    clicks = _table['clicks'].to_numpy(np.float64)
+    conversions = _table['conversions'].to_numpy(np.float64)
+    ctr = np.divide(clicks * 100, counts, out=np.zeros(len(counts)), where=counts > 0)
+    cr = np.divide(conversions * 100, counts, out=np.zeros(len(counts)), where=counts > 0)
+    classic_cvr = np.divide(conversions * 100, clicks, out=np.zeros(len(counts)), where=clicks > 0)
+    if 'ctr_smoothed' in _table.columns and 'cr_smoothed' in _table.columns:
+        ctr = _table['ctr_smoothed'].to_numpy(np.float64)
+        cr = _table['cr_smoothed'].to_numpy(np.float64)
+    median_ctr = np.median(ctr) if len(ctr) else 0.0
+    median_cr = np.median(cr) if len(cr) else 0.0
+    
+    ctr_rank, cr_rank = _percentile_rank(ctr), _percentile_rank(cr)
+    signals = pd.DataFrame({
+        'volume': _log_min_max(counts),
+        'low_ctr': 1 - ctr_rank,
+        'low_cr': 1 - cr_rank,
+        'high_ctr': ctr_rank,
+        'high_classic_cvr': _percentile_rank(classic_cvr),
+        'missed_clicks': _log_min_max(counts * np.clip(median_ctr - ctr, 0, None) / 100),
+        'missed_conversions': _log_min_max(counts * np.clip(median_cr - cr, 0, None) / 100)
+    }, index=_table.index)
+    return signals[list(OPPORTUNITY_SIGNALS)].astype(np.float32)
+
+def top_k_opportunities(table, signals, weights, k=INSIGHTS_TOP_N):
+    """Weighted opportunity score for every row, returning only the top-k rows (partial selection).
+
+    weights maps signal -> weight (missing = 0); the score is the weighted mean of the signals on a
+    0-100 scale. The result is table's top-k rows plus 'opportunity_score' and 'main_driver' (the
+    signal contributing most to that row's score).
+    """
+    weight_vector = np.array([max(float(weights.get(sig, 0)), 0.0) for sig in OPPORTUNITY_SIGNALS], dtype=np.float32)
+    if table is None or table.empty or weight_vector.sum() <= 0:
+        return None
+    
+    matrix = signals.to_numpy(np.float32)
+    scores = matrix @ (weight_vector / weight_vector.sum()) * 100
+    k = min(int(k), len(scores))
+    # 🚀 argpartition picks the top-k in O(n); only those k are sorted
+    picked = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+    picked = picked[np.lexsort((picked, -scores[picked]))]
+    
+    out = table.iloc[picked].copy()
+    out['opportunity_score'] = scores[picked]
+    out['main_driver'] = np.array(list(OPPORTUNITY_SIGNALS.values()))[np.argmax(matrix[picked] * weight_vector, axis=1)]
+    return out.reset_index(drop=True)
+
+
 # ========================================
 # 🟢 GREEN THEME TABLE FUNCTION (BOLD & LARGE FONTS)
 # ========================================
@@ -908,6 +2741,85 @@ def display_styled_table(df, title=None, download_filename=None, max_rows=None,
         )
 
 
+# ========================================
+# 📄 SERVER-SIDE PAGED TABLE
+# ========================================
+PAGED_TABLE_THRESHOLD = 500          # tables longer than this are paged instead of rendered in full
+PAGED_TABLE_PAGE_SIZES = [25, 50, 100, 250]
+
+@st.cache_data(ttl=1800, show_spinner=False, max_entries=32)
+def _paged_table_order(_df, cache_key, n_rows, sort_col=None, ascending=False, search=''):
+    """Row positions of a cached table after the search filter and sort - the table itself stays put.
+
+    n_rows (= len(_df)) is part of the cache key so positions are never reused for a table of another size.
+    """
+    positions = np.arange(len(_df))
+    if search:
+        mask = np.zeros(len(_df), dtype=bool)
+        for col in _df.columns:
+            if not pd.api.types.is_numeric_dtype(_df[col]):
+                mask |= _df[col].astype(str).str.contains(search, case=False, regex=False, na=False).to_numpy()
+        positions = positions[mask]
+    if sort_col is not None and sort_col in _df.columns and len(positions):
+        values = _df[sort_col].iloc[positions].reset_index(drop=True)
+        order = values.sort_values(ascending=ascending, kind='stable', na_position='last').index.to_numpy()
+        positions = positions[order]
+    return positions
+
+def display_paged_table(df, key, cache_key, title=None, formatters=None, default_sort=None,
+                        default_ascending=False, page_size=50, align="center"):
+    """Page through a large table server-side: only the current page is formatted and sent.
+
+    Search (text columns) and sort run against the cached table and only produce a row order
+    (see _paged_table_order). formatters maps column -> callable applied to the page's cells.
+    cache_key must identify df's content; key namespaces the widgets.
+    """
+    if df is None or df.empty:
+        st.warning("⚠️ No data available to display")
+        return
+    if isinstance(df.columns, pd.MultiIndex):
+        df = df.set_axis([' | '.join(str(part) for part in col if str(part) != '') for col in df.columns], axis=1)
+    columns = [str(col) for col in df.columns]
+    df = df.set_axis(columns, axis=1)
+    
+    if title:
+        st.markdown(f"### {title}")
+    
+    col_search, col_sort, col_order, col_size = st.columns([3, 2, 1, 1])
+    with col_search:
+        search = st.text_input("🔎 Search", value="", key=f"{key}_search").strip()
+    with col_sort:
+        sort_options = ['(original order)'] + columns
+        default_index = sort_options.index(default_sort) if default_sort in sort_options else 0
+        sort_col = st.selectbox("Sort by", sort_options, index=default_index, key=f"{key}_sort")
+    with col_order:
+        ascending = st.radio("Order", ['↓', '↑'], index=1 if default_ascending else 0, horizontal=True, key=f"{key}_order") == '↑'
+    with col_size:
+        size = st.selectbox("Rows", PAGED_TABLE_PAGE_SIZES,
+                            index=PAGED_TABLE_PAGE_SIZES.index(page_size) if page_size in PAGED_TABLE_PAGE_SIZES else 1,
+                            key=f"{key}_size")
+    
+    positions = _paged_table_order(df, cache_key, len(df), None if sort_col == '(original order)' else sort_col, ascending, search)
+    n_pages = max(1, -(-len(positions) // size))
+    
+    # Reset to page 1 whenever the view (search / sort / page size) changes
+    view_state = (search, sort_col, ascending, size, cache_key)
+    if st.session_state.get(f"{key}_view") != view_state:
+        st.session_state[f"{key}_view"] = view_state
+        st.session_state[f"{key}_page"] = 1
+    page = st.number_input(f"Page (1-{n_pages:,})", min_value=1, max_value=n_pages, step=1, key=f"{key}_page")
+    
+    start = (int(page) - 1) * size
+    page_df = df.iloc[positions[start:start + size]].copy()
+    for col, formatter in (formatters or {}).items():
+        if col in page_df.columns:
+            page_df[col] = page_df[col].map(formatter)
+    
+    st.caption(f"Showing rows {start + 1:,}-{start + len(page_df):,} of {len(positions):,}"
+               + (f" (filtered from {len(df):,})" if search else ""))
+    display_styled_table(df=page_df, align=align, scrollable=True, max_height="600px")
+
+
 # ========================================
 # 🎨 OPTIONAL: PRE-DEFINED THEME PRESETS
 # ========================================
@@ -1241,12 +3153,16 @@ if not st.session_state.data_loaded:
             
             queries = prepare_queries_fast(raw_queries)
             
+            # 📏 Text features computed once over distinct queries (filtered frames inherit them)
+            queries = add_query_text_features(queries)
+            
             del raw_queries
             gc.collect()
             
             # ✅ FIX: Store both original and filtered versions
             st.session_state.queries = queries
             st.session_state.queries_original = queries.copy()
+            st.session_state.dataset_version = uuid4().hex  # keys per-entity deep-dive caches
             st.session_state.queries_filtered = queries.copy()
             st.session_state.sheets = essential_sheets
             st.session_state.data_loaded = True
@@ -1433,6 +3349,7 @@ if st.session_state.queries_original is None:
         
         # ✅ Initialize both original and filtered
         st.session_state.queries_original = queries_processed
+        st.session_state.dataset_version = uuid4().hex  # keys per-entity deep-dive caches
         st.session_state.queries_filtered = queries_processed.copy()
         
     except Exception as e:
@@ -1955,75 +3872,10 @@ with tab_overview:
 
             filter_cache_key = create_filter_cache_key()
 
-            # ✅ FIX 2: Updated cache function with filter awareness AND top_n parameter
-            @st.cache_data(ttl=300, show_spinner=False)
-            def compute_top50__queries_filter_aware(_df, month_names_dict, cache_key, top_n=50):
-                """🔄 FIXED: Filter-aware computation of top N queries"""
-                if _df.empty:
-                    return pd.DataFrame(), []
-                
-                grouped = _df.groupby('search').agg({
-                    'Counts': 'sum',
-                    'clicks': 'sum', 
-                    'conversions': 'sum'
-                }).reset_index()
-                
-                topN_queries = grouped.nlargest(top_n, 'Counts')['search'].tolist()
-                topN_data = _df[_df['search'].isin(topN_queries)].copy()
-                
-                if 'month' in topN_data.columns:
-                    unique_months = sorted(topN_data['month'].unique(), key=lambda x: pd.to_datetime(x))
-                else:
-                    unique_months = []
-                
-                result_data = []
-                
-                for query in topN_queries:
-                    query_data = topN_data[topN_data['search'] == query]
-                    
-                    total_counts = int(query_data['Counts'].sum())
-                    total_clicks = int(query_data['clicks'].sum())
-                    total_conversions = int(query_data['conversions'].sum())
-                    overall_ctr = (total_clicks / total_counts * 100) if total_counts > 0 else 0
-                    overall_cr = (total_conversions / total_counts * 100) if total_counts > 0 else 0
-                    
-                    row = {
-                        'Query': query,
-                        'Total Volume': total_counts,
-                        'Share %': (total_counts / _df['Counts'].sum()) * 100,
-                        'Overall CTR': overall_ctr,
-                        'Overall CR': overall_cr,
-                        'Total Clicks': total_clicks,
-                        'Total Conversions': total_conversions
-                    }
-                    
-                    for month in unique_months:
-                        month_data = query_data[query_data['month'] == month]
-                        month_display = month_names_dict.get(month, month)
-                        
-                        if not month_data.empty:
-                            month_counts = int(month_data['Counts'].sum())
-                            month_clicks = int(month_data['clicks'].sum())
-                            month_conversions = int(month_data['conversions'].sum())
-                            month_ctr = (month_clicks / month_counts * 100) if month_counts > 0 else 0
-                            month_cr = (month_conversions / month_counts * 100) if month_counts > 0 else 0
-                            
-                            row[f'{month_display} Vol'] = month_counts
-                            row[f'{month_display} CTR'] = month_ctr
-                            row[f'{month_display} CR'] = month_cr
-                        else:
-                            row[f'{month_display} Vol'] = 0
-                            row[f'{month_display} CTR'] = 0
-                            row[f'{month_display} CR'] = 0
-                    
-                    result_data.append(row)
-                
-                result_df = pd.DataFrame(result_data)
-                result_df = result_df.sort_values('Total Volume', ascending=False).reset_index(drop=True)
-                
-                return result_df, unique_months
-
-            topN, unique_months = compute_top50__queries_filter_aware(queries, month_names, filter_cache_key, top_n_queries)
+            # ✅ Shared entity × month builder: one grouped pass + unstack, filter-aware cache key
+            topN, unique_months = build_entity_month_table(
+                queries, 'search', month_names, top_n_queries, filter_cache_key, entity_label='Query'
+            )
 
             if topN.empty:
                 st.warning("No valid data after processing top queries.")
@@ -3730,6 +5582,9 @@ with tab_search:
         
         return list(set(keywords))  # Remove duplicates early
 
+    # Single alternation of the compiled patterns above, for vectorized str.findall
+    KEYWORD_GROUPING_PATTERN = re.compile(r'[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF]{2,}|[a-zA-Z]{3,}|\d{2,}')
+
     @st.cache_resource  # ✅ FIX #2: Use cache_resource for module imports
     def safe_import_fuzzywuzzy():
         """Safely import fuzzywuzzy with fallback - CACHED AS RESOURCE"""
@@ -3763,12 +5618,15 @@ with tab_search:
     fuzz, has_fuzzywuzzy = safe_import_fuzzywuzzy()
 
     def fuzzy_match_keywords(keyword_data, master_dict, min_score=70):
-        """Optimized fuzzy matching with early termination and error handling"""
+        """Optimized fuzzy matching with early termination and error handling.
+        
+        Groups collect the keywords' query-id arrays (integer postings), not query strings.
+        """
         grouped_keywords = defaultdict(lambda: {
             'total_counts': 0, 
             'total_clicks': 0, 
             'total_conversions': 0, 
-            'queries': [],
+            'query_ids': [],
             'variations': []
         })
         
@@ -3851,59 +5709,67 @@ with tab_search:
             grouped_keywords[group_key]['total_counts'] += data['total_counts']
             grouped_keywords[group_key]['total_clicks'] += data['total_clicks']
             grouped_keywords[group_key]['total_conversions'] += data['total_conversions']
-            grouped_keywords[group_key]['queries'].extend(data['queries'])
+            grouped_keywords[group_key]['query_ids'].append(data['query_ids'])
             
             processed_keywords.add(keyword)
         
         return dict(grouped_keywords)
 
     @st.cache_data(ttl=1800, max_entries=3, show_spinner=False)  # ✅ FIX #1: Added max_entries
-    def calculate_enhanced_keyword_performance(_df):
-        """Enhanced keyword performance calculation with optimizations"""
+    def calculate_enhanced_keyword_performance(_df, cache_key=None):
+        """Enhanced keyword performance calculation on integer query postings.
+        
+        Keywords hold arrays of query codes into the distinct-query table of
+        build_query_token_index; query strings are only materialized for display.
+        """
         if _df.empty:
             return pd.DataFrame()
         
         try:
-            keyword_data = defaultdict(lambda: {
-                'total_counts': 0, 
-                'total_clicks': 0, 
-                'total_conversions': 0, 
-                'queries': []
-            })
+            index = build_query_token_index(_df, cache_key or get_filter_fingerprint(_df))
+            if index is None:
+                return pd.DataFrame()
             
-            # Process data in chunks for better memory management
-            chunk_size = 1000
-            total_rows = len(_df)
+            query_table = index['queries']
+            active = query_table[query_table['Counts'] > 0]
             
-            for i in range(0, total_rows, chunk_size):
-                chunk = _df.iloc[i:i+chunk_size]
-                
-                for _, row in chunk.iterrows():
-                    try:
-                        query = str(row.get('normalized_query', ''))
-                        counts = row.get('Counts', 0)
-                        clicks = row.get('clicks', 0)
-                        conversions = row.get('conversions', 0)
-                        
-                        if not query or counts == 0:
-                            continue
-                        
-                        keywords = extract_keywords_with_fuzzy_grouping(query, min_length=2)
-                        
-                        for keyword in keywords:
-                            if len(keyword.strip()) >= 2:
-                                keyword_data[keyword]['total_counts'] += counts
-                                keyword_data[keyword]['total_clicks'] += clicks
-                                keyword_data[keyword]['total_conversions'] += conversions
-                                keyword_data[keyword]['queries'].append(query)
-                    except Exception:
-                        continue
+            # 🚀 Tokenize each distinct query once (same patterns as extract_keywords_with_fuzzy_grouping)
+            tokens = active['query'].str.strip().str.lower().str.findall(KEYWORD_GROUPING_PATTERN)
+            exploded = tokens.explode().dropna()
+            exploded = exploded[exploded.str.len() >= 2]
+            if exploded.empty:
+                return pd.DataFrame()
+            
+            # 🔤 Collapse tokens that only differ by script (ک/ك, ی/ي, hamza) into one key,
+            # then keep one (query, keyword) posting per pair
+            norm_keys, norm_codes = normalize_token_vocabulary(exploded.to_numpy())
+            postings = pd.DataFrame({
+                'query_code': exploded.index.to_numpy(),
+                'kw_code': norm_codes
+            }).drop_duplicates()
+            postings = postings.join(active[METRIC_COLS], on='query_code')
+            
+            totals = postings.groupby('kw_code')[METRIC_COLS].sum()
+            postings = postings.sort_values('kw_code', kind='stable')
+            split_points = np.searchsorted(postings['kw_code'].to_numpy(), totals.index.to_numpy()[1:])
+            query_id_lists = np.split(postings['query_code'].to_numpy(), split_points)
+            
+            keyword_data = {
+                norm_keys[code]: {
+                    'total_counts': row.Counts,
+                    'total_clicks': row.clicks,
+                    'total_conversions': row.conversions,
+                    'query_ids': query_ids
+                }
+                for code, row, query_ids in zip(totals.index, totals.itertuples(index=False), query_id_lists)
+            }
             
-            # Apply fuzzy matching grouping
-            master_dict = create_master_keyword_dictionary()
+            # Apply fuzzy matching grouping (master variations normalized the same way)
+            master_dict = normalize_master_dictionary(create_master_keyword_dictionary())
             grouped_data = fuzzy_match_keywords(keyword_data, master_dict, min_score=65)
             
             # Convert to DataFrame with optimized calculations
+            query_volumes = query_table['Counts'].to_numpy()
             kw_list = []
             for keyword, data in grouped_data.items():
                 try:
@@ -3916,8 +5782,9 @@ with tab_search:
                         classic_cr = (total_conversions / total_clicks * 100) if total_clicks > 0 else 0
                         _cr = (total_conversions / total_counts * 100) if total_counts > 0 else 0
                         
-                        # Limit data to reduce memory usage
-                        unique_queries = list(set(data['queries']))
+                        # 🚀 Integer postings: unique query ids + top-5 examples by volume
+                        unique_ids = np.unique(np.concatenate(data['query_ids']))
+                        top_ids = unique_ids[np.argsort(-query_volumes[unique_ids], kind='stable')[:5]]
                         unique_variations = list(set(data['variations']))
                         
                         kw_list.append({
@@ -3928,9 +5795,9 @@ with tab_search:
                             'avg_ctr': round(avg_ctr, 2),
                             'classic_cr': round(classic_cr, 2),
                             '_cr': round(_cr, 2),
-                            'unique_queries': len(unique_queries),
+                            'unique_queries': len(unique_ids),
                             'variations_count': len(unique_variations),
-                            'example_queries': unique_queries[:5],
+                            'example_query_ids': top_ids.tolist(),
                             'variations': unique_variations
                         })
                 except Exception:
@@ -3952,14 +5819,22 @@ with tab_search:
         if _df.empty:
             return None
         
-        fig_length = px.histogram(
-            _df, 
-            x='query_length', 
-            nbins=30,
+        # 📏 Bin the precomputed uint16 length column server-side into the same 30 bins (only 30 bars go to the browser)
+        length_counts = ensure_query_text_features(_df)['query_length'].value_counts().sort_index()
+        bin_counts, bin_edges = np.histogram(length_counts.index.to_numpy(), bins=30, weights=length_counts.to_numpy())
+        
+        fig_length = px.bar(
+            x=(bin_edges[:-1] + bin_edges[1:]) / 2, 
+            y=bin_counts,
             title='<b style="color:#2E7D32;">Query Length Distribution</b>',
-            labels={'query_length': 'Character Length', 'count': 'Number of Queries'},
+            labels={'x': 'Character Length', 'y': 'Number of Queries'},
             color_discrete_sequence=['#66BB6A']
         )
+        fig_length.update_traces(
+            width=np.diff(bin_edges) * 0.9,  # same 0.1 gap as the histogram layout
+            customdata=np.column_stack([bin_edges[:-1], bin_edges[1:]]),
+            hovertemplate='Character Length: %{customdata[0]:.0f}-%{customdata[1]:.0f}<br>Number of Queries: %{y:,}<extra></extra>'
+        )
         
         fig_length.update_layout(
             plot_bgcolor='rgba(248,253,248,0.95)',
@@ -4149,6 +6024,9 @@ with tab_search:
         </div>
         """, unsafe_allow_html=True)
         
+        # 📏 Read precomputed text features instead of re-deriving them per section
+        queries = ensure_query_text_features(queries)
+        
         adv_col1, adv_col2, adv_col3 = st.columns(3)
         
         with adv_col1:
@@ -4207,11 +6085,8 @@ with tab_search:
         with adv_col2:
             st.markdown("**📊 Long-tail vs Short-tail Performance**")
             
-            # Create a copy to avoid SettingWithCopyWarning
-            queries_copy = queries.copy()
-            queries_copy['is_long_tail'] = queries_copy['query_length'] >= 20
-            
-            lt_analysis = queries_copy.groupby('is_long_tail').agg({
+            # ✅ Precomputed is_long_tail flag - no frame copy needed
+            lt_analysis = queries.groupby('is_long_tail').agg({
                 'Counts': 'sum', 
                 'clicks': 'sum',
                 'conversions': 'sum'
@@ -4272,15 +6147,15 @@ with tab_search:
         with adv_col3:
             st.markdown("**🔍 Keyword Density Analysis**")
             
-            density_bins = pd.cut(queries['query_length'], 
-                                bins=[0, 10, 20, 30, 50, 100], 
-                                labels=['0-10', '11-20', '21-30', '31-50', '51-100'])
-            
-            density_analysis = queries.groupby(density_bins, observed=True).agg({
+            # ✅ Precomputed int8 length band (-1 = out of range)
+            density_analysis = queries[queries['query_length_band'] >= 0].groupby('query_length_band').agg({
                 'Counts': 'sum',
                 'clicks': 'sum',
                 'conversions': 'sum'
             }).reset_index()
+            density_analysis['query_length'] = density_analysis['query_length_band'].map(
+                dict(enumerate(QUERY_LENGTH_BAND_LABELS))
+            )
             
             # ✅ VECTORIZED CALCULATION
             density_analysis['ctr'] = np.where(
@@ -4423,6 +6298,55 @@ with tab_search:
         </div>
         """, unsafe_allow_html=True)
 
+        # ⚡ INSTANT KEYWORD / QUERY LOOKUP (prefix index, built once per filter state)
+        lookup_col1, lookup_col2 = st.columns([3, 1])
+        with lookup_col1:
+            lookup_text = st.text_input(
+                "⚡ Instant lookup - type an ingredient or query prefix (e.g. melatonin, omega 3, collagen):",
+                key="kw_prefix_lookup",
+                help="Matches keywords and any word inside a query, ranked by search volume"
+            )
+        with lookup_col2:
+            lookup_top_k = st.selectbox("Top matches:", [10, 25, 50], index=0, key="kw_prefix_top_k")
+        
+        if lookup_text.strip():
+            lookup_cache_key = get_filter_fingerprint(queries)
+            prefix_index = build_prefix_index(queries, lookup_cache_key)
+            
+            if prefix_index is not None:
+                lookup_start = datetime.now()
+                kw_ids, _ = prefix_lookup(prefix_index['keywords'], lookup_text, top_k=lookup_top_k)
+                q_ids, _ = prefix_lookup(prefix_index['queries'], lookup_text, top_k=lookup_top_k)
+                lookup_ms = (datetime.now() - lookup_start).total_seconds() * 1000
+                
+                def _lookup_display(table, label_col, label):
+                    out = table[[label_col] + METRIC_COLS].copy()
+                    out['CTR'] = np.where(out['Counts'] > 0, out['clicks'] / out['Counts'] * 100, 0)
+                    out['CR'] = np.where(out['Counts'] > 0, out['conversions'] / out['Counts'] * 100, 0)
+                    out = out.rename(columns={label_col: label, 'Counts': 'Search Volume', 'clicks': 'Clicks', 'conversions': 'Conversions'})
+                    for col in ['Search Volume', 'Clicks', 'Conversions']:
+                        out[col] = out[col].apply(format_number)
+                    out['CTR'] = out['CTR'].apply(lambda x: f"{x:.1f}%")
+                    out['CR'] = out['CR'].apply(lambda x: f"{x:.1f}%")
+                    return out.reset_index(drop=True)
+                
+                res_col1, res_col2 = st.columns(2)
+                with res_col1:
+                    if len(kw_ids):
+                        token_table = compute_token_metrics(queries, lookup_cache_key)
+                        display_styled_table(_lookup_display(token_table.loc[kw_ids], 'keyword', 'Keyword'),
+                                             title="🔑 Matching Keywords", align="center")
+                    else:
+                        st.info("No matching keywords")
+                with res_col2:
+                    if len(q_ids):
+                        query_table = build_query_token_index(queries, lookup_cache_key)['queries']
+                        display_styled_table(_lookup_display(query_table.loc[q_ids], 'query', 'Search Query'),
+                                             title="🔍 Matching Queries", align="center")
+                    else:
+                        st.info("No matching queries")
+                st.caption(f"⚡ Lookup served in {lookup_ms:.1f} ms from the prefix index")
+
         
         # Performance monitoring
         start_time = datetime.now()
@@ -4457,7 +6381,7 @@ with tab_search:
                         time.sleep(0.3)
                 
                 # Calculate keyword performance ONCE
-                kw_perf_df = calculate_enhanced_keyword_performance(queries)
+                kw_perf_df = calculate_enhanced_keyword_performance(queries, get_filter_fingerprint(queries))
                 
                 # Clean up loading UI
                 time.sleep(0.3)
@@ -4886,7 +6810,7 @@ with tab_search:
 
         # Calculate enhanced keyword performance with progress tracking
         with st.spinner("🧠 Processing advanced fuzzy matching..."):
-            kw_perf_df = calculate_enhanced_keyword_performance(queries)
+            kw_perf_df = calculate_enhanced_keyword_performance(queries, get_filter_fingerprint(queries))
 
             # ✅ GENERIC: Get top 4 grouped keywords by total volume
             top_4_keywords = kw_perf_df.nlargest(4, 'total_counts')
@@ -5540,6 +7464,85 @@ with tab_search:
     
 
                 
+                # ================================================================================================
+                # 🔗 KEYWORD CO-OCCURRENCE & BIGRAMS
+                # ================================================================================================
+                
+                st.markdown("""
+                <div style="background: linear-gradient(135deg, #2E7D32 0%, #388E3C 100%); color: white; padding: 1.5rem; border-radius: 12px; margin: 2rem 0;">
+                    <h3 style="margin: 0;">🔗 Keyword Pairs & Bigrams</h3>
+                    <p style="margin: 0.5rem 0 0 0; opacity: 0.9;">Which keywords are searched together - combined volume, CTR and CR</p>
+                </div>
+                """, unsafe_allow_html=True)
+                
+                pair_col1, pair_col2, pair_col3 = st.columns([2, 1, 1])
+                with pair_col1:
+                    pair_mode = st.radio(
+                        "🔗 Pair type:",
+                        ["Co-occurring in same query", "Adjacent bigrams"],
+                        horizontal=True,
+                        key="kw_pair_mode",
+                        help="Co-occurring pairs ignore word order; bigrams are consecutive words"
+                    )
+                with pair_col2:
+                    pair_top_n = st.selectbox("📊 Top pairs:", [25, 50, 100, 250], index=1, key="kw_pair_top_n")
+                with pair_col3:
+                    pair_min_queries = st.number_input("🔍 Min shared queries:", min_value=1, max_value=100, value=2, key="kw_pair_min_q")
+                
+                pair_cache_key = get_filter_fingerprint(queries)
+                if pair_mode == "Adjacent bigrams":
+                    pairs_df = compute_keyword_bigrams(queries, pair_cache_key, top_n=pair_top_n, min_queries=int(pair_min_queries))
+                else:
+                    pairs_df = compute_keyword_cooccurrence(queries, pair_cache_key, top_n=pair_top_n, min_queries=int(pair_min_queries))
+                
+                if not pairs_df.empty:
+                    fig_pairs = px.bar(
+                        pairs_df.head(20).assign(pair=lambda d: d['keyword_a'] + ' + ' + d['keyword_b']),
+                        x='total_counts',
+                        y='pair',
+                        orientation='h',
+                        color='cr',
+                        title='<b style="color:#2E7D32;">Top Keyword Pairs by Combined Volume</b>',
+                        labels={'total_counts': 'Combined Search Volume', 'pair': 'Keyword Pair', 'cr': 'CR (%)'},
+                        color_continuous_scale=['#E8F5E8', '#66BB6A', '#2E7D32'],
+                        template='plotly_white'
+                    )
+                    fig_pairs.update_layout(
+                        plot_bgcolor='rgba(248,253,248,0.95)',
+                        paper_bgcolor='rgba(232,245,232,0.8)',
+                        font=dict(color='#1B5E20', family='Segoe UI'),
+                        height=550,
+                        yaxis=dict(autorange='reversed')
+                    )
+                    st.plotly_chart(fig_pairs, use_container_width=True)
+                    
+                    pairs_display = pairs_df.rename(columns={
+                        'keyword_a': 'Keyword A',
+                        'keyword_b': 'Keyword B',
+                        'co_queries': 'Shared Queries',
+                        'total_counts': 'Combined Volume',
+                        'total_clicks': 'Clicks',
+                        'total_conversions': 'Conversions',
+                        'ctr': 'CTR',
+                        'cr': 'CR'
+                    })
+                    pairs_display['Combined Volume'] = pairs_display['Combined Volume'].apply(format_number)
+                    pairs_display['Clicks'] = pairs_display['Clicks'].apply(format_number)
+                    pairs_display['Conversions'] = pairs_display['Conversions'].apply(format_number)
+                    pairs_display['CTR'] = pairs_display['CTR'].apply(lambda x: f"{x:.1f}%")
+                    pairs_display['CR'] = pairs_display['CR'].apply(lambda x: f"{x:.1f}%")
+                    
+                    display_styled_table(
+                        df=pairs_display,
+                        title=f"🔗 Top {len(pairs_display)} {'Bigrams' if pair_mode == 'Adjacent bigrams' else 'Co-occurring Keyword Pairs'}",
+                        download_filename=f"keyword_pairs_{datetime.now().strftime('%Y%m%d_%H%M')}.csv",
+                        align="center",
+                        scrollable=True,
+                        max_height="500px"
+                    )
+                else:
+                    st.info("ℹ️ No keyword pairs meet the minimum shared-queries threshold.")
+                
                 # ================================================================================================
                 # 🔍 ENHANCED EXAMPLE QUERIES & VARIATIONS SECTION
                 # ================================================================================================
@@ -5559,9 +7562,13 @@ with tab_search:
                     </div>
                     """, unsafe_allow_html=True)
                     
+                    example_query_text = build_query_token_index(
+                        queries, get_filter_fingerprint(queries)
+                    )['queries']['query'].to_numpy()
+                    
                     for idx, row in top_keywords.head(5).iterrows():
                         keyword = row['keyword']
-                        examples = row['example_queries'][:3]
+                        examples = example_query_text[row['example_query_ids'][:3]]  # materialize strings for display only
                         variations = row['variations'][:15]  # Show more variations
                         emoji = emoji_map.get(keyword, '💊')
                         
@@ -6099,7 +8106,8 @@ with tab_brand:
             key="scatter_brand_count"
         )
 
-        bs_for_scatter = bs_summary.sort_values('Counts', ascending=False).head(num_scatter_brands)
+        bs_summary_rank = build_sort_permutations(bs_summary, get_filter_fingerprint(bs_summary))
+        bs_for_scatter = ranked_view(bs_summary, bs_summary_rank, 'Counts', top_n=num_scatter_brands)
 
         fig_brand_perf = px.scatter(
             bs_for_scatter,
@@ -6297,101 +8305,27 @@ with tab_brand:
             if _queries_df.empty:
                 return pd.DataFrame(), []
             
-            brand_totals = _queries_df.groupby(brand_col)['Counts'].sum().reset_index()
-            top_brands_list = brand_totals.nlargest(num_brands, 'Counts')[brand_col].tolist()
-            top_brands_queries = _queries_df[_queries_df[brand_col].isin(top_brands_list)].copy()
-            
-            if 'month' in top_brands_queries.columns:
-                unique_months = sorted(top_brands_queries['month'].unique(), key=lambda x: pd.to_datetime(x))
-            else:
-                unique_months = []
-            
-            result_data = []
+            # ✅ Totals, share, CTR/CR and monthly columns from the shared entity × month builder
+            result_df, unique_months = build_entity_month_table(
+                _queries_df, brand_col, month_names_dict, num_brands, cache_key,
+                entity_label='Brand', share_label='Market Share %', include_classic_cr=True
+            )
+            if result_df.empty:
+                return result_df, unique_months
             
-            for brand in top_brands_list:
-                brand_data = top_brands_queries[top_brands_queries[brand_col] == brand]
-                
-                total_counts = int(brand_data['Counts'].sum())
-                total_clicks = int(brand_data['clicks'].sum())
-                total_conversions = int(brand_data['conversions'].sum())
-                
-                dataset_total_counts = _queries_df['Counts'].sum()
-                share_pct = (total_counts / dataset_total_counts * 100) if dataset_total_counts > 0 else 0
-                
-                overall_ctr = (total_clicks / total_counts * 100) if total_counts > 0 else 0
-                overall_cr = (total_conversions / total_counts * 100) if total_counts > 0 else 0
-                classic_cr = (total_conversions / total_clicks * 100) if total_clicks > 0 else 0
-                
-                unique_keywords_set = set()
-                keyword_counts = {}
-                
-                for idx, row_data in brand_data.iterrows():
-                    keywords_list = row_data.get('keywords', [])
-                    query_count = row_data.get('Counts', 0)
-                    
-                    if isinstance(keywords_list, list) and len(keywords_list) > 0:
-                        unique_keywords_set.update(keywords_list)
-                        for keyword in keywords_list:
-                            if keyword in keyword_counts:
-                                keyword_counts[keyword] += query_count
-                            else:
-                                keyword_counts[keyword] = query_count
-                    elif pd.notna(keywords_list):
-                        search_term = row_data.get('normalized_query', '')
-                        if pd.notna(search_term) and str(search_term).strip():
-                            keywords = str(search_term).lower().split()
-                            unique_keywords_set.update(keywords)
-                            for keyword in keywords:
-                                if keyword in keyword_counts:
-                                    keyword_counts[keyword] += query_count
-                                else:
-                                    keyword_counts[keyword] = query_count
-                
-                unique_keywords_count = len(unique_keywords_set)
-                
-                if keyword_counts:
-                    top_keywords = sorted(keyword_counts.items(), key=lambda x: x[1], reverse=True)[:5]
-                    top_keywords_str = ', '.join([f"{kw}({format_number(v)})" for kw, v in top_keywords])
-                else:
-                    top_keywords_str = "No keywords"
-                
-                row = {
-                    'Brand': brand,
-                    'Total Volume': total_counts,
-                    'Market Share %': share_pct,
-                    'Overall CTR': overall_ctr,
-                    'Overall CR': overall_cr,
-                    'Classic CR': classic_cr,
-                    'Total Clicks': total_clicks,
-                    'Total Conversions': total_conversions,
-                    'Unique Keywords': unique_keywords_count,
-                    'Top Keywords': top_keywords_str
-                }
-                
-                for month in unique_months:
-                    month_display = month_names_dict.get(month, month)
-                    month_data = brand_data[brand_data['month'] == month]
-                    
-                    if not month_data.empty:
-                        month_counts = int(month_data['Counts'].sum())
-                        month_clicks = int(month_data['clicks'].sum())
-                        month_conversions = int(month_data['conversions'].sum())
-                        
-                        month_ctr = (month_clicks / month_counts * 100) if month_counts > 0 else 0
-                        month_cr = (month_conversions / month_counts * 100) if month_counts > 0 else 0
-                        
-                        row[f'{month_display} Vol'] = month_counts
-                        row[f'{month_display} CTR'] = month_ctr
-                        row[f'{month_display} CR'] = month_cr
-                    else:
-                        row[f'{month_display} Vol'] = 0
-                        row[f'{month_display} CTR'] = 0
-                        row[f'{month_display} CR'] = 0
-                
-                result_data.append(row)
+            # ✅ Keyword stats for all brands in one pass over the shared token index
+            # (top 5 keywords + unique keyword count per brand, independent of num_brands)
+            brand_keywords = compute_top_keywords_per_group(
+                _queries_df, brand_col, 5, get_filter_fingerprint(_queries_df)
+            )
+            brand_keywords = brand_keywords[brand_keywords['group'].isin(result_df['Brand'])]
+            keyword_labels = brand_keywords['keyword'] + '(' + brand_keywords['count'].map(format_number) + ')'
+            top_keywords_strs = keyword_labels.groupby(brand_keywords['group'], sort=False).agg(', '.join)
+            unique_keywords_counts = brand_keywords.groupby('group', sort=False)['group_keywords'].first()
             
-            result_df = pd.DataFrame(result_data)
-            result_df = result_df.sort_values('Total Volume', ascending=False).reset_index(drop=True)
+            insert_at = result_df.columns.get_loc('Total Conversions') + 1
+            result_df.insert(insert_at, 'Unique Keywords', result_df['Brand'].map(unique_keywords_counts).fillna(0).astype(int))
+            result_df.insert(insert_at + 1, 'Top Keywords', result_df['Brand'].map(top_keywords_strs).fillna("No keywords"))
             
             return result_df, unique_months
         
@@ -6762,32 +8696,8 @@ with tab_brand:
     # ENHANCED Brand-Keyword Intelligence Matrix with Interactive CTR/CR Display
     st.subheader("🔥 Brand-Keyword Intelligence Matrix")
 
-    # ✅ FIX: Aggregate queries data across ALL months for matrix analysis
-    @st.cache_data(ttl=300, show_spinner=False)
-    def aggregate_matrix_data(_queries_df, brand_col):
-        """Aggregate queries across all months for brand-keyword matrix"""
-        if _queries_df.empty:
-            return pd.DataFrame()
-        
-        # Group by brand and search, summing across all months
-        aggregated = _queries_df.groupby([brand_col, 'search']).agg({
-            'Counts': 'sum',
-            'clicks': 'sum',
-            'conversions': 'sum'
-        }).reset_index()
-        
-        # Rename brand column to 'brand' for consistency
-        aggregated = aggregated.rename(columns={brand_col: 'brand'})
-        
-        # Calculate metrics
-        aggregated['ctr'] = ((aggregated['clicks'] / aggregated['Counts']) * 100).fillna(0).round(2)
-        aggregated['cr'] = ((aggregated['conversions'] / aggregated['Counts']) * 100).fillna(0).round(2)
-        aggregated['classic_cr'] = ((aggregated['conversions'] / aggregated['clicks']) * 100).fillna(0).round(2)
-        
-        return aggregated
-
-    # ✅ CREATE: Aggregated dataset for matrix
-    queries_matrix = aggregate_matrix_data(brand_queries, brand_column)
+    # ✅ Sparse brand × search matrix aggregated across ALL months (built once per filter state)
+    brand_matrix = build_dimension_query_matrix(brand_queries, brand_column, get_filter_fingerprint(brand_queries))
 
     # ✅ SHOW: Date range info
     if 'start_date' in brand_queries.columns and 'end_date' in brand_queries.columns:
@@ -6796,15 +8706,10 @@ with tab_brand:
         st.info(f"📅 Analyzing aggregated data from **{date_range_start}** to **{date_range_end}**")
 
     # Create brand filter dropdown with enhanced UI
-    if not queries_matrix.empty and 'brand' in queries_matrix.columns and 'search' in queries_matrix.columns:
-        # ✅ CHANGED: Use queries_matrix instead of queries
-        available_brands = queries_matrix[
-            (queries_matrix['brand'].notna()) & 
-            (queries_matrix['brand'].str.lower() != 'other') &
-            (queries_matrix['brand'].str.lower() != 'others')
-        ]['brand'].unique()
-        
-        available_brands = sorted(available_brands)
+    if brand_matrix is not None:
+        # ✅ Matrix row totals already exclude null / 'other' brands
+        brand_totals = brand_matrix['row_totals']
+        available_brands = sorted(brand_totals.index)
         brand_options = ['All Brands'] + list(available_brands)
         
         # ENHANCED UI for brand selection with metrics
@@ -6835,8 +8740,8 @@ with tab_brand:
         
         with col_metrics:
             if selected_brand != 'All Brands':
-                # ✅ CHANGED: Show metrics from aggregated data (already filtered)
-                brand_metrics = queries_matrix[queries_matrix['brand'] == selected_brand]
+                # ✅ CHANGED: Show metrics from the matrix row totals (already filtered)
+                brand_metrics = brand_totals[brand_totals.index == selected_brand]
                 
                 if not brand_metrics.empty:
                     # Aggregate metrics for the selected brand
@@ -6896,14 +8801,10 @@ with tab_brand:
                         """, unsafe_allow_html=True)
 
             else:
-                # ✅ FIX: Explicitly filter out "Others" from queries_matrix for "All Brands" metrics
-                queries_matrix_filtered = queries_matrix[
-                    (~queries_matrix['brand'].str.lower().isin(['other', 'others']))
-                ]
-                
-                total_searches = queries_matrix_filtered['Counts'].sum()
-                total_clicks = queries_matrix_filtered['clicks'].sum()
-                total_conversions = queries_matrix_filtered['conversions'].sum()
+                # ✅ "Others" is already excluded from the matrix row totals
+                total_searches = brand_totals['Counts'].sum()
+                total_clicks = brand_totals['clicks'].sum()
+                total_conversions = brand_totals['conversions'].sum()
                 
                 avg_ctr = (total_clicks / total_searches * 100) if total_searches > 0 else 0
                 avg_cr = (total_conversions / total_searches * 100) if total_searches > 0 else 0
@@ -6945,62 +8846,27 @@ with tab_brand:
                     """, unsafe_allow_html=True)
 
         
-        # ✅ CHANGED: Filter from queries_matrix instead of queries
+        # ✅ Top-k slices of the shared sparse matrix (no per-view groupby)
         if selected_brand == 'All Brands':
-            # Get top 8 brands by total counts from aggregated data
-            top_brands = queries_matrix.groupby('brand')['Counts'].sum().nlargest(8).index.tolist()
-            
-            filtered_data = queries_matrix[queries_matrix['brand'].isin(top_brands)]
+            size_col1, size_col2 = st.columns(2)
+            with size_col1:
+                matrix_top_rows = st.slider("Brands in matrix:", 5, 30, 8, key="brand_matrix_rows")
+            with size_col2:
+                matrix_top_cols = st.slider("Search terms in matrix:", 5, 40, 12, key="brand_matrix_cols")
+            matrix_slice = slice_dimension_query_matrix(brand_matrix, matrix_top_rows, matrix_top_cols)
             matrix_title = "Top Brands vs Search Terms"
         else:
-            filtered_data = queries_matrix[queries_matrix['brand'] == selected_brand]
+            matrix_slice = slice_dimension_query_matrix(brand_matrix, rows=[selected_brand], top_cols=15)
             matrix_title = f"{selected_brand} - Search Terms Analysis"
         
-        # Remove null values and 'other' categories
-        matrix_data = filtered_data[
-            (filtered_data['brand'].notna()) & 
-            (filtered_data['search'].notna()) &
-            (filtered_data['brand'].str.lower() != 'other') &
-            (filtered_data['brand'].str.lower() != 'others') &
-            (filtered_data['search'].str.lower() != 'other') &
-            (filtered_data['search'].str.lower() != 'others')
-        ].copy()
+        matrix_data = matrix_slice['cells'].rename(columns={'dimension': 'brand'})
         
         if not matrix_data.empty:
             if selected_brand == 'All Brands':
-                # ✅ CHANGED: Data is already aggregated, no need to groupby again
-                brand_search_matrix = matrix_data.copy()
-                
-                # Get top 12 search terms by total counts
-                top_searches = brand_search_matrix.groupby('search')['Counts'].sum().nlargest(12).index.tolist()
-                
-                brand_search_matrix = brand_search_matrix[brand_search_matrix['search'].isin(top_searches)]
-                
-                # Create pivot table for counts
-                heatmap_data = brand_search_matrix.pivot(
-                    index='brand', 
-                    columns='search', 
-                    values='Counts'
-                ).fillna(0)
-                
-                # Create pivot tables for CTR, CR, and Classic CR
-                ctr_data = brand_search_matrix.pivot(
-                    index='brand', 
-                    columns='search', 
-                    values='ctr'
-                ).fillna(0)
-                
-                cr_data = brand_search_matrix.pivot(
-                    index='brand', 
-                    columns='search', 
-                    values='cr'
-                ).fillna(0)
-                
-                classic_cr_data = brand_search_matrix.pivot(
-                    index='brand', 
-                    columns='search', 
-                    values='classic_cr'
-                ).fillna(0)
+                heatmap_data = matrix_slice['Counts']
+                ctr_data = matrix_slice['ctr']
+                cr_data = matrix_slice['cr']
+                classic_cr_data = matrix_slice['classic_cr']
                 
                 # Enhanced heatmap with custom hover template
                 fig_matrix = px.imshow(
@@ -7049,9 +8915,8 @@ with tab_brand:
                 st.plotly_chart(fig_matrix, use_container_width=True)
                 
             else:
-                # ✅ CHANGED: Data is already aggregated
-                brand_search_data = matrix_data.copy()
-                brand_search_data = brand_search_data.sort_values('Counts', ascending=False).head(15)
+                # ✅ Top 15 search terms of the selected brand, already sorted by volume
+                brand_search_data = matrix_data
                 
                 # Add CR selection for chart coloring
                 st.markdown("#### 📊 Chart Display Options")
@@ -7231,6 +9096,7 @@ with tab_brand:
     # Calculate metrics once
     if not bs.empty and len(bs) > 0:
         bs_with_metrics = calculate_brand_metrics(bs)
+        bs_metrics_rank = build_sort_permutations(bs_with_metrics, get_filter_fingerprint(bs_with_metrics))
         has_data = True
     else:
         bs_with_metrics = bs
@@ -7252,7 +9118,7 @@ with tab_brand:
                 median_efficiency = bs_with_metrics['efficiency_score'].median()
                 
                 # Quadrant scatter plot
-                top_brands = bs_with_metrics.nlargest(30, 'Counts')
+                top_brands = ranked_view(bs_with_metrics, bs_metrics_rank, 'Counts', top_n=30)
                 
                 fig_quadrant = px.scatter(
                     top_brands,
@@ -7422,7 +9288,11 @@ with tab_brand:
                 efficiency_leader = bs_with_metrics.loc[bs_with_metrics['classic_cr'].idxmax()] if bs_with_metrics['classic_cr'].max() > 0 else None
                 ctr_leader = bs_with_metrics.loc[bs_with_metrics['ctr'].idxmax()]
                 
-                top_5_share = bs_with_metrics.nlargest(5, 'Counts')['share_pct'].sum()
+                brand_concentration = concentration_metrics(
+                    compute_concentration_table(brand_queries, get_filter_fingerprint(brand_queries), dimensions={brand_column: 'Brand'}),
+                    brand_column
+                )
+                top_5_share = float(brand_concentration.get('top_5_share', 0.0))
                 market_concentration = "High" if top_5_share > 70 else "Medium" if top_5_share > 50 else "Low"
                 competitive_intensity = "High" if len(bs_with_metrics) > 50 else "Medium" if len(bs_with_metrics) > 20 else "Low"
                 
@@ -7682,8 +9552,9 @@ with tab_department:
         
         return ds
     
-    # Calculate once, reuse everywhere
+    # Calculate once, reuse everywhere (sort permutations cached with it: top-N views are index slices)
     ds = calculate_department_stats(department_queries, department_column)
+    ds_rank = build_sort_permutations(ds, get_filter_fingerprint(department_queries))
     
     # Main Department Analysis Layout
     col_left, col_right = st.columns([3, 2])
@@ -7692,7 +9563,7 @@ with tab_department:
         st.subheader("📈 Department Performance Matrix")
         
         # ✅ MEMORY FIX: Use top 30 only for visualization
-        top_30_ds = ds.nlargest(30, 'Counts')
+        top_30_ds = ranked_view(ds, ds_rank, 'Counts', top_n=30)
         
         # Create customdata efficiently
         customdata = np.column_stack([
@@ -7732,7 +9603,7 @@ with tab_department:
         # 🚀 NEW: Combined Volume vs Performance Chart
         st.subheader("🚀 Search Volume vs Performance Matrix")
         
-        top_ds_combined = ds.nlargest(15, 'Counts')
+        top_ds_combined = ranked_view(ds, ds_rank, 'Counts', top_n=15)
         top_ds_combined['conversion_rate_volume'] = (top_ds_combined['conversions'] / top_ds_combined['Counts'] * 100).round(2)
         
         fig_combined = make_subplots(specs=[[{"secondary_y": True}]])
@@ -7792,7 +9663,7 @@ with tab_department:
         col_chart1, col_chart2 = st.columns(2)
         
         with col_chart1:
-            top_15_counts = ds.nlargest(15, 'Counts')
+            top_15_counts = ranked_view(ds, ds_rank, 'Counts', top_n=15)
             
             fig_counts = px.bar(
                 top_15_counts, 
@@ -7817,7 +9688,7 @@ with tab_department:
             st.plotly_chart(fig_counts, use_container_width=True)
         
         with col_chart2:
-            top_15_cr = ds.nlargest(15, 'cr')
+            top_15_cr = ranked_view(ds, ds_rank, 'cr', top_n=15)
             
             fig_cr = px.bar(
                 top_15_cr, 
@@ -7874,78 +9745,11 @@ with tab_department:
         month_names = get_month_names_cached_dept(queries_with_month)
         
         # ✅ CRITICAL: Compute monthly data with aggressive caching
-        filter_key = f"{queries_with_month.shape}_{num_departments}_{hash(str(ds['department'].tolist()[:5]))}"
-        
-        @st.cache_data(ttl=1800, show_spinner=False, max_entries=5)
-        def compute_monthly_performance_dept(df, ds_df, month_dict, num_depts, cache_key):
-            """Optimized monthly calculation with vectorization"""
-            if df.empty or ds_df.empty:
-                return pd.DataFrame(), []
-            
-            top_depts = ds_df.nlargest(num_depts, 'Counts')['department'].tolist()
-            top_data = df[df[department_column].isin(top_depts)].copy()
-            
-            if 'month' not in top_data.columns:
-                return pd.DataFrame(), []
-            
-            unique_months = sorted(top_data['month'].dropna().unique(), key=lambda x: pd.to_datetime(x))
-            
-            # ✅ VECTORIZED: Group once, calculate all metrics
-            grouped = top_data.groupby([department_column, 'month'], as_index=False).agg({
-                'Counts': 'sum',
-                'clicks': 'sum',
-                'conversions': 'sum'
-            })
-            
-            # Calculate metrics vectorized
-            grouped['ctr'] = np.where(grouped['Counts'] > 0, (grouped['clicks'] / grouped['Counts'] * 100), 0)
-            grouped['cr'] = np.where(grouped['Counts'] > 0, (grouped['conversions'] / grouped['Counts'] * 100), 0)
-            
-            # Build result efficiently
-            result_rows = []
-            for dept in top_depts:
-                dept_total = ds_df[ds_df['department'] == dept]
-                if dept_total.empty:
-                    continue
-                
-                dept_total_row = dept_total.iloc[0]
-                dataset_total = df['Counts'].sum()
-                share_pct = (dept_total_row['Counts'] / dataset_total * 100) if dataset_total > 0 else 0
-                
-                row = {
-                    'Department': dept,
-                    'Total Volume': int(dept_total_row['Counts']),
-                    'Share %': share_pct,
-                    'Overall CTR': dept_total_row['ctr'],
-                    'Overall CR': dept_total_row['cr'],
-                    'Total Clicks': int(dept_total_row['clicks']),
-                    'Total Conversions': int(dept_total_row['conversions'])
-                }
-                
-                # Add monthly data
-                dept_monthly = grouped[grouped[department_column] == dept]
-                for month in unique_months:
-                    month_display = month_dict.get(month, month)
-                    month_row = dept_monthly[dept_monthly['month'] == month]
-                    
-                    if not month_row.empty:
-                        mr = month_row.iloc[0]
-                        row[f'{month_display} Vol'] = int(mr['Counts'])
-                        row[f'{month_display} CTR'] = mr['ctr']
-                        row[f'{month_display} CR'] = mr['cr']
-                    else:
-                        row[f'{month_display} Vol'] = 0
-                        row[f'{month_display} CTR'] = 0
-                        row[f'{month_display} CR'] = 0
-                
-                result_rows.append(row)
-            
-            result_df = pd.DataFrame(result_rows)
-            result_df = result_df.sort_values('Total Volume', ascending=False).reset_index(drop=True)
-            return result_df[result_df['Total Volume'] > 0], unique_months
+        filter_key = f"{get_filter_fingerprint(queries_with_month)}_{num_departments}"
         
-        top_departments_monthly, unique_months = compute_monthly_performance_dept(
-            queries_with_month, ds, month_names, num_departments, filter_key
+        # ✅ Shared entity × month builder: one grouped pass + unstack
+        top_departments_monthly, unique_months = build_entity_month_table(
+            queries_with_month, department_column, month_names, num_departments, filter_key, entity_label='Department'
         )
         
         if not top_departments_monthly.empty:
@@ -8094,7 +9898,7 @@ with tab_department:
     with col_right:
         st.subheader("🏢 Department Market Share")
         
-        top_10_pie = ds.nlargest(10, 'Counts')
+        top_10_pie = ranked_view(ds, ds_rank, 'Counts', top_n=10)
         dept_colors = ['#1565C0', '#2196F3', '#42A5F5', '#64B5F6', '#90CAF9', 
                        '#BBDEFB', '#E3F2FD', '#1976D2', '#1E88E5', '#2196F3']
         
@@ -8142,7 +9946,7 @@ with tab_department:
         if 'Date' in queries.columns:
             st.subheader("📈 Department Trend Analysis")
             
-            top_5_depts = ds.nlargest(5, 'Counts')['department'].tolist()
+            top_5_depts = ranked_view(ds, ds_rank, 'Counts', top_n=5)['department'].tolist()
             trend_data = queries[
                 (queries[department_column].isin(top_5_depts)) &
                 (queries[department_column].notna())
@@ -8381,58 +10185,28 @@ with tab_department:
                 with m5:
                     st.markdown(f'<div class="dept-metric-card"><div class="dept-metric-value">{format_number(total_clicks)}</div><div class="dept-metric-label">🏢 Total Clicks</div></div>', unsafe_allow_html=True)
         
-        # Filter data
+        # ✅ Top-k slices of the shared sparse department × search matrix (no per-view groupby)
+        dept_matrix = build_dimension_query_matrix(department_queries, department_column, get_filter_fingerprint(department_queries))
         if selected_department == 'All Departments':
-            top_depts_matrix = ds.nlargest(8, 'Counts')['department'].tolist()
-            filtered_data = department_queries[department_queries[department_column].isin(top_depts_matrix)]
+            size_col1, size_col2 = st.columns(2)
+            with size_col1:
+                matrix_top_rows = st.slider("Departments in matrix:", 5, 30, 8, key="dept_matrix_rows")
+            with size_col2:
+                matrix_top_cols = st.slider("Search terms in matrix:", 5, 40, 12, key="dept_matrix_cols")
+            matrix_slice = slice_dimension_query_matrix(dept_matrix, matrix_top_rows, matrix_top_cols, col_rank='n_rows') if dept_matrix is not None else None
             matrix_title = "Top Departments vs Search Terms"
         else:
-            filtered_data = department_queries[department_queries[department_column] == selected_department]
+            matrix_slice = slice_dimension_query_matrix(dept_matrix, rows=[selected_department], top_cols=15) if dept_matrix is not None else None
             matrix_title = f"{selected_department} - Search Terms Analysis"
         
-        matrix_data = filtered_data[
-            (filtered_data[department_column].notna()) & 
-            (filtered_data['search'].notna()) &
-            (~filtered_data['search'].str.lower().isin(['other', 'others']))
-        ].copy()
+        matrix_data = matrix_slice['cells'].rename(columns={'dimension': 'department'}) if matrix_slice is not None else pd.DataFrame()
         
         if not matrix_data.empty:
             if selected_department == 'All Departments':
-                # ✅ VECTORIZED AGGREGATION
-                dept_search_matrix = matrix_data.groupby([department_column, 'search'], as_index=False).agg({
-                    'Counts': 'sum',
-                    'clicks': 'sum',
-                    'conversions': 'sum'
-                })
-                
-                dept_search_matrix = dept_search_matrix.rename(columns={department_column: 'department'})
-                
-                # Vectorized calculations
-                dept_search_matrix['ctr'] = np.where(
-                    dept_search_matrix['Counts'] > 0,
-                    (dept_search_matrix['clicks'] / dept_search_matrix['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                dept_search_matrix['cr'] = np.where(
-                    dept_search_matrix['Counts'] > 0,
-                    (dept_search_matrix['conversions'] / dept_search_matrix['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                dept_search_matrix['classic_cr'] = np.where(
-                    dept_search_matrix['clicks'] > 0,
-                    (dept_search_matrix['conversions'] / dept_search_matrix['clicks'] * 100),
-                    0
-                ).round(2)
-                
-                top_searches = matrix_data['search'].value_counts().head(12).index.tolist()
-                dept_search_matrix = dept_search_matrix[dept_search_matrix['search'].isin(top_searches)]
-                
-                heatmap_data = dept_search_matrix.pivot(index='department', columns='search', values='Counts').fillna(0)
-                ctr_data = dept_search_matrix.pivot(index='department', columns='search', values='ctr').fillna(0)
-                cr_data = dept_search_matrix.pivot(index='department', columns='search', values='cr').fillna(0)
-                classic_cr_data = dept_search_matrix.pivot(index='department', columns='search', values='classic_cr').fillna(0)
+                heatmap_data = matrix_slice['Counts']
+                ctr_data = matrix_slice['ctr']
+                cr_data = matrix_slice['cr']
+                classic_cr_data = matrix_slice['classic_cr']
                 
                 if not heatmap_data.empty:
                     fig_matrix = px.imshow(
@@ -8471,35 +10245,12 @@ with tab_department:
                     
                     st.plotly_chart(fig_matrix, use_container_width=True)
                     
-                    total_interactions = dept_search_matrix['Counts'].sum()
+                    total_interactions = matrix_data['Counts'].sum()
                     st.info(f"📊 Matrix shows {len(heatmap_data.index)} departments × {len(heatmap_data.columns)} search terms with {format_number(total_interactions)} total searches")
             else:
                 # Single department
-                dept_search_data = matrix_data.groupby('search', as_index=False).agg({
-                    'Counts': 'sum',
-                    'clicks': 'sum',
-                    'conversions': 'sum'
-                })
-                
-                dept_search_data['ctr'] = np.where(
-                    dept_search_data['Counts'] > 0,
-                    (dept_search_data['clicks'] / dept_search_data['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                dept_search_data['cr'] = np.where(
-                    dept_search_data['Counts'] > 0,
-                    (dept_search_data['conversions'] / dept_search_data['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                dept_search_data['classic_cr'] = np.where(
-                    dept_search_data['clicks'] > 0,
-                    (dept_search_data['conversions'] / dept_search_data['clicks'] * 100),
-                    0
-                ).round(2)
-                
-                dept_search_data = dept_search_data.nlargest(15, 'Counts')
+                # ✅ Top 15 search terms of the selected department, already sorted by volume
+                dept_search_data = matrix_data
                 
                 st.markdown("#### 📊 Chart Display Options")
                 cr_option = st.radio(
@@ -8589,37 +10340,11 @@ with tab_department:
     )
     
     try:
-        # ✅ VECTORIZED KEYWORD EXTRACTION
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def extract_keywords_optimized_dept(df, dept_col, num_kw):
-            """Optimized keyword extraction with vectorization"""
-            rows = []
-            
-            for dept, grp in df.groupby(dept_col):
-                keyword_counts = {}
-                
-                for _, row in grp.iterrows():
-                    keywords_list = row.get('keywords', [])
-                    query_count = row['Counts']
-                    
-                    if isinstance(keywords_list, list):
-                        for kw in keywords_list:
-                            keyword_counts[kw] = keyword_counts.get(kw, 0) + query_count
-                    elif pd.notna(keywords_list):
-                        search_term = row.get('normalized_query', '')
-                        if pd.notna(search_term):
-                            keywords = str(search_term).lower().split()
-                            for kw in keywords:
-                                keyword_counts[kw] = keyword_counts.get(kw, 0) + query_count
-                
-                top_kws = sorted(keyword_counts.items(), key=lambda x: x[1], reverse=True)[:num_kw]
-                
-                for kw, count in top_kws:
-                    rows.append({'department': dept, 'keyword': kw, 'count': count})
-            
-            return pd.DataFrame(rows)
-        
-        df_dkw = extract_keywords_optimized_dept(department_queries, department_column, num_keywords)
+        # ✅ VECTORIZED KEYWORD EXTRACTION (shared top-k per group engine)
+        df_dkw = compute_top_keywords_per_group(
+            department_queries, department_column, num_keywords,
+            get_filter_fingerprint(department_queries), _base_df=queries
+        )[['group', 'keyword', 'count']].rename(columns={'group': 'department'})
         
         if not df_dkw.empty:
             display_option = st.radio(
@@ -8786,7 +10511,7 @@ with tab_department:
     
     with col_insights1:
         # Top performing department by CTR
-        top_ctr_dept = ds.nlargest(1, 'ctr').iloc[0]
+        top_ctr_dept = ranked_view(ds, ds_rank, 'ctr', top_n=1).iloc[0]
         dept_name_display = top_ctr_dept['department'][:20] + "..." if len(top_ctr_dept['department']) > 20 else top_ctr_dept['department']
         
         st.markdown(f"""
@@ -8804,7 +10529,7 @@ with tab_department:
     
     with col_insights2:
         # Top performing department by CR
-        top_cr_dept = ds.nlargest(1, 'cr').iloc[0]
+        top_cr_dept = ranked_view(ds, ds_rank, 'cr', top_n=1).iloc[0]
         dept_name_display = top_cr_dept['department'][:20] + "..." if len(top_cr_dept['department']) > 20 else top_cr_dept['department']
         
         st.markdown(f"""
@@ -8822,7 +10547,7 @@ with tab_department:
     
     with col_insights3:
         # Highest volume department
-        top_volume_dept = ds.nlargest(1, 'Counts').iloc[0]
+        top_volume_dept = ranked_view(ds, ds_rank, 'Counts', top_n=1).iloc[0]
         dept_name_display = top_volume_dept['department'][:20] + "..." if len(top_volume_dept['department']) > 20 else top_volume_dept['department']
         
         st.markdown(f"""
@@ -8908,7 +10633,7 @@ with tab_department:
     
     with col_export2:
         # Export top performers
-        top_performers = ds.nlargest(20, 'Counts')
+        top_performers = ranked_view(ds, ds_rank, 'Counts', top_n=20)
         csv_top_performers = top_performers.to_csv(index=False)
         st.download_button(
             label="🏆 Download Top 20 Departments",
@@ -8937,6 +10662,102 @@ with tab_department:
             use_container_width=True
         )
     
+    # ✅ HIERARCHY DRILL-DOWN (precomputed tree - no row-level work)
+    st.markdown("---")
+    st.subheader("🌳 Hierarchy Drill-Down")
+    
+    hierarchy = build_hierarchy_tree(queries, get_filter_fingerprint(queries))
+    
+    if hierarchy is None:
+        st.info("ℹ️ No Department / Category hierarchy columns available for drill-down.")
+    else:
+        tree_nodes = hierarchy['nodes']
+        tree_levels = hierarchy['levels']
+        
+        col_chart_type, col_depth = st.columns([1, 1])
+        with col_chart_type:
+            tree_chart_type = st.radio("Chart type:", ["Treemap", "Sunburst"], horizontal=True, key="hierarchy_chart_type")
+        with col_depth:
+            tree_depth = st.slider("Levels shown below the focus:", 1, len(tree_levels), min(2, len(tree_levels)), key="hierarchy_depth")
+        
+        # Drill path: one selector per level, each offering the children of the current focus
+        focus_id = HIERARCHY_ROOT
+        path_cols = st.columns(len(tree_levels))
+        for level_idx, level_name in enumerate(tree_levels):
+            child_ids = hierarchy['children'].get(focus_id, [])
+            if not child_ids:
+                break
+            with path_cols[level_idx]:
+                child_labels = tree_nodes.loc[child_ids, 'label'].tolist()
+                picked = st.selectbox(f"{level_name}:", ['(All)'] + child_labels, key=f"hierarchy_level_{level_idx}")
+            if picked == '(All)':
+                break
+            focus_id = child_ids[child_labels.index(picked)]
+        
+        focus = tree_nodes.loc[focus_id]
+        subtree = tree_nodes.loc[hierarchy_subtree(hierarchy, focus_id, tree_depth)]
+        
+        c1, c2, c3, c4 = st.columns(4)
+        with c1:
+            st.metric("📊 Searches", format_number(focus['Counts']))
+        with c2:
+            st.metric("📈 CTR", f"{focus['ctr']:.1f}%")
+        with c3:
+            st.metric("🎯 CR", f"{focus['cr']:.1f}%")
+        with c4:
+            st.metric("🌍 Share of Total", f"{focus['share']:.1f}%")
+        
+        chart_cls = go.Treemap if tree_chart_type == "Treemap" else go.Sunburst
+        fig_tree = go.Figure(chart_cls(
+            ids=subtree.index,
+            labels=subtree['label'],
+            parents=subtree['parent'].where(subtree.index != focus_id, ''),
+            values=subtree['Counts'],
+            branchvalues='total',
+            customdata=np.column_stack([subtree['level'], subtree['ctr'], subtree['cr'], subtree['share']]),
+            hovertemplate='<b>%{label}</b> (%{customdata[0]})<br>Searches: %{value:,.0f}<br>'
+                          'CTR: %{customdata[1]:.1f}%<br>CR: %{customdata[2]:.1f}%<br>'
+                          'Share of Total: %{customdata[3]:.1f}%<extra></extra>',
+            marker=dict(colors=subtree['ctr'], colorscale=[[0, '#E3F2FD'], [0.5, '#64B5F6'], [1, '#1565C0']],
+                        colorbar=dict(title='CTR %'))
+        ))
+        fig_tree.update_layout(
+            height=600,
+            margin=dict(t=40, l=10, r=10, b=10),
+            paper_bgcolor='rgba(227,242,253,0.8)',
+            font=dict(color='#0D47A1', family='Segoe UI'),
+            title=f'<b style="color:#1565C0;">{focus["label"]} - {tree_chart_type} by Search Volume (colored by CTR)</b>'
+        )
+        st.plotly_chart(fig_tree, use_container_width=True)
+        
+        # Children table of the focus node
+        child_ids = hierarchy['children'].get(focus_id, [])
+        if child_ids:
+            children_df = tree_nodes.loc[child_ids]
+            parent_volume = focus['Counts']
+            children_display = pd.DataFrame({
+                children_df['level'].iloc[0]: children_df['label'].to_numpy(),
+                'Searches': children_df['Counts'].map(format_number).to_numpy(),
+                'Share of Parent %': children_df['Counts'].to_numpy() / parent_volume * 100 if parent_volume > 0 else 0.0,
+                'Share of Total %': children_df['share'].to_numpy(),
+                'CTR %': children_df['ctr'].to_numpy(),
+                'CR %': children_df['cr'].to_numpy(),
+                'Sub-nodes': children_df['n_children'].to_numpy()
+            })
+            for col in ['Share of Parent %', 'Share of Total %', 'CTR %', 'CR %']:
+                children_display[col] = children_display[col].map(lambda x: f"{x:.1f}%")
+            
+            display_styled_table(
+                df=children_display,
+                title=f"📋 {focus['label']} → {children_df['level'].iloc[0]} Breakdown",
+                download_filename=f"hierarchy_{focus['label'].replace(' ', '_')}_{pd.Timestamp.now().strftime('%Y%m%d')}.csv",
+                scrollable=True,
+                max_height="500px",
+                align="center"
+            )
+        else:
+            st.info(f"ℹ️ {focus['label']} is a leaf {focus['level']} - no further levels to drill into.")
+    
     # Success message
     st.success("✅ Department analysis complete! Use the download buttons above to export your data.")
     
@@ -9068,6 +10889,7 @@ with tab_category:
     
     # Calculate once, reuse everywhere
     cs = calculate_category_stats(category_queries, category_column)
+    cs_rank = build_sort_permutations(cs, get_filter_fingerprint(category_queries))
     
     # Main Category Analysis Layout
     col_left, col_right = st.columns([3, 2])
@@ -9076,7 +10898,7 @@ with tab_category:
         st.subheader("📈 Category Performance Matrix")
         
         # ✅ MEMORY FIX: Use top 30 only for visualization
-        top_30_cs = cs.nlargest(30, 'Counts')
+        top_30_cs = ranked_view(cs, cs_rank, 'Counts', top_n=30)
         
         # Create customdata efficiently
         customdata = np.column_stack([
@@ -9117,7 +10939,7 @@ with tab_category:
         col_chart1, col_chart2 = st.columns(2)
         
         with col_chart1:
-            top_15_counts = cs.nlargest(15, 'Counts')
+            top_15_counts = ranked_view(cs, cs_rank, 'Counts', top_n=15)
             
             fig_counts = px.bar(
                 top_15_counts, 
@@ -9142,7 +10964,7 @@ with tab_category:
             st.plotly_chart(fig_counts, use_container_width=True)
         
         with col_chart2:
-            top_15_cr = cs.nlargest(15, 'cr')
+            top_15_cr = ranked_view(cs, cs_rank, 'cr', top_n=15)
             
             fig_cr = px.bar(
                 top_15_cr, 
@@ -9199,78 +11021,11 @@ with tab_category:
         month_names = get_month_names_cached(queries_with_month)
         
         # ✅ CRITICAL: Compute monthly data with aggressive caching
-        filter_key = f"{queries_with_month.shape}_{num_categories}_{hash(str(cs['category'].tolist()[:5]))}"
-        
-        @st.cache_data(ttl=1800, show_spinner=False, max_entries=5)
-        def compute_monthly_performance(df, cs_df, month_dict, num_cats, cache_key):
-            """Optimized monthly calculation with vectorization"""
-            if df.empty or cs_df.empty:
-                return pd.DataFrame(), []
-            
-            top_cats = cs_df.nlargest(num_cats, 'Counts')['category'].tolist()
-            top_data = df[df[category_column].isin(top_cats)].copy()
-            
-            if 'month' not in top_data.columns:
-                return pd.DataFrame(), []
-            
-            unique_months = sorted(top_data['month'].dropna().unique(), key=lambda x: pd.to_datetime(x))
-            
-            # ✅ VECTORIZED: Group once, calculate all metrics
-            grouped = top_data.groupby([category_column, 'month'], as_index=False).agg({
-                'Counts': 'sum',
-                'clicks': 'sum',
-                'conversions': 'sum'
-            })
-            
-            # Calculate metrics vectorized
-            grouped['ctr'] = np.where(grouped['Counts'] > 0, (grouped['clicks'] / grouped['Counts'] * 100), 0)
-            grouped['cr'] = np.where(grouped['Counts'] > 0, (grouped['conversions'] / grouped['Counts'] * 100), 0)
-            
-            # Build result efficiently
-            result_rows = []
-            for cat in top_cats:
-                cat_total = cs_df[cs_df['category'] == cat]
-                if cat_total.empty:
-                    continue
-                
-                cat_total_row = cat_total.iloc[0]
-                dataset_total = df['Counts'].sum()
-                share_pct = (cat_total_row['Counts'] / dataset_total * 100) if dataset_total > 0 else 0
-                
-                row = {
-                    'Category': cat,
-                    'Total Volume': int(cat_total_row['Counts']),
-                    'Share %': share_pct,
-                    'Overall CTR': cat_total_row['ctr'],
-                    'Overall CR': cat_total_row['cr'],
-                    'Total Clicks': int(cat_total_row['clicks']),
-                    'Total Conversions': int(cat_total_row['conversions'])
-                }
-                
-                # Add monthly data
-                cat_monthly = grouped[grouped[category_column] == cat]
-                for month in unique_months:
-                    month_display = month_dict.get(month, month)
-                    month_row = cat_monthly[cat_monthly['month'] == month]
-                    
-                    if not month_row.empty:
-                        mr = month_row.iloc[0]
-                        row[f'{month_display} Vol'] = int(mr['Counts'])
-                        row[f'{month_display} CTR'] = mr['ctr']
-                        row[f'{month_display} CR'] = mr['cr']
-                    else:
-                        row[f'{month_display} Vol'] = 0
-                        row[f'{month_display} CTR'] = 0
-                        row[f'{month_display} CR'] = 0
-                
-                result_rows.append(row)
-            
-            result_df = pd.DataFrame(result_rows)
-            result_df = result_df.sort_values('Total Volume', ascending=False).reset_index(drop=True)
-            return result_df[result_df['Total Volume'] > 0], unique_months
+        filter_key = f"{get_filter_fingerprint(queries_with_month)}_{num_categories}"
         
-        top_categories_monthly, unique_months = compute_monthly_performance(
-            queries_with_month, cs, month_names, num_categories, filter_key
+        # ✅ Shared entity × month builder: one grouped pass + unstack
+        top_categories_monthly, unique_months = build_entity_month_table(
+            queries_with_month, category_column, month_names, num_categories, filter_key, entity_label='Category'
         )
         
         if not top_categories_monthly.empty:
@@ -9419,7 +11174,7 @@ with tab_category:
     with col_right:
         st.subheader(" Category Market Share")
         
-        top_10_pie = cs.nlargest(10, 'Counts')
+        top_10_pie = ranked_view(cs, cs_rank, 'Counts', top_n=10)
         _colors = ['#2E7D32', '#4CAF50', '#66BB6A', '#81C784', '#A5D6A7', 
                         '#C8E6C8', '#E8F5E8', '#388E3C', '#689F38', '#8BC34A']
         
@@ -9467,7 +11222,7 @@ with tab_category:
         if 'Date' in queries.columns:
             st.subheader("📈 Category Trend Analysis")
             
-            top_5_cats = cs.nlargest(5, 'Counts')['category'].tolist()
+            top_5_cats = ranked_view(cs, cs_rank, 'Counts', top_n=5)['category'].tolist()
             trend_data = queries[
                 (queries[category_column].isin(top_5_cats)) &
                 (queries[category_column].notna())
@@ -9706,58 +11461,28 @@ with tab_category:
                 with m5:
                     st.markdown(f'<div class="brand-metric-card"><div class="brand-metric-value">{format_number(total_clicks)}</div><div class="brand-metric-label">🍃 Total Clicks</div></div>', unsafe_allow_html=True)
         
-        # Filter data
+        # ✅ Top-k slices of the shared sparse category × search matrix (no per-view groupby)
+        cat_matrix = build_dimension_query_matrix(category_queries, category_column, get_filter_fingerprint(category_queries))
         if selected_category == 'All Categories':
-            top_cats_matrix = cs.nlargest(8, 'Counts')['category'].tolist()
-            filtered_data = category_queries[category_queries[category_column].isin(top_cats_matrix)]
+            size_col1, size_col2 = st.columns(2)
+            with size_col1:
+                matrix_top_rows = st.slider("Categories in matrix:", 5, 30, 8, key="cat_matrix_rows")
+            with size_col2:
+                matrix_top_cols = st.slider("Search terms in matrix:", 5, 40, 12, key="cat_matrix_cols")
+            matrix_slice = slice_dimension_query_matrix(cat_matrix, matrix_top_rows, matrix_top_cols, col_rank='n_rows') if cat_matrix is not None else None
             matrix_title = "Top Categories vs Search Terms"
         else:
-            filtered_data = category_queries[category_queries[category_column] == selected_category]
+            matrix_slice = slice_dimension_query_matrix(cat_matrix, rows=[selected_category], top_cols=15) if cat_matrix is not None else None
             matrix_title = f"{selected_category} - Search Terms Analysis"
         
-        matrix_data = filtered_data[
-            (filtered_data[category_column].notna()) & 
-            (filtered_data['search'].notna()) &
-            (~filtered_data['search'].str.lower().isin(['other', 'others']))
-        ].copy()
+        matrix_data = matrix_slice['cells'].rename(columns={'dimension': 'category'}) if matrix_slice is not None else pd.DataFrame()
         
         if not matrix_data.empty:
             if selected_category == 'All Categories':
-                # ✅ VECTORIZED AGGREGATION
-                cat_search_matrix = matrix_data.groupby([category_column, 'search'], as_index=False).agg({
-                    'Counts': 'sum',
-                    'clicks': 'sum',
-                    'conversions': 'sum'
-                })
-                
-                cat_search_matrix = cat_search_matrix.rename(columns={category_column: 'category'})
-                
-                # Vectorized calculations
-                cat_search_matrix['ctr'] = np.where(
-                    cat_search_matrix['Counts'] > 0,
-                    (cat_search_matrix['clicks'] / cat_search_matrix['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                cat_search_matrix['cr'] = np.where(
-                    cat_search_matrix['Counts'] > 0,
-                    (cat_search_matrix['conversions'] / cat_search_matrix['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                cat_search_matrix['classic_cr'] = np.where(
-                    cat_search_matrix['clicks'] > 0,
-                    (cat_search_matrix['conversions'] / cat_search_matrix['clicks'] * 100),
-                    0
-                ).round(2)
-                
-                top_searches = matrix_data['search'].value_counts().head(12).index.tolist()
-                cat_search_matrix = cat_search_matrix[cat_search_matrix['search'].isin(top_searches)]
-                
-                heatmap_data = cat_search_matrix.pivot(index='category', columns='search', values='Counts').fillna(0)
-                ctr_data = cat_search_matrix.pivot(index='category', columns='search', values='ctr').fillna(0)
-                cr_data = cat_search_matrix.pivot(index='category', columns='search', values='cr').fillna(0)
-                classic_cr_data = cat_search_matrix.pivot(index='category', columns='search', values='classic_cr').fillna(0)
+                heatmap_data = matrix_slice['Counts']
+                ctr_data = matrix_slice['ctr']
+                cr_data = matrix_slice['cr']
+                classic_cr_data = matrix_slice['classic_cr']
                 
                 if not heatmap_data.empty:
                     fig_matrix = px.imshow(
@@ -9796,35 +11521,12 @@ with tab_category:
                     
                     st.plotly_chart(fig_matrix, use_container_width=True)
                     
-                    total_interactions = cat_search_matrix['Counts'].sum()
+                    total_interactions = matrix_data['Counts'].sum()
                     st.info(f"📊 Matrix shows {len(heatmap_data.index)} categories × {len(heatmap_data.columns)} search terms with {format_number(total_interactions)} total searches")
             else:
                 # Single category
-                cat_search_data = matrix_data.groupby('search', as_index=False).agg({
-                    'Counts': 'sum',
-                    'clicks': 'sum',
-                    'conversions': 'sum'
-                })
-                
-                cat_search_data['ctr'] = np.where(
-                    cat_search_data['Counts'] > 0,
-                    (cat_search_data['clicks'] / cat_search_data['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                cat_search_data['cr'] = np.where(
-                    cat_search_data['Counts'] > 0,
-                    (cat_search_data['conversions'] / cat_search_data['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                cat_search_data['classic_cr'] = np.where(
-                    cat_search_data['clicks'] > 0,
-                    (cat_search_data['conversions'] / cat_search_data['clicks'] * 100),
-                    0
-                ).round(2)
-                
-                cat_search_data = cat_search_data.nlargest(15, 'Counts')
+                # ✅ Top 15 search terms of the selected category, already sorted by volume
+                cat_search_data = matrix_data
                 
                 st.markdown("#### 📊 Chart Display Options")
                 cr_option = st.radio(
@@ -9914,37 +11616,11 @@ with tab_category:
     )
     
     try:
-        # ✅ VECTORIZED KEYWORD EXTRACTION
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def extract_keywords_optimized(df, cat_col, num_kw):
-            """Optimized keyword extraction with vectorization"""
-            rows = []
-            
-            for cat, grp in df.groupby(cat_col):
-                keyword_counts = {}
-                
-                for _, row in grp.iterrows():
-                    keywords_list = row.get('keywords', [])
-                    query_count = row['Counts']
-                    
-                    if isinstance(keywords_list, list):
-                        for kw in keywords_list:
-                            keyword_counts[kw] = keyword_counts.get(kw, 0) + query_count
-                    elif pd.notna(keywords_list):
-                        search_term = row.get('normalized_query', '')
-                        if pd.notna(search_term):
-                            keywords = str(search_term).lower().split()
-                            for kw in keywords:
-                                keyword_counts[kw] = keyword_counts.get(kw, 0) + query_count
-                
-                top_kws = sorted(keyword_counts.items(), key=lambda x: x[1], reverse=True)[:num_kw]
-                
-                for kw, count in top_kws:
-                    rows.append({'category': cat, 'keyword': kw, 'count': count})
-            
-            return pd.DataFrame(rows)
-        
-        df_ckw = extract_keywords_optimized(category_queries, category_column, num_keywords)
+        # ✅ VECTORIZED KEYWORD EXTRACTION (shared top-k per group engine)
+        df_ckw = compute_top_keywords_per_group(
+            category_queries, category_column, num_keywords,
+            get_filter_fingerprint(category_queries), _base_df=queries
+        )[['group', 'keyword', 'count']].rename(columns={'group': 'category'})
         
         if not df_ckw.empty:
             display_option = st.radio(
@@ -10229,29 +11905,18 @@ with tab_subcat:
         avg_ctr = float(sc['ctr'].mean())
         avg_cr = float(sc['conversion_rate'].mean())
         
-        # Market concentration metrics
-        if total_subcategories >= 5:
-            top_5_concentration = sc.head(5)['Counts'].sum() / sc['Counts'].sum() * 100
-        else:
-            top_5_concentration = 100.0
-        
-        if total_subcategories >= 10:
-            top_10_concentration = sc.head(10)['Counts'].sum() / sc['Counts'].sum() * 100
-        else:
-            top_10_concentration = 100.0
-        
-        # Calculate Gini & Herfindahl efficiently
-        if len(sc) > 1:
-            sorted_counts = sc['Counts'].sort_values().values
-            cumsum_counts = np.cumsum(sorted_counts)
-            n = len(sc)
-            total_sum = sorted_counts.sum()
-            gini_coefficient = (2 * np.sum((np.arange(1, n + 1) * sorted_counts))) / (n * total_sum) - (n + 1) / n
-            shares = sc['Counts'].values / total_sum
-            herfindahl_index = np.sum(shares ** 2)
-        else:
-            gini_coefficient = 0
-            herfindahl_index = 1
+        # Market concentration metrics (shared concentration table)
+        subcat_concentration = concentration_metrics(
+            compute_concentration_table(
+                subcategory_queries, get_filter_fingerprint(subcategory_queries),
+                dimensions={subcategory_column: 'Subcategory'}, excluded_labels=()
+            ),
+            subcategory_column
+        )
+        top_5_concentration = float(subcat_concentration.get('top_5_share', 100.0))
+        top_10_concentration = float(subcat_concentration.get('top_10_share', 100.0))
+        gini_coefficient = float(subcat_concentration.get('gini', 0.0))
+        herfindahl_index = float(subcat_concentration.get('hhi', 1.0))
         
         # ✅ KEY METRICS SECTION
         st.subheader("🌿 Subcategories Performance Overview")
@@ -10358,42 +12023,27 @@ with tab_subcat:
             keyword_col = 'keyword' if 'keyword' in queries.columns else 'search'
             
             @st.cache_data(ttl=1800, show_spinner=False, max_entries=3)
-            def analyze_subcategory_keywords(df, subcat_col, kw_col, top_n=10):
-                """Optimized keyword analysis with vectorization"""
-                df_filtered = df[(df[kw_col].notna()) & (df[subcat_col].notna())].copy()
+            def analyze_subcategory_keywords(_df, subcat_col, kw_col, cache_key, top_n=10):
+                """Optimized keyword analysis on the shared top-k per group engine"""
+                df_filtered = _df[(_df[kw_col].notna()) & (_df[subcat_col].notna())]
                 
                 if len(df_filtered) == 0:
                     return pd.DataFrame(), {}
                 
-                # Ensure numeric columns
-                for col in ['Counts', 'clicks', 'conversions']:
-                    if col in df_filtered.columns:
-                        df_filtered[col] = pd.to_numeric(df_filtered[col], errors='coerce').fillna(0)
-                
-                # Vectorized groupby
-                df_grouped = df_filtered.groupby([subcat_col, kw_col], as_index=False).agg({
-                    'Counts': 'sum',
-                    'clicks': 'sum',
-                    'conversions': 'sum'
-                })
-                
-                df_grouped = df_grouped.rename(columns={'Counts': 'count'})
-                df_grouped['count'] = df_grouped['count'].round().astype(np.int64)
-                df_grouped['clicks'] = df_grouped['clicks'].round().astype(np.int64)
-                df_grouped['conversions'] = df_grouped['conversions'].round().astype(np.int64)
+                # Vectorized (subcategory, keyword) sums + per-subcategory top-n
+                top_kw = compute_top_keywords_per_group(
+                    df_filtered, subcat_col, top_n, cache_key, keyword_col=kw_col
+                ).rename(columns={'group': subcat_col, 'keyword': kw_col, 'ctr': 'keyword_ctr', 'cr': 'keyword_cr'})
                 
-                # Vectorized metrics
-                df_grouped['keyword_ctr'] = np.where(df_grouped['count'] > 0, (df_grouped['clicks'] / df_grouped['count'] * 100), 0)
-                df_grouped['keyword_cr'] = np.where(df_grouped['count'] > 0, (df_grouped['conversions'] / df_grouped['count'] * 100), 0)
+                if top_kw.empty:
+                    return pd.DataFrame(), {}
                 
                 # Build summary efficiently
                 summary_rows = []
                 subcat_stats = {}
-                total_volume = int(df_grouped['count'].sum())
+                total_volume = int(pd.to_numeric(df_filtered['Counts'], errors='coerce').fillna(0).sum().round())
                 
-                for subcat in df_grouped[subcat_col].unique():
-                    subcat_data = df_grouped[df_grouped[subcat_col] == subcat].nlargest(top_n, 'count')
-                    
+                for subcat, subcat_data in top_kw.groupby(subcat_col, sort=False):
                     # Format keywords
                     keywords_list = []
                     for _, row in subcat_data.iterrows():
@@ -10404,7 +12054,7 @@ with tab_subcat:
                     
                     actual_total = int(subcat_data['count'].sum())
                     share_pct = (actual_total / total_volume * 100) if total_volume > 0 else 0
-                    unique_kws = len(df_grouped[df_grouped[subcat_col] == subcat])
+                    unique_kws = int(subcat_data['group_keywords'].iloc[0])
                     avg_count = float(subcat_data['count'].mean())
                     top_kw_dominance = (float(subcat_data.iloc[0]['count']) / actual_total * 100) if len(subcat_data) > 0 and actual_total > 0 else 0
                     
@@ -10437,7 +12087,8 @@ with tab_subcat:
                 return summary_df, subcat_stats
             
             summary_df, subcategory_stats = analyze_subcategory_keywords(
-                subcategory_queries, subcategory_column, keyword_col
+                subcategory_queries, subcategory_column, keyword_col,
+                get_filter_fingerprint(subcategory_queries)
             )
             
             if not summary_df.empty:
@@ -10491,7 +12142,7 @@ with tab_subcat:
                     month_names = get_month_names_cached(queries_with_month)
                 
                 # Compute monthly data
-                filter_key = f"{queries_with_month.shape}_{num_subcategories}_{hash(str(sc['sub_category'].tolist()[:5]))}"
+                filter_key = f"{get_filter_fingerprint(queries_with_month)}_{num_subcategories}"
                 
                 @st.cache_data(ttl=1800, show_spinner=False, max_entries=5)
                 def compute_subcategory_monthly(df, sc_df, month_dict, num_subcats, cache_key):
@@ -10857,6 +12508,11 @@ with tab_subcat:
                 index=0,
                 key="detailed_subcategory_selector"
             )
+            prefetch_subcats = st.checkbox(
+                "⚡ Prefetch the next subcategories in the background",
+                value=True,
+                key="subcat_deep_dive_prefetch"
+            )
             
             if selected_subcategory:
                 subcat_data = sc[sc['sub_category'] == selected_subcategory].iloc[0]
@@ -10989,39 +12645,21 @@ with tab_subcat:
                 
                 st.plotly_chart(fig_radar, use_container_width=True)
                 
+                # ✅ Keyword + month breakdowns from the per-entity LRU (next subcategories by volume prefetched)
+                keyword_col = 'keyword' if 'keyword' in queries.columns else 'search' if 'search' in queries.columns else None
+                subcat_order = sc['sub_category'].tolist()
+                next_pos = subcat_order.index(selected_subcategory) + 1
+                subcat_deep_dive = get_entity_deep_dive(
+                    subcategory_queries, 'subcategory', subcategory_column, selected_subcategory,
+                    get_filter_fingerprint(subcategory_queries), keyword_col=keyword_col,
+                    prefetch=subcat_order[next_pos:next_pos + DEEP_DIVE_PREFETCH_COUNT] if prefetch_subcats else ()
+                )
+                
                 # Keyword analysis
-                if 'keyword' in queries.columns or 'search' in queries.columns:
-                    keyword_col = 'keyword' if 'keyword' in queries.columns else 'search'
-                    subcat_keywords = subcategory_queries[subcategory_queries[subcategory_column] == selected_subcategory].copy()
+                if keyword_col is not None:
+                    keyword_analysis = subcat_deep_dive.get('keywords', pd.DataFrame())
                     
-                    if len(subcat_keywords) > 0:
-                        # Ensure numeric
-                        for col in ['Counts', 'clicks', 'conversions']:
-                            if col in subcat_keywords.columns:
-                                subcat_keywords[col] = pd.to_numeric(subcat_keywords[col], errors='coerce').fillna(0)
-                        
-                        keyword_analysis = subcat_keywords.groupby(keyword_col, as_index=False).agg({
-                            'Counts': 'sum',
-                            'clicks': 'sum',
-                            'conversions': 'sum'
-                        })
-                        
-                        keyword_analysis['Counts'] = keyword_analysis['Counts'].round().astype(np.int64)
-                        keyword_analysis['clicks'] = keyword_analysis['clicks'].round().astype(np.int64)
-                        keyword_analysis['conversions'] = keyword_analysis['conversions'].round().astype(np.int64)
-                        
-                        keyword_analysis['keyword_ctr'] = np.where(
-                            keyword_analysis['Counts'] > 0,
-                            (keyword_analysis['clicks'] / keyword_analysis['Counts'] * 100),
-                            0
-                        )
-                        keyword_analysis['keyword_cr'] = np.where(
-                            keyword_analysis['Counts'] > 0,
-                            (keyword_analysis['conversions'] / keyword_analysis['Counts'] * 100),
-                            0
-                        )
-                        
-                        keyword_analysis = keyword_analysis.nlargest(15, 'Counts')
+                    if len(keyword_analysis) > 0:
                         
                         # Keyword chart
                         fig_keywords = px.bar(
@@ -11061,6 +12699,28 @@ with tab_subcat:
                     else:
                         st.info("No keyword data available for this subcategory.")
                 
+                # Monthly trend (same cached deep-dive result)
+                subcat_monthly = subcat_deep_dive.get('monthly', pd.DataFrame())
+                if len(subcat_monthly) > 1:
+                    st.markdown("### 📅 Monthly Trend")
+                    fig_subcat_month = px.line(
+                        subcat_monthly,
+                        x='month',
+                        y='Counts',
+                        markers=True,
+                        title=f'<b style="color:#2E7D32;">🌿 Monthly Search Volume - {selected_subcategory}</b>',
+                        labels={'Counts': 'Search Volume', 'month': 'Month'},
+                        hover_data={'ctr': ':.1f', 'cr': ':.1f'}
+                    )
+                    fig_subcat_month.update_traces(line_color='#4CAF50')
+                    fig_subcat_month.update_layout(
+                        plot_bgcolor='rgba(248,255,248,0.95)',
+                        paper_bgcolor='rgba(232,245,232,0.8)',
+                        font=dict(color='#1B5E20', family='Segoe UI'),
+                        height=400
+                    )
+                    st.plotly_chart(fig_subcat_month, use_container_width=True)
+                
                 # Competitive analysis
                 st.markdown("### 📈 Subcategory Competitive Analysis")
                 
@@ -11141,7 +12801,7 @@ with tab_subcat:
         elif analysis_type == "📈 Performance Comparison":
             st.subheader("⚖️ Subcategory Performance Comparison")
             
-            max_selections = min(10, len(sc))
+            max_selections = min(20, len(sc))
             default_selections = min(5, len(sc))
             
             selected_subcategories = st.multiselect(
@@ -11153,7 +12813,14 @@ with tab_subcat:
             )
             
             if selected_subcategories:
-                comparison_data = sc[sc['sub_category'].isin(selected_subcategories)].copy()
+                # ✅ One grouped pass for all selected subcategories (summary + monthly series)
+                subcat_comparison = compare_entities(
+                    subcategory_queries, subcategory_column, tuple(selected_subcategories),
+                    get_filter_fingerprint(subcategory_queries)
+                )
+                comparison_data = subcat_comparison['summary'].rename(columns={
+                    subcategory_column: 'sub_category', 'cr': 'conversion_rate', 'classic_cr': 'classic_cvr'
+                })
                 
                 # Performance metrics comparison
                 fig_comparison = go.Figure()
@@ -11220,6 +12887,31 @@ with tab_subcat:
                 
                 st.plotly_chart(fig_scatter, use_container_width=True)
                 
+                # Monthly series from the same comparison pass
+                subcat_comparison_monthly = subcat_comparison['monthly']
+                if subcat_comparison_monthly['month'].nunique() > 1:
+                    st.markdown("### 📅 Monthly Volume Comparison")
+                    
+                    fig_monthly_comparison = px.line(
+                        subcat_comparison_monthly.rename(columns={subcategory_column: 'sub_category'}),
+                        x='month',
+                        y='Counts',
+                        color='sub_category',
+                        markers=True,
+                        title='<b style="color:#2E7D32;">🌿 Monthly Search Volume by Subcategory</b>',
+                        labels={'Counts': 'Search Volume', 'month': 'Month', 'sub_category': 'Subcategory'},
+                        color_discrete_sequence=px.colors.qualitative.Set2
+                    )
+                    
+                    fig_monthly_comparison.update_layout(
+                        plot_bgcolor='rgba(248,255,248,0.95)',
+                        paper_bgcolor='rgba(232,245,232,0.8)',
+                        font=dict(color='#1B5E20', family='Segoe UI'),
+                        height=450
+                    )
+                    
+                    st.plotly_chart(fig_monthly_comparison, use_container_width=True)
+                
                 # Detailed comparison table
                 st.markdown("### 📊 Detailed Comparison Table")
                 
@@ -11237,6 +12929,8 @@ with tab_subcat:
                     'Click Share %': comparison_table['click_share'].apply(lambda x: f"{x:.1f}%"),
                     'Conversion Share %': comparison_table['conversion_share'].apply(lambda x: f"{x:.1f}%")
                 })
+                # 95% intervals + z-test flags vs the rest of the subcategory data
+                final_table = pd.concat([final_table, significance_display_columns(comparison_data)], axis=1)
                 
                 display_styled_table(
                     df=final_table,
@@ -11595,6 +13289,7 @@ with tab_class:
         return cls.sort_values('Counts', ascending=False).reset_index(drop=True)
     
     cls = calculate_class_metrics(class_queries, class_column)
+    cls_rank = build_sort_permutations(cls, get_filter_fingerprint(class_queries))
     
     # Main Layout
     col_left, col_right = st.columns([3, 2])
@@ -11670,7 +13365,7 @@ with tab_class:
             st.plotly_chart(fig_counts, use_container_width=True)
         
         with col_chart2:
-            top_15_cr = cls.nlargest(15, 'cr')
+            top_15_cr = ranked_view(cls, cls_rank, 'cr', top_n=15)
             fig_cr = px.bar(
                 top_15_cr,
                 x='class',
@@ -11723,78 +13418,11 @@ with tab_class:
             month_names = get_month_names_cached(queries_with_month)
         
         # Compute monthly data
-        filter_key = f"{queries_with_month.shape}_{num_classes}_{hash(str(cls['class'].tolist()[:5]))}"
-        
-        @st.cache_data(ttl=1800, show_spinner=False, max_entries=5)
-        def compute_class_monthly(df, cls_df, month_dict, num_cls, cache_key):
-            """Optimized monthly class calculation"""
-            if df.empty or cls_df.empty:
-                return pd.DataFrame(), []
-            
-            top_classes = cls_df.nlargest(num_cls, 'Counts')['class'].tolist()
-            top_data = df[df[class_column].isin(top_classes)].copy()
-            
-            if 'month' not in top_data.columns:
-                return pd.DataFrame(), []
-            
-            unique_months = sorted(top_data['month'].dropna().unique(), key=lambda x: pd.to_datetime(x))
-            
-            # Vectorized groupby
-            grouped = top_data.groupby([class_column, 'month'], as_index=False).agg({
-                'Counts': 'sum',
-                'clicks': 'sum',
-                'conversions': 'sum'
-            })
-            
-            grouped['ctr'] = np.where(grouped['Counts'] > 0, (grouped['clicks'] / grouped['Counts'] * 100), 0)
-            grouped['cr'] = np.where(grouped['Counts'] > 0, (grouped['conversions'] / grouped['Counts'] * 100), 0)
-            
-            # Build result
-            result_rows = []
-            dataset_total = df['Counts'].sum()
-            
-            for class_name in top_classes:
-                class_total = cls_df[cls_df['class'] == class_name]
-                if class_total.empty:
-                    continue
-                
-                ct_row = class_total.iloc[0]
-                share_pct = (ct_row['Counts'] / dataset_total * 100) if dataset_total > 0 else 0
-                
-                row = {
-                    'Class': class_name,
-                    'Total Volume': int(ct_row['Counts']),
-                    'Share %': share_pct,
-                    'Overall CTR': ct_row['ctr'],
-                    'Overall CR': ct_row['cr'],
-                    'Total Clicks': int(ct_row['clicks']),
-                    'Total Conversions': int(ct_row['conversions'])
-                }
-                
-                # Add monthly data
-                class_monthly = grouped[grouped[class_column] == class_name]
-                for month in unique_months:
-                    month_display = month_dict.get(month, month)
-                    month_row = class_monthly[class_monthly['month'] == month]
-                    
-                    if not month_row.empty:
-                        mr = month_row.iloc[0]
-                        row[f'{month_display} Vol'] = int(mr['Counts'])
-                        row[f'{month_display} CTR'] = mr['ctr']
-                        row[f'{month_display} CR'] = mr['cr']
-                    else:
-                        row[f'{month_display} Vol'] = 0
-                        row[f'{month_display} CTR'] = 0
-                        row[f'{month_display} CR'] = 0
-                
-                result_rows.append(row)
-            
-            result_df = pd.DataFrame(result_rows)
-            result_df = result_df.sort_values('Total Volume', ascending=False).reset_index(drop=True)
-            return result_df[result_df['Total Volume'] > 0], unique_months
+        filter_key = f"{get_filter_fingerprint(queries_with_month)}_{num_classes}"
         
-        top_classes_monthly, unique_months_cls = compute_class_monthly(
-            queries_with_month, cls, month_names, num_classes, filter_key
+        # ✅ Shared entity × month builder: one grouped pass + unstack
+        top_classes_monthly, unique_months_cls = build_entity_month_table(
+            queries_with_month, class_column, month_names, num_classes, filter_key, entity_label='Class'
         )
         
         if not top_classes_monthly.empty:
@@ -12300,60 +13928,28 @@ with tab_class:
                     </div>
                     """, unsafe_allow_html=True)
         
-        # Filter data
+        # ✅ Top-k slices of the shared sparse class × search matrix (no per-view groupby)
+        class_matrix = build_dimension_query_matrix(class_queries, class_column, get_filter_fingerprint(class_queries))
         if selected_class == 'All Classes':
-            top_classes_matrix = cls.head(8)['class'].tolist()
-            filtered_data = class_queries[class_queries[class_column].isin(top_classes_matrix)]
+            size_col1, size_col2 = st.columns(2)
+            with size_col1:
+                matrix_top_rows = st.slider("Classes in matrix:", 5, 30, 8, key="class_matrix_rows")
+            with size_col2:
+                matrix_top_cols = st.slider("Search terms in matrix:", 5, 40, 12, key="class_matrix_cols")
+            matrix_slice = slice_dimension_query_matrix(class_matrix, matrix_top_rows, matrix_top_cols, col_rank='n_rows') if class_matrix is not None else None
             matrix_title = "Top Classes vs Search Terms"
         else:
-            filtered_data = class_queries[class_queries[class_column] == selected_class]
+            matrix_slice = slice_dimension_query_matrix(class_matrix, rows=[selected_class], top_cols=15) if class_matrix is not None else None
             matrix_title = f"{selected_class} - Search Terms Analysis"
         
-        matrix_data = filtered_data[
-            (filtered_data[class_column].notna()) & 
-            (filtered_data['search'].notna()) &
-            (~filtered_data['search'].str.lower().isin(['other', 'others']))
-        ].copy()
+        matrix_data = matrix_slice['cells'].rename(columns={'dimension': 'class'}) if matrix_slice is not None else pd.DataFrame()
         
         if not matrix_data.empty:
             if selected_class == 'All Classes':
-                # Vectorized aggregation
-                class_search_matrix = matrix_data.groupby([class_column, 'search'], as_index=False).agg({
-                    'Counts': 'sum',
-                    'clicks': 'sum',
-                    'conversions': 'sum'
-                })
-                
-                class_search_matrix = class_search_matrix.rename(columns={class_column: 'class'})
-                
-                # Vectorized metrics
-                class_search_matrix['ctr'] = np.where(
-                    class_search_matrix['Counts'] > 0,
-                    (class_search_matrix['clicks'] / class_search_matrix['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                class_search_matrix['cr'] = np.where(
-                    class_search_matrix['Counts'] > 0,
-                    (class_search_matrix['conversions'] / class_search_matrix['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                class_search_matrix['classic_cr'] = np.where(
-                    class_search_matrix['clicks'] > 0,
-                    (class_search_matrix['conversions'] / class_search_matrix['clicks'] * 100),
-                    0
-                ).round(2)
-                
-                # Get top searches
-                top_searches = matrix_data['search'].value_counts().head(12).index.tolist()
-                class_search_matrix = class_search_matrix[class_search_matrix['search'].isin(top_searches)]
-                
-                # Create pivots
-                heatmap_data = class_search_matrix.pivot(index='class', columns='search', values='Counts').fillna(0)
-                ctr_data = class_search_matrix.pivot(index='class', columns='search', values='ctr').fillna(0)
-                cr_data = class_search_matrix.pivot(index='class', columns='search', values='cr').fillna(0)
-                classic_cr_data = class_search_matrix.pivot(index='class', columns='search', values='classic_cr').fillna(0)
+                heatmap_data = matrix_slice['Counts']
+                ctr_data = matrix_slice['ctr']
+                cr_data = matrix_slice['cr']
+                classic_cr_data = matrix_slice['classic_cr']
                 
                 if not heatmap_data.empty:
                     fig_matrix = px.imshow(
@@ -12395,35 +13991,12 @@ with tab_class:
                     
                     st.plotly_chart(fig_matrix, use_container_width=True)
                     
-                    total_interactions = int(class_search_matrix['Counts'].sum())
+                    total_interactions = int(matrix_data['Counts'].sum())
                     st.info(f"📊 Matrix shows {len(heatmap_data.index)} classes × {len(heatmap_data.columns)} search terms with {format_number(total_interactions)} total searches")
             else:
                 # Single class analysis
-                class_search_data = matrix_data.groupby('search', as_index=False).agg({
-                    'Counts': 'sum',
-                    'clicks': 'sum',
-                    'conversions': 'sum'
-                })
-                
-                class_search_data['ctr'] = np.where(
-                    class_search_data['Counts'] > 0,
-                    (class_search_data['clicks'] / class_search_data['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                class_search_data['cr'] = np.where(
-                    class_search_data['Counts'] > 0,
-                    (class_search_data['conversions'] / class_search_data['Counts'] * 100),
-                    0
-                ).round(2)
-                
-                class_search_data['classic_cr'] = np.where(
-                    class_search_data['clicks'] > 0,
-                    (class_search_data['conversions'] / class_search_data['clicks'] * 100),
-                    0
-                ).round(2)
-                
-                class_search_data = class_search_data.nlargest(15, 'Counts')
+                # ✅ Top 15 search terms of the selected class, already sorted by volume
+                class_search_data = matrix_data
                 
                 # CR selection
                 st.markdown("#### 📊 Chart Display Options")
@@ -12515,37 +14088,11 @@ with tab_class:
     )
     
     try:
-        # Vectorized keyword extraction
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def extract_class_keywords(df, cls_col, num_kw):
-            """Optimized keyword extraction with vectorization"""
-            rows = []
-            
-            for cls_name, grp in df.groupby(cls_col):
-                keyword_counts = {}
-                
-                for _, row in grp.iterrows():
-                    keywords_list = row['keywords']
-                    query_count = row['Counts']
-                    
-                    if isinstance(keywords_list, list):
-                        for keyword in keywords_list:
-                            keyword_counts[keyword] = keyword_counts.get(keyword, 0) + query_count
-                    elif pd.notna(keywords_list):
-                        search_term = row['normalized_query']
-                        if pd.notna(search_term):
-                            keywords = str(search_term).lower().split()
-                            for keyword in keywords:
-                                keyword_counts[keyword] = keyword_counts.get(keyword, 0) + query_count
-                
-                top_keywords = sorted(keyword_counts.items(), key=lambda x: x[1], reverse=True)[:num_kw]
-                
-                for keyword, count in top_keywords:
-                    rows.append({'class': cls_name, 'keyword': keyword, 'count': count})
-            
-            return pd.DataFrame(rows)
-        
-        df_ckw = extract_class_keywords(class_queries, class_column, num_keywords)
+        # Vectorized keyword extraction (shared top-k per group engine)
+        df_ckw = compute_top_keywords_per_group(
+            class_queries, class_column, num_keywords,
+            get_filter_fingerprint(class_queries), _base_df=queries
+        )[['group', 'keyword', 'count']].rename(columns={'group': 'class'})
         
         if not df_ckw.empty:
             pivot_ckw = df_ckw.pivot_table(index='class', columns='keyword', values='count', fill_value=0)
@@ -12808,8 +14355,8 @@ with tab_generic:
         
         # ✅ PRE-CALCULATE ALL METRICS ONCE (WITH TOTAL CTR & CR)
         @st.cache_data(ttl=1800, show_spinner=False)
-        def calculate_summary_metrics(data):
-            """Vectorized summary metrics calculation"""
+        def calculate_summary_metrics(data, concentration):
+            """Vectorized summary metrics calculation (concentration: row of the shared concentration table)"""
             total_count = data['count'].sum()
             total_clicks = data['Clicks'].sum()
             total_conversions = data['Conversions'].sum()
@@ -12819,14 +14366,6 @@ with tab_generic:
             total_cr = (total_conversions / total_count * 100) if total_count > 0 else 0
             total_classic_cr = (total_conversions / total_clicks * 100) if total_clicks > 0 else 0
             
-            # Vectorized calculations for concentration metrics
-            sorted_counts = np.sort(data['count'].values)
-            cumsum_counts = np.cumsum(sorted_counts)
-            n = len(sorted_counts)
-            
-            gini_coefficient = 1 - 2 * np.sum(cumsum_counts) / (n * total_count) if total_count > 0 else 0
-            herfindahl_index = np.sum((data['count'] / total_count) ** 2) if total_count > 0 else 0
-            
             return {
                 'total_generic_terms': len(data),
                 'total_searches': int(total_count),
@@ -12835,16 +14374,25 @@ with tab_generic:
                 'total_ctr': float(total_ctr),  # ✅ Changed from avg_ctr
                 'total_cr': float(total_cr),    # ✅ Changed from avg_cr
                 'total_classic_cr': float(total_classic_cr),  # ✅ Added
-                'gini_coefficient': float(gini_coefficient),
-                'herfindahl_index': float(herfindahl_index),
-                'top_5_concentration': float(data.head(5)['count'].sum() / total_count * 100) if total_count > 0 else 0,
-                'top_10_concentration': float(data.head(10)['count'].sum() / total_count * 100) if total_count > 0 else 0,
+                'gini_coefficient': float(concentration.get('gini', 0.0)),
+                'herfindahl_index': float(concentration.get('hhi', 0.0)),
+                'top_5_concentration': float(concentration.get('top_5_share', 0.0)),
+                'top_10_concentration': float(concentration.get('top_10_share', 0.0)),
                 'top_generic_term': data.iloc[0]['search'] if len(data) > 0 else 'N/A',
                 'top_generic_volume': int(data.iloc[0]['count']) if len(data) > 0 else 0,
                 'top_conversion_generic': data.nlargest(1, 'Conversions')['search'].iloc[0] if len(data) > 0 else 'N/A'
             }
         
-        metrics = calculate_summary_metrics(gt_agg)
+        generic_concentration_col = 'normalized_query' if 'normalized_query' in generic_type.columns else 'search'
+        generic_concentration = concentration_metrics(
+            compute_concentration_table(
+                generic_type, get_filter_fingerprint(generic_type),
+                dimensions={generic_concentration_col: 'Generic Term'},
+                metric_col='count' if 'count' in generic_type.columns else 'Counts', excluded_labels=('',)
+            ),
+            generic_concentration_col
+        )
+        metrics = calculate_summary_metrics(gt_agg, generic_concentration)
         
         # ✅ LOAD CSS ONCE PER SESSION
         if 'generic_css_loaded' not in st.session_state:
@@ -12996,79 +14544,15 @@ with tab_generic:
             generic_type_with_month['start_date'] = pd.to_datetime(generic_type_with_month['start_date'])
             generic_type_with_month['month'] = generic_type_with_month['start_date'].dt.to_period('M').astype(str)
         
-        # Compute monthly data
-        filter_key = f"{generic_type_with_month.shape}_{num_generic_terms}_{hash(str(gt_agg['search'].tolist()[:5]))}"
-        
-        @st.cache_data(ttl=1800, show_spinner=False, max_entries=5)
-        def compute_generic_monthly(df, gt_df, month_dict, num_terms, cache_key):
-            """Optimized monthly generic calculation"""
-            if df.empty or gt_df.empty:
-                return pd.DataFrame(), []
-            
-            top_generics = gt_df.nlargest(num_terms, 'count')['search'].tolist()
-            top_data = df[df['search'].isin(top_generics)].copy()
-            
-            if 'month' not in top_data.columns:
-                return pd.DataFrame(), []
-            
-            unique_months = sorted(top_data['month'].dropna().unique(), key=lambda x: pd.to_datetime(x))
-            
-            # Vectorized groupby
-            grouped = top_data.groupby(['search', 'month'], as_index=False).agg({
-                'count': 'sum',
-                'Clicks': 'sum',
-                'Conversions': 'sum'
-            })
-            
-            grouped['ctr'] = np.where(grouped['count'] > 0, (grouped['Clicks'] / grouped['count'] * 100), 0)
-            grouped['cr'] = np.where(grouped['count'] > 0, (grouped['Conversions'] / grouped['count'] * 100), 0)
-            
-            # Build result
-            result_rows = []
-            dataset_total = df['count'].sum()
-            
-            for generic_term in top_generics:
-                generic_total = gt_df[gt_df['search'] == generic_term]
-                if generic_total.empty:
-                    continue
-                
-                gt_row = generic_total.iloc[0]
-                share_pct = (gt_row['count'] / dataset_total * 100) if dataset_total > 0 else 0
-                
-                row = {
-                    'Generic Term': generic_term,
-                    'Total Volume': int(gt_row['count']),
-                    'Share %': share_pct,
-                    'Overall CTR': gt_row['ctr'],
-                    'Overall CR': gt_row['conversion_rate'],
-                    'Total Clicks': int(gt_row['Clicks']),
-                    'Total Conversions': int(gt_row['Conversions'])
-                }
-                
-                # Add monthly data
-                generic_monthly = grouped[grouped['search'] == generic_term]
-                for month in unique_months:
-                    month_display = month_dict.get(month, month)
-                    month_row = generic_monthly[generic_monthly['month'] == month]
-                    
-                    if not month_row.empty:
-                        mr = month_row.iloc[0]
-                        row[f'{month_display} Vol'] = int(mr['count'])
-                        row[f'{month_display} CTR'] = mr['ctr']
-                        row[f'{month_display} CR'] = mr['cr']
-                    else:
-                        row[f'{month_display} Vol'] = 0
-                        row[f'{month_display} CTR'] = 0
-                        row[f'{month_display} CR'] = 0
-                
-                result_rows.append(row)
-            
-            result_df = pd.DataFrame(result_rows)
-            result_df = result_df.sort_values('Total Volume', ascending=False).reset_index(drop=True)
-            return result_df[result_df['Total Volume'] > 0], unique_months
-        
-        top_generics_monthly, unique_months_gen = compute_generic_monthly(
-            generic_type_with_month, gt_agg, month_names, num_generic_terms, filter_key
+        # ✅ Shared entity × month builder: one grouped pass + unstack
+        # (generic rows come straight from queries, so accept both metric naming schemes)
+        generic_metric_cols = (('count', 'Clicks', 'Conversions') if 'count' in generic_type_with_month.columns
+                               else tuple(METRIC_COLS))
+        generic_totals = tuple(int(generic_type_with_month[c].sum()) for c in generic_metric_cols)
+        filter_key = f"{get_filter_fingerprint(generic_type_with_month)}_{hash(generic_totals)}_{num_generic_terms}"
+        top_generics_monthly, unique_months_gen = build_entity_month_table(
+            generic_type_with_month, 'search', month_names, num_generic_terms, filter_key,
+            entity_label='Generic Term', metric_cols=generic_metric_cols
         )
         
         if not top_generics_monthly.empty:
@@ -13368,6 +14852,11 @@ with tab_generic:
                 options=gt_agg['search'].tolist(),
                 index=0
             )
+            prefetch_generics = st.checkbox(
+                "⚡ Prefetch the next terms in the background",
+                value=True,
+                key="generic_deep_dive_prefetch"
+            )
             
             if selected_generic:
                 generic_data = gt_agg[gt_agg['search'] == selected_generic].iloc[0]
@@ -13515,19 +15004,62 @@ with tab_generic:
                 
                 fig_radar = create_radar(generic_data, selected_generic, max_values)
                 st.plotly_chart(fig_radar, use_container_width=True)
+                
+                # ✅ Monthly breakdown from the per-entity LRU (next terms by volume prefetched)
+                generic_term_col = 'normalized_query' if 'normalized_query' in generic_type.columns else 'search'
+                generic_order = gt_agg['search'].tolist()  # generic_rank is also the next term's position
+                generic_deep_dive = get_entity_deep_dive(
+                    generic_type, 'generic', generic_term_col, selected_generic,
+                    get_filter_fingerprint(generic_type),
+                    metric_cols=('count', 'Clicks', 'Conversions') if 'count' in generic_type.columns else tuple(METRIC_COLS),
+                    prefetch=generic_order[generic_rank:generic_rank + DEEP_DIVE_PREFETCH_COUNT] if prefetch_generics else ()
+                )
+                
+                generic_monthly = generic_deep_dive.get('monthly', pd.DataFrame())
+                if len(generic_monthly) > 1:
+                    st.markdown("### 📅 Monthly Trend")
+                    vol_col = generic_monthly.columns[1]
+                    fig_generic_month = px.line(
+                        generic_monthly,
+                        x='month',
+                        y=vol_col,
+                        markers=True,
+                        title=f'<b style="color:#2E7D32;">Monthly Search Volume - {selected_generic}</b>',
+                        labels={vol_col: 'Search Volume', 'month': 'Month'},
+                        hover_data={'ctr': ':.1f', 'cr': ':.1f'}
+                    )
+                    fig_generic_month.update_traces(line_color='#4CAF50')
+                    fig_generic_month.update_layout(
+                        plot_bgcolor='rgba(248,255,248,0.95)',
+                        paper_bgcolor='rgba(232,245,232,0.8)',
+                        font=dict(color='#1B5E20', family='Segoe UI'),
+                        height=400
+                    )
+                    st.plotly_chart(fig_generic_month, use_container_width=True)
         
         elif analysis_type == "📈 Performance Comparison":
             st.subheader("⚖️ Generic Terms Performance Comparison")
             
             selected_generics = st.multiselect(
-                "Select generic terms to compare (max 10):",
+                "Select generic terms to compare (max 20):",
                 options=gt_agg['search'].tolist(),
                 default=gt_agg['search'].head(5).tolist(),
-                max_selections=10
+                max_selections=20
             )
             
             if selected_generics:
-                comparison_data = gt_agg[gt_agg['search'].isin(selected_generics)].copy()
+                # ✅ One grouped pass for all selected terms (summary + monthly series)
+                generic_term_col = 'normalized_query' if 'normalized_query' in generic_type.columns else 'search'
+                generic_metric_cols = ('count', 'Clicks', 'Conversions') if 'count' in generic_type.columns else tuple(METRIC_COLS)
+                generic_comparison = compare_entities(
+                    generic_type, generic_term_col, tuple(selected_generics),
+                    get_filter_fingerprint(generic_type), metric_cols=generic_metric_cols
+                )
+                generic_comparison_names = {
+                    generic_term_col: 'search', 'cr': 'conversion_rate', 'classic_cr': 'classic_cvr',
+                    **dict(zip(generic_metric_cols, ('count', 'Clicks', 'Conversions')))
+                }
+                comparison_data = generic_comparison['summary'].rename(columns=generic_comparison_names)
                 
                 @st.cache_data(show_spinner=False)
                 def create_comparison(data):
@@ -13559,6 +15091,28 @@ with tab_generic:
                 fig_comparison = create_comparison(comparison_data)
                 st.plotly_chart(fig_comparison, use_container_width=True)
                 
+                # Monthly series from the same comparison pass
+                generic_comparison_monthly = generic_comparison['monthly'].rename(columns=generic_comparison_names)
+                if generic_comparison_monthly['month'].nunique() > 1:
+                    st.markdown("### 📅 Monthly Volume Comparison")
+                    
+                    fig_generic_monthly = px.line(
+                        generic_comparison_monthly,
+                        x='month',
+                        y='count',
+                        color='search',
+                        markers=True,
+                        title='<b style="color:#2E7D32;"> Monthly Search Volume by Generic Term</b>',
+                        labels={'count': 'Search Volume', 'month': 'Month', 'search': 'Generic Term'}
+                    )
+                    fig_generic_monthly.update_layout(
+                        plot_bgcolor='rgba(248,255,248,0.95)',
+                        paper_bgcolor='rgba(232,245,232,0.8)',
+                        font=dict(color='#1B5E20', family='Segoe UI'),
+                        height=450
+                    )
+                    st.plotly_chart(fig_generic_monthly, use_container_width=True)
+                
                 # Comparison table
                 st.markdown("### 📊 Detailed Comparison Table")
                 
@@ -13571,6 +15125,8 @@ with tab_generic:
                     comparison_table[col] = comparison_table[col].apply(lambda x: format_number(int(x)))
                 for col in ['CTR %', 'Conversion Rate %', 'Click Share %', 'Conversion Share %']:
                     comparison_table[col] = comparison_table[col].apply(lambda x: f"{x:.1f}%")
+                # 95% intervals + z-test flags vs the rest of the generic terms
+                comparison_table = pd.concat([comparison_table, significance_display_columns(comparison_data)], axis=1)
                 
                 display_styled_table(
                     df=comparison_table,
@@ -14001,18 +15557,32 @@ Generated by Generic Terms Analysis Dashboard
                 display_filtered = filtered_data[['search', 'count', 'Clicks', 'Conversions', 'ctr', 'conversion_rate']].copy()
                 display_filtered.columns = ['Generic Term', 'Search Volume', 'Clicks', 'Conversions', 'CTR %', 'Conversion Rate %']
                 
-                # Optimized formatting
-                for col in ['Search Volume', 'Clicks', 'Conversions']:
-                    display_filtered[col] = display_filtered[col].apply(lambda x: format_number(int(x)))
-                for col in ['CTR %', 'Conversion Rate %']:
-                    display_filtered[col] = display_filtered[col].apply(lambda x: f"{x:.1f}%")
-                
-                display_styled_table(
-                    df=display_filtered,
-                    align="center",
-                    scrollable=True,
-                    max_height="600px"
-                )
+                if len(display_filtered) > PAGED_TABLE_THRESHOLD:
+                    # Long term lists stay numeric server-side; only the visible page gets formatted
+                    display_paged_table(
+                        display_filtered,
+                        key="filtered_generic_table",
+                        cache_key=f"generic_filtered_{get_filter_fingerprint(generic_type)}_"
+                                  f"{pd.util.hash_pandas_object(display_filtered, index=False).sum()}",
+                        formatters={
+                            **{col: (lambda x: format_number(int(x))) for col in ['Search Volume', 'Clicks', 'Conversions']},
+                            **{col: (lambda x: f"{x:.1f}%") for col in ['CTR %', 'Conversion Rate %']}
+                        },
+                        default_sort='Search Volume'
+                    )
+                else:
+                    # Optimized formatting
+                    for col in ['Search Volume', 'Clicks', 'Conversions']:
+                        display_filtered[col] = display_filtered[col].apply(lambda x: format_number(int(x)))
+                    for col in ['CTR %', 'Conversion Rate %']:
+                        display_filtered[col] = display_filtered[col].apply(lambda x: f"{x:.1f}%")
+                    
+                    display_styled_table(
+                        df=display_filtered,
+                        align="center",
+                        scrollable=True,
+                        max_height="600px"
+                    )
                 
                 # Download filtered data
                 filtered_csv = filtered_data.to_csv(index=False)
@@ -14120,6 +15690,8 @@ with tab_time:
         
         # ✅ CACHED MONTHLY CALCULATIONS
         time_cache_key = f"{queries_clean.shape}_{hash(str(queries_clean['month'].tolist()[:5]))}_{st.session_state.get('filters_applied', False)}"
+        # Content-based key for the shared engines that take an unhashed _df
+        time_fingerprint = f"time_{get_filter_fingerprint(queries_clean)}"
         
         @st.cache_data(ttl=1800, show_spinner=False, max_entries=5)
         def compute_monthly_metrics(df, cache_key):
@@ -14155,30 +15727,11 @@ with tab_time:
         
         monthly, total_clicks, total_conversions = compute_monthly_metrics(queries_clean, time_cache_key)
         
-        # ✅ FAST DISTRIBUTION CALCULATIONS
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_distribution_metrics(monthly_df, cache_key):
-            """Vectorized distribution calculations"""
-            if monthly_df.empty:
-                return 0.0, 0.0
-            
-            # Gini coefficient
-            sorted_counts = monthly_df['Counts'].sort_values().values
-            n = len(sorted_counts)
-            total = sorted_counts.sum()
-            
-            if total == 0:
-                return 0.0, 0.0
-            
-            cumsum = np.cumsum(sorted_counts)
-            gini = 1 - 2 * np.sum(cumsum) / (n * total)
-            
-            # Top 3 concentration
-            top_3_conc = monthly_df.nlargest(3, 'Counts')['Counts'].sum() / total * 100
-            
-            return float(gini), float(top_3_conc)
-        
-        gini_coefficient, top_3_concentration = compute_distribution_metrics(monthly, time_cache_key)
+        # ✅ CONCENTRATION TABLE (every dimension × month in one pass; the Month row feeds the cards)
+        concentration_table = compute_concentration_table(queries_clean, time_fingerprint)
+        month_concentration = concentration_metrics(concentration_table, 'month')
+        gini_coefficient = float(month_concentration.get('gini', 0.0))
+        top_3_concentration = float(month_concentration.get('top_3_share', 0.0))
         
         # ✅ PRE-CALCULATED SUMMARY METRICS
         summary_metrics = {
@@ -14250,23 +15803,37 @@ with tab_time:
         
         analysis_type = st.radio(
             "Choose Analysis Type:",
-            ["📊 Trends Overview", "🔍 Detailed Month Analysis", "🏷 Brand Comparison", "📊 Distribution Analysis"],
+            ["📊 Trends Overview", "🔍 Detailed Month Analysis", "🏷 Brand Comparison", "🔁 Period Comparison", "🚨 Movers & Anomalies", "🔮 Forecast", "📊 Distribution Analysis"],
             horizontal=True,
             key="temporal_analysis_type_radio"
         )
         
         if analysis_type == "📊 Trends Overview":
-            st.subheader("📈 Monthly Trends")
+            # ✅ Day-level cube built once; granularity switch only re-buckets it
+            time_buckets = build_time_buckets(
+                queries_clean, time_fingerprint, entity_cols=('brand',) if 'brand' in queries_clean.columns else ()
+            ) if 'Date' in queries_clean.columns else None
+            granularity_options = time_buckets['granularities'] if time_buckets is not None else ['Monthly']
+            granularity = st.radio(
+                "Granularity:",
+                granularity_options,
+                index=len(granularity_options) - 1,
+                horizontal=True,
+                key="time_granularity"
+            )
+            period_label = {'Daily': 'Day', 'Weekly': 'Week', 'Monthly': 'Month'}[granularity]
+            
+            st.subheader(f"📈 {granularity} Trends")
             
             # ✅ CACHED CHART CREATION
             @st.cache_data(ttl=1800, show_spinner=False)
-            def create_trends_charts(monthly_df, cache_key):
+            def create_trends_charts(monthly_df, cache_key, granularity='Monthly', period_label='Month'):
                 """Pre-built chart configurations"""
                 # Volume line chart
                 fig_counts = px.line(
                     monthly_df, x='month', y='Counts',
-                    title='<b style="color:#2E7D32;">🌿 Monthly Search Volume</b>',
-                    labels={'Counts': 'Search Volume', 'month': 'Month'},
+                    title=f'<b style="color:#2E7D32;">🌿 {granularity} Search Volume</b>',
+                    labels={'Counts': 'Search Volume', 'month': period_label},
                     color_discrete_sequence=['#4CAF50']
                 )
                 fig_counts.update_traces(line=dict(width=3), mode='lines+markers')
@@ -14296,20 +15863,50 @@ with tab_time:
                     mode='lines+markers'
                 ))
                 fig_metrics.update_layout(
-                    title='<b style="color:#2E7D32;">🌿 Monthly CTR and Conversion Rate Trends</b>',
+                    title=f'<b style="color:#2E7D32;">🌿 {granularity} CTR and Conversion Rate Trends</b>',
                     plot_bgcolor='rgba(248,255,248,0.95)',
                     paper_bgcolor='rgba(232,245,232,0.8)',
                     font=dict(color='#1B5E20', family='Segoe UI'),
                     height=400,
-                    xaxis=dict(tickangle=45, title='Month'),
+                    xaxis=dict(tickangle=45, title=period_label),
                     yaxis=dict(title='Percentage (%)')
                 )
                 
                 return fig_counts, fig_metrics
             
-            fig_counts, fig_metrics = create_trends_charts(monthly, time_cache_key)
+            if granularity == 'Monthly' or time_buckets is None:
+                trend_df = monthly
+            else:
+                trend_df = resample_time_series(time_buckets, granularity).rename(columns={'cr': 'conversion_rate'})
+                trend_df['month'] = trend_df['period'].dt.strftime('%d %b %Y')
+            
+            fig_counts, fig_metrics = create_trends_charts(trend_df, time_cache_key, granularity, period_label)
             st.plotly_chart(fig_counts, use_container_width=True)
             st.plotly_chart(fig_metrics, use_container_width=True)
+            
+            # Top brands at the same granularity (per-entity series from the same cube)
+            if time_buckets is not None and 'brand' in time_buckets['entity_daily']:
+                brand_cube = time_buckets['entity_daily']['brand']
+                brand_volume = pd.Series(
+                    np.bincount(brand_cube['entity'], weights=brand_cube['sums'][:, 0], minlength=len(brand_cube['entities'])),
+                    index=brand_cube['entities']
+                )
+                brand_volume = brand_volume[~brand_volume.index.astype(str).str.lower().isin(['other', 'nan', 'none', ''])]
+                trend_brands = brand_volume.nlargest(5).index.tolist()
+                if trend_brands:
+                    brand_series = resample_time_series(time_buckets, granularity, 'brand', trend_brands).sort_values('period')
+                    fig_brand_trend = px.line(
+                        brand_series, x='period', y='Counts', color='brand', markers=True,
+                        title=f'<b style="color:#2E7D32;">🌿 {granularity} Search Volume - Top 5 Brands</b>',
+                        labels={'Counts': 'Search Volume', 'period': period_label, 'brand': 'Brand'}
+                    )
+                    fig_brand_trend.update_layout(
+                        plot_bgcolor='rgba(248,255,248,0.95)',
+                        paper_bgcolor='rgba(232,245,232,0.8)',
+                        font=dict(color='#1B5E20', family='Segoe UI'),
+                        height=400
+                    )
+                    st.plotly_chart(fig_brand_trend, use_container_width=True)
         
         elif analysis_type == "🔍 Detailed Month Analysis":
             st.subheader("🔬 Detailed Monthly Performance")
@@ -14510,6 +16107,420 @@ with tab_time:
             else:
                 st.info("Brand or month data not available for brand-month analysis.")
         
+        elif analysis_type == "🔁 Period Comparison":
+            st.subheader("🔁 Period-over-Period Comparison")
+            
+            if 'Date' in queries_clean.columns and queries_clean['Date'].notna().any():
+                period_dimensions = {
+                    'normalized_query': 'Search Query', 'brand': 'Brand', 'department': 'Department',
+                    'category': 'Category', 'sub_category': 'Subcategory', 'Class': 'Class'
+                }
+                period_dimensions = {col: label for col, label in period_dimensions.items() if col in queries_clean.columns}
+                
+                col_mode, col_dim = st.columns(2)
+                with col_mode:
+                    period_mode = st.radio(
+                        "Compare:",
+                        ["Month vs Month", "Custom Range vs Previous Period"],
+                        horizontal=True,
+                        key="period_compare_mode"
+                    )
+                with col_dim:
+                    period_dim = st.selectbox(
+                        "Compare by:",
+                        options=list(period_dimensions),
+                        format_func=period_dimensions.get,
+                        key="period_compare_dimension"
+                    )
+                
+                if period_mode == "Month vs Month":
+                    month_options = sort_month_keys(queries_clean['month'].dropna().unique())
+                    col_month_a, col_month_b = st.columns(2)
+                    with col_month_a:
+                        month_a = st.selectbox("Baseline month:", month_options, index=max(len(month_options) - 2, 0), key="period_compare_month_a")
+                    with col_month_b:
+                        month_b = st.selectbox("Comparison month:", month_options, index=len(month_options) - 1, key="period_compare_month_b")
+                    period_a, period_b = month_period(month_a), month_period(month_b)
+                    label_a, label_b = month_a, month_b
+                else:
+                    min_day = queries_clean['Date'].min().date()
+                    max_day = queries_clean['Date'].max().date()
+                    default_start = max(min_day, max_day - pd.Timedelta(days=29))
+                    picked_range = st.date_input(
+                        "Comparison range:",
+                        value=(default_start, max_day),
+                        min_value=min_day,
+                        max_value=max_day,
+                        key="period_compare_range"
+                    )
+                    if not isinstance(picked_range, (tuple, list)) or len(picked_range) != 2:
+                        picked_range = (picked_range[0] if isinstance(picked_range, (tuple, list)) else picked_range,) * 2
+                    period_b = (pd.Timestamp(picked_range[0]), pd.Timestamp(picked_range[1]))
+                    period_a = previous_period(*period_b)
+                    label_a = f"{period_a[0]:%d %b %Y} – {period_a[1]:%d %b %Y}"
+                    label_b = f"{period_b[0]:%d %b %Y} – {period_b[1]:%d %b %Y}"
+                
+                col_min, col_top = st.columns(2)
+                with col_min:
+                    period_min_volume = st.number_input(
+                        "Minimum volume (either period) for movers:",
+                        min_value=0, value=100, step=50,
+                        key="period_compare_min_volume"
+                    )
+                with col_top:
+                    period_top_n = st.slider("Movers to show:", min_value=5, max_value=50, value=15, step=5, key="period_compare_top_n")
+                
+                period_result = compute_period_diff(
+                    queries_clean, period_dim,
+                    (period_a[0], period_a[1]), (period_b[0], period_b[1]),
+                    time_fingerprint
+                )
+                period_diff = period_result['diff']
+                period_totals = period_result['totals']
+                
+                # ✅ PERIOD TOTALS
+                col_p1, col_p2, col_p3, col_p4 = st.columns(4)
+                volume_pct = period_totals['delta_volume_pct']
+                period_cards = [
+                    (col_p1, '🔍', format_number(period_totals['Counts_b']),
+                     'Search Volume', f"{label_a}: {format_number(period_totals['Counts_a'])}",
+                     f"{volume_pct:+.1f}%" if pd.notna(volume_pct) else "New", pd.isna(volume_pct) or volume_pct >= 0),
+                    (col_p2, '📈', f"{period_totals['ctr_b']:.1f}%",
+                     'CTR', f"{label_a}: {period_totals['ctr_a']:.1f}%",
+                     f"{period_totals['delta_ctr']:+.2f} pp", period_totals['delta_ctr'] >= 0),
+                    (col_p3, '💚', f"{period_totals['cr_b']:.1f}%",
+                     'Conversion Rate', f"{label_a}: {period_totals['cr_a']:.1f}%",
+                     f"{period_totals['delta_cr']:+.2f} pp", period_totals['delta_cr'] >= 0),
+                    (col_p4, '🎯', format_number(period_totals['conversions_b']),
+                     'Conversions', f"{label_a}: {format_number(period_totals['conversions_a'])}",
+                     f"{period_totals['delta_conversions']:+,}", period_totals['delta_conversions'] >= 0)
+                ]
+                for column, icon, value, label, sub_label, delta_text, is_up in period_cards:
+                    with column:
+                        delta_class = "high-time-performance" if is_up else "low-time-performance"
+                        st.markdown(f"""
+                        <div class='time-metric-card'>
+                            <span class='icon'>{icon}</span>
+                            <div class='value'>{value} <span class='time-performance-badge {delta_class}'>{delta_text}</span></div>
+                            <div class='label'>{label} ({label_b})</div>
+                            <div class='sub-label'>{sub_label}</div>
+                        </div>
+                        """, unsafe_allow_html=True)
+                
+                # ✅ BIGGEST MOVERS (all entities aligned; slices of the one diff table)
+                movers_pool = period_diff[np.maximum(period_diff['Counts_a'], period_diff['Counts_b']) >= period_min_volume]
+                dim_label = period_dimensions[period_dim]
+                
+                def format_movers(movers):
+                    table = pd.DataFrame({
+                        dim_label: movers[period_dim].astype(str),
+                        f'Volume ({label_a})': movers['Counts_a'].apply(format_number),
+                        f'Volume ({label_b})': movers['Counts_b'].apply(format_number),
+                        'Δ Volume': movers['delta_volume'].apply(lambda x: f"{x:+,}"),
+                        'Δ Volume %': movers['delta_volume_pct'].apply(lambda x: f"{x:+.1f}%" if pd.notna(x) else "New"),
+                        'CTR': [f"{a:.1f}% → {b:.1f}%" for a, b in zip(movers['ctr_a'], movers['ctr_b'])],
+                        'Δ CTR (pp)': movers['delta_ctr'].apply(lambda x: f"{x:+.2f}"),
+                        'CR': [f"{a:.1f}% → {b:.1f}%" for a, b in zip(movers['cr_a'], movers['cr_b'])],
+                        'Δ CR (pp)': movers['delta_cr'].apply(lambda x: f"{x:+.2f}")
+                    })
+                    return table
+                
+                if movers_pool.empty:
+                    st.info("No entities meet the minimum volume in either period.")
+                else:
+                    gainers = movers_pool.nlargest(period_top_n, 'delta_volume')
+                    decliners = movers_pool.nsmallest(period_top_n, 'delta_volume')
+                    
+                    movers_chart = pd.concat([gainers, decliners]).drop_duplicates(subset=[period_dim]).sort_values('delta_volume')
+                    fig_movers = px.bar(
+                        movers_chart,
+                        x='delta_volume',
+                        y=movers_chart[period_dim].astype(str),
+                        orientation='h',
+                        color='delta_volume',
+                        color_continuous_scale=['#E57373', '#F1F8E9', '#2E7D32'],
+                        color_continuous_midpoint=0,
+                        title=f'<b style="color:#2E7D32;">🔁 Biggest Volume Movers by {dim_label}: {label_a} → {label_b}</b>',
+                        labels={'delta_volume': 'Δ Search Volume', period_dim: dim_label}
+                    )
+                    fig_movers.update_layout(
+                        plot_bgcolor='rgba(248,255,248,0.95)',
+                        paper_bgcolor='rgba(232,245,232,0.8)',
+                        font=dict(color='#1B5E20', family='Segoe UI'),
+                        height=max(400, 22 * len(movers_chart)),
+                        showlegend=False
+                    )
+                    st.plotly_chart(fig_movers, use_container_width=True)
+                    
+                    col_gain, col_decline = st.columns(2)
+                    with col_gain:
+                        display_styled_table(df=format_movers(gainers), title="📈 Biggest Gainers (Volume)", align="center", scrollable=True, max_height="500px")
+                    with col_decline:
+                        display_styled_table(df=format_movers(decliners), title="📉 Biggest Decliners (Volume)", align="center", scrollable=True, max_height="500px")
+                    
+                    col_ctr_up, col_ctr_down = st.columns(2)
+                    with col_ctr_up:
+                        display_styled_table(df=format_movers(movers_pool.nlargest(period_top_n, 'delta_ctr')), title="⬆️ Biggest CTR Gains", align="center", scrollable=True, max_height="500px")
+                    with col_ctr_down:
+                        display_styled_table(df=format_movers(movers_pool.nsmallest(period_top_n, 'delta_ctr')), title="⬇️ Biggest CTR Drops", align="center", scrollable=True, max_height="500px")
+                
+                # Download
+                csv_period = period_diff.to_csv(index=False)
+                st.download_button(
+                    label="📥 Download Period Comparison CSV",
+                    data=csv_period,
+                    file_name=f"period_comparison_{period_dim}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                    mime="text/csv",
+                    key="period_comparison_download"
+                )
+            else:
+                st.info("Date information is not available for period comparison.")
+        
+        elif analysis_type == "🚨 Movers & Anomalies":
+            st.subheader("🚨 Month-over-Month Movers & Spikes")
+            
+            mover_dimensions = {
+                'normalized_query': 'Search Query', 'brand': 'Brand', 'department': 'Department',
+                'category': 'Category', 'sub_category': 'Subcategory', 'Class': 'Class'
+            }
+            mover_dimensions = {col: label for col, label in mover_dimensions.items() if col in queries_clean.columns}
+            
+            col_mdim, col_mmin, col_mtop = st.columns(3)
+            with col_mdim:
+                mover_dim = st.selectbox(
+                    "Detect movers by:",
+                    options=list(mover_dimensions),
+                    format_func=mover_dimensions.get,
+                    key="movers_dimension"
+                )
+            with col_mmin:
+                mover_min_volume = st.number_input(
+                    "Minimum monthly volume:",
+                    min_value=0, value=100, step=50,
+                    key="movers_min_volume"
+                )
+            with col_mtop:
+                mover_top_n = st.slider("Entities to show:", min_value=5, max_value=50, value=15, step=5, key="movers_top_n")
+            
+            movers, mover_months = detect_entity_movers(queries_clean, mover_dim, time_fingerprint, min_volume=mover_min_volume)
+            
+            if len(mover_months) < 2 or movers.empty:
+                st.info("At least two months of data are needed to detect movers.")
+            else:
+                mover_label = mover_dimensions[mover_dim]
+                risers = movers[movers['direction'] == 'Riser'].nlargest(mover_top_n, 'mom_z')
+                fallers = movers[movers['direction'] == 'Faller'].nsmallest(mover_top_n, 'mom_z')
+                # Same monthly meaning as risers / fallers: the spike month or its baseline clears the minimum
+                eligible = movers[np.maximum(movers['spike_volume'], movers['spike_baseline']) >= mover_min_volume]
+                spikes = eligible[np.abs(eligible['spike_z']) >= MOVER_Z_THRESHOLD]
+                spikes = spikes.loc[spikes['spike_z'].abs().nlargest(mover_top_n).index]
+                
+                col_m1, col_m2, col_m3 = st.columns(3)
+                mover_cards = [
+                    (col_m1, '📈', f"{(movers['direction'] == 'Riser').sum():,}", 'Significant Risers'),
+                    (col_m2, '📉', f"{(movers['direction'] == 'Faller').sum():,}", 'Significant Fallers'),
+                    (col_m3, '⚡', f"{(np.abs(eligible['spike_z']) >= MOVER_Z_THRESHOLD).sum():,}", 'Spiking Entities')
+                ]
+                for column, icon, value, label in mover_cards:
+                    with column:
+                        st.markdown(f"""
+                        <div class='time-metric-card'>
+                            <span class='icon'>{icon}</span>
+                            <div class='value'>{value}</div>
+                            <div class='label'>{label}</div>
+                            <div class='sub-label'>{mover_months[-2]} → {mover_months[-1]} | {len(movers):,} {mover_label.lower()} values scored</div>
+                        </div>
+                        """, unsafe_allow_html=True)
+                
+                def format_mover_rows(rows):
+                    return pd.DataFrame({
+                        mover_label: rows[mover_dim].astype(str),
+                        f'{mover_months[-2]}': rows['prev'].apply(format_number),
+                        f'{mover_months[-1]}': rows['last'].apply(format_number),
+                        'Δ Volume': rows['mom_change'].apply(lambda x: f"{x:+,}"),
+                        'Δ %': rows['mom_pct'].apply(lambda x: f"{x:+.1f}%" if pd.notna(x) else "New"),
+                        'Z-Score': rows['mom_z'].apply(lambda x: f"{x:+.1f}"),
+                        'Trend / Month': rows['trend_pct'].apply(lambda x: f"{x:+.1f}%"),
+                        'Biggest Spike': [f"{month} ({z:+.1f}σ)" for month, z in zip(rows['spike_month'], rows['spike_z'])]
+                    })
+                
+                col_rise, col_fall = st.columns(2)
+                with col_rise:
+                    if risers.empty:
+                        st.info("No significant risers.")
+                    else:
+                        display_styled_table(df=format_mover_rows(risers), title="📈 Top Risers", align="center", scrollable=True, max_height="500px")
+                with col_fall:
+                    if fallers.empty:
+                        st.info("No significant fallers.")
+                    else:
+                        display_styled_table(df=format_mover_rows(fallers), title="📉 Top Fallers", align="center", scrollable=True, max_height="500px")
+                
+                if len(mover_months) < MOVER_SPIKE_MIN_MONTHS:
+                    st.caption(f"⚡ Spike detection needs at least {MOVER_SPIKE_MIN_MONTHS} months of data.")
+                elif not spikes.empty:
+                    st.markdown("### ⚡ Biggest Spikes")
+                    fig_spikes = px.bar(
+                        spikes.sort_values('spike_z'),
+                        x='spike_z',
+                        y=spikes.sort_values('spike_z')[mover_dim].astype(str),
+                        orientation='h',
+                        color='spike_z',
+                        color_continuous_scale=['#E57373', '#F1F8E9', '#2E7D32'],
+                        color_continuous_midpoint=0,
+                        hover_data={'spike_month': True, 'spike_volume': ':,', 'total': ':,'},
+                        title=f'<b style="color:#2E7D32;">⚡ Largest Monthly Deviations by {mover_label}</b>',
+                        labels={'spike_z': 'Deviation (σ)', mover_dim: mover_label, 'spike_month': 'Month',
+                                'spike_volume': 'Month Volume', 'total': 'Total Volume'}
+                    )
+                    fig_spikes.update_layout(
+                        plot_bgcolor='rgba(248,255,248,0.95)',
+                        paper_bgcolor='rgba(232,245,232,0.8)',
+                        font=dict(color='#1B5E20', family='Segoe UI'),
+                        height=max(400, 24 * len(spikes)),
+                        showlegend=False
+                    )
+                    st.plotly_chart(fig_spikes, use_container_width=True)
+                
+                st.download_button(
+                    label="📥 Download Movers CSV",
+                    data=movers.to_csv(index=False),
+                    file_name=f"movers_{mover_dim}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                    mime="text/csv",
+                    key="movers_download"
+                )
+        
+        elif analysis_type == "🔮 Forecast":
+            st.subheader("🔮 Next-Month Volume Forecast")
+            
+            forecast_dimensions = {
+                'normalized_query': 'Search Query', 'brand': 'Brand', 'department': 'Department',
+                'category': 'Category', 'sub_category': 'Subcategory', 'Class': 'Class'
+            }
+            forecast_dimensions = {col: label for col, label in forecast_dimensions.items() if col in queries_clean.columns}
+            
+            col_fdim, col_fn, col_fh = st.columns(3)
+            with col_fdim:
+                forecast_dim = st.selectbox(
+                    "Forecast by:",
+                    options=list(forecast_dimensions),
+                    format_func=forecast_dimensions.get,
+                    key="forecast_dimension"
+                )
+            with col_fn:
+                forecast_top_n = st.select_slider(
+                    "Series to forecast (top by volume):",
+                    options=[50, 100, 200, 500, 1000, 2000, 5000],
+                    value=200,
+                    key="forecast_top_n"
+                )
+            with col_fh:
+                forecast_horizon = st.radio("Months ahead:", [1, 2, 3], horizontal=True, key="forecast_horizon")
+            
+            forecasts, forecast_history, forecast_months, forecast_future = forecast_entity_series(
+                queries_clean, forecast_dim, time_fingerprint, top_n=forecast_top_n, horizon=forecast_horizon
+            )
+            
+            if forecasts.empty:
+                st.info("At least three months of data are needed to forecast.")
+            else:
+                forecast_label = forecast_dimensions[forecast_dim]
+                intervals_approx = bool(forecasts['interval_approx'].iloc[0])
+                if intervals_approx:
+                    st.caption(f"⚠️ Only {len(forecast_months)} months of history: intervals and MAPE rest on "
+                               f"{len(forecast_months) - 2} one-step error(s) per series and are approximate "
+                               f"(reliable from {FORECAST_MIN_INTERVAL_MONTHS} months).")
+                next_total = forecasts['forecast_1'].sum()
+                last_total = forecasts['last'].sum()
+                
+                col_f1, col_f2, col_f3 = st.columns(3)
+                forecast_cards = [
+                    (col_f1, '🔮', format_number(int(round(next_total))), f'Forecast {forecast_future[0]}',
+                     f"{len(forecasts):,} {forecast_label.lower()} series | {forecasts['model'].iloc[0]}"),
+                    (col_f2, '📊', f"{(next_total - last_total) / last_total * 100:+.1f}%" if last_total > 0 else "N/A",
+                     'Change vs Last Month', f"{forecast_months[-1]}: {format_number(int(last_total))}"),
+                    (col_f3, '🎯', f"{forecasts['mape'].median():.1f}%", 'Median Fit Error (MAPE)',
+                     'One-step in-sample error')
+                ]
+                for column, icon, value, label, sub_label in forecast_cards:
+                    with column:
+                        st.markdown(f"""
+                        <div class='time-metric-card'>
+                            <span class='icon'>{icon}</span>
+                            <div class='value'>{value}</div>
+                            <div class='label'>{label}</div>
+                            <div class='sub-label'>{sub_label}</div>
+                        </div>
+                        """, unsafe_allow_html=True)
+                
+                # History + forecast with interval for one series
+                forecast_entity = st.selectbox(
+                    f"{forecast_label} to chart:",
+                    options=forecasts[forecast_dim].tolist(),
+                    key="forecast_entity"
+                )
+                entity_pos = forecasts.index[forecasts[forecast_dim] == forecast_entity][0]
+                entity_forecast = forecasts.loc[entity_pos]
+                steps = range(1, forecast_horizon + 1)
+                
+                fig_forecast = go.Figure()
+                fig_forecast.add_trace(go.Scatter(
+                    x=forecast_months, y=forecast_history.loc[entity_pos, forecast_months].to_numpy(),
+                    name='Actual', mode='lines+markers', line=dict(color='#2E7D32', width=3)
+                ))
+                forecast_x = [forecast_months[-1]] + forecast_future
+                fig_forecast.add_trace(go.Scatter(
+                    x=forecast_x + forecast_x[::-1],
+                    y=[entity_forecast['last']] + [entity_forecast[f'upper_{k}'] for k in steps]
+                      + [entity_forecast[f'lower_{k}'] for k in reversed(steps)] + [entity_forecast['last']],
+                    fill='toself', fillcolor='rgba(129,199,132,0.3)', line=dict(color='rgba(0,0,0,0)'),
+                    name='~95% Interval (approximate)' if intervals_approx else '95% Interval', hoverinfo='skip'
+                ))
+                fig_forecast.add_trace(go.Scatter(
+                    x=forecast_x, y=[entity_forecast['last']] + [entity_forecast[f'forecast_{k}'] for k in steps],
+                    name='Forecast', mode='lines+markers', line=dict(color='#66BB6A', width=3, dash='dash')
+                ))
+                fig_forecast.update_layout(
+                    title=f'<b style="color:#2E7D32;">🔮 Search Volume Forecast - {forecast_entity}</b>',
+                    plot_bgcolor='rgba(248,255,248,0.95)',
+                    paper_bgcolor='rgba(232,245,232,0.8)',
+                    font=dict(color='#1B5E20', family='Segoe UI'),
+                    height=450,
+                    xaxis=dict(title='Month', tickangle=45),
+                    yaxis=dict(title='Search Volume')
+                )
+                st.plotly_chart(fig_forecast, use_container_width=True)
+                
+                # Forecast table (top 50 by forecast volume)
+                top_forecasts = forecasts.nlargest(50, 'forecast_1')
+                forecast_table = pd.DataFrame({
+                    forecast_label: top_forecasts[forecast_dim].astype(str),
+                    f'{forecast_months[-1]} (Actual)': top_forecasts['last'].apply(format_number)
+                })
+                for k, month_name in zip(steps, forecast_future):
+                    forecast_table[f'{month_name} Forecast'] = [
+                        f"{format_number(int(round(point)))} ({format_number(int(round(low)))}–{format_number(int(round(high)))})"
+                        for point, low, high in zip(top_forecasts[f'forecast_{k}'], top_forecasts[f'lower_{k}'], top_forecasts[f'upper_{k}'])
+                    ]
+                forecast_table['Change %'] = top_forecasts['change_pct'].apply(lambda x: f"{x:+.1f}%" if pd.notna(x) else "New")
+                forecast_table['MAPE'] = top_forecasts['mape'].apply(lambda x: f"{x:.1f}%" + (" (approx.)" if intervals_approx else ""))
+                
+                display_styled_table(
+                    df=forecast_table,
+                    title=f"🔮 Top {len(forecast_table)} {forecast_label} Forecasts",
+                    align="center",
+                    scrollable=True,
+                    max_height="600px"
+                )
+                
+                st.download_button(
+                    label="📥 Download Forecasts CSV",
+                    data=forecasts.to_csv(index=False),
+                    file_name=f"forecast_{forecast_dim}_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                    mime="text/csv",
+                    key="forecast_download"
+                )
+        
         elif analysis_type == "📊 Distribution Analysis":
             st.subheader("📊 Monthly Distribution Analysis")
             
@@ -14556,6 +16567,61 @@ with tab_time:
                     <div class='sub-label'>Search volume concentration</div>
                 </div>
                 """, unsafe_allow_html=True)
+            
+            # Concentration of volume inside every dimension (same table as the cards above)
+            st.markdown("### 🎯 Concentration by Dimension")
+            
+            dimension_concentration = concentration_table[
+                (concentration_table['month'] == 'All') & (concentration_table['column'] != 'month')
+            ] if not concentration_table.empty else concentration_table
+            
+            if not dimension_concentration.empty:
+                concentration_display = pd.DataFrame({
+                    'Dimension': dimension_concentration['dimension'],
+                    'Entities': dimension_concentration['n_entities'].apply(lambda x: f"{int(x):,}"),
+                    'Gini': dimension_concentration['gini'].apply(lambda x: f"{x:.3f}"),
+                    'HHI': dimension_concentration['hhi'].apply(lambda x: f"{x:.4f}"),
+                    'Top 1 Share': dimension_concentration['top_1_share'].apply(lambda x: f"{x:.1f}%"),
+                    'Top 5 Share': dimension_concentration['top_5_share'].apply(lambda x: f"{x:.1f}%"),
+                    'Top 10 Share': dimension_concentration['top_10_share'].apply(lambda x: f"{x:.1f}%"),
+                    '80% of Volume': [f"{int(count):,} ({pct:.1f}%)" for count, pct in
+                                      zip(dimension_concentration['pareto_count'], dimension_concentration['pareto_pct'])]
+                })
+                display_styled_table(df=concentration_display, align="center")
+                
+                monthly_concentration = concentration_table[
+                    (concentration_table['month'] != 'All') & (concentration_table['column'] != 'month')
+                ]
+                if monthly_concentration['month'].nunique() > 1:
+                    concentration_metric = st.radio(
+                        "Concentration trend metric:",
+                        ['gini', 'hhi', 'top_5_share'],
+                        format_func={'gini': 'Gini', 'hhi': 'HHI', 'top_5_share': 'Top 5 Share %'}.get,
+                        horizontal=True,
+                        key="concentration_trend_metric"
+                    )
+                    month_order = sort_month_keys(monthly_concentration['month'].unique())
+                    fig_concentration = px.line(
+                        monthly_concentration, x='month', y=concentration_metric, color='dimension', markers=True,
+                        category_orders={'month': month_order},
+                        title='<b style="color:#2E7D32;">🌿 Monthly Concentration by Dimension</b>',
+                        labels={'month': 'Month', 'dimension': 'Dimension', concentration_metric: concentration_metric.replace('_', ' ').title()}
+                    )
+                    fig_concentration.update_layout(
+                        plot_bgcolor='rgba(248,255,248,0.95)',
+                        paper_bgcolor='rgba(232,245,232,0.8)',
+                        font=dict(color='#1B5E20', family='Segoe UI'),
+                        height=400
+                    )
+                    st.plotly_chart(fig_concentration, use_container_width=True)
+                
+                st.download_button(
+                    label="📥 Download Concentration Table CSV",
+                    data=concentration_table.to_csv(index=False),
+                    file_name=f"concentration_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                    mime="text/csv",
+                    key="concentration_download"
+                )
         
         # ✅ ADVANCED FILTERING SECTION
         st.markdown("---")
@@ -14930,6 +16996,7 @@ with tab_pivot:
             return pv_top
         
         pv_top = generate_brand_query_pivot(queries, pivot_cache_key)
+        pivot_sort_permutations = build_sort_permutations(pv_top, pivot_cache_key) if pv_top is not None else {}
         
         if pv_top is not None and len(pv_top) > 0:
             # ✅ PRE-CALCULATED METRICS
@@ -15032,14 +17099,12 @@ with tab_pivot:
                         key="pivot_min_ctr"
                     )
                 
-                # Apply filters
-                pv_filtered = pv_top[
-                    (pv_top['Counts'] >= min_counts) &
-                    (pv_top['ctr'] >= min_ctr)
-                ].sort_values(
-                    sort_col,
-                    ascending=(sort_order == 'Ascending')
-                ).head(300)
+                # Apply filters (sort order is a slice of the cached permutation)
+                pv_filtered = ranked_view(
+                    pv_top, pivot_sort_permutations, sort_col,
+                    ascending=(sort_order == 'Ascending'), top_n=300,
+                    mask=((pv_top['Counts'] >= min_counts) & (pv_top['ctr'] >= min_ctr)).to_numpy()
+                )
             
             # ✅ DISPLAY PIVOT
             st.markdown(f"### 📊 Showing {len(pv_filtered)} Brand-Query Pairs")
@@ -15132,9 +17197,25 @@ with tab_pivot:
                     help="Choose how to aggregate the selected value.",
                     key="pivot_aggfunc"
                 )
+                guard_mode = st.selectbox(
+                    "🛡️ If the pivot is too large",
+                    options=list(PIVOT_GUARD_MODES),
+                    format_func={
+                        'truncate': f'Truncate to top rows × top {PIVOT_MAX_COLUMNS} columns',
+                        'sparse': 'Sparse (non-empty cells only)',
+                        'refuse': "Don't build it"
+                    }.get,
+                    index=0,
+                    help=f"Pivots above {PIVOT_MAX_CELLS:,} cells are truncated by search volume, returned as a long table, or refused.",
+                    key="pivot_guard_mode"
+                )
             
             # Preview pivot structure
             if idx and cols and val:
+                estimated_rows, estimated_cols = estimate_pivot_cardinality(
+                    queries, tuple(idx), tuple(cols), pivot_cache_key + str(idx) + str(cols)
+                )
+                size_note = " ⚠️ exceeds the size guard" if estimated_rows * estimated_cols > PIVOT_MAX_CELLS else ""
                 st.markdown(f"""
                 <div class='pivot-preview-box'>
                     <h4>👁️ Preview Pivot Structure</h4>
@@ -15150,6 +17231,10 @@ with tab_pivot:
                         <span class='pivot-preview-label'>📈 Value:</span>
                         <span class='pivot-preview-value'>{val} ({aggfunc})</span>
                     </div>
+                    <div class='pivot-preview-item'>
+                        <span class='pivot-preview-label'>📐 Size:</span>
+                        <span class='pivot-preview-value'>{estimated_rows:,} rows × {estimated_cols:,} columns{size_note}</span>
+                    </div>
                 </div>
                 """, unsafe_allow_html=True)
             else:
@@ -15169,80 +17254,77 @@ with tab_pivot:
         
         if reset_pivot:
             # Clear session state
-            for key in ['pivot_idx', 'pivot_cols', 'pivot_val', 'pivot_aggfunc', 'pivot_sort_col', 'pivot_sort_order', 'pivot_min_counts', 'pivot_min_ctr']:
+            for key in ['pivot_idx', 'pivot_cols', 'pivot_val', 'pivot_aggfunc', 'pivot_sort_col', 'pivot_sort_order', 'pivot_min_counts', 'pivot_min_ctr', 'custom_pivot_spec']:
                 if key in st.session_state:
                     del st.session_state[key]
             st.rerun()
         
+        # Keep the generated pivot across reruns so paging / sorting / searching doesn't drop it
+        current_pivot_spec = (tuple(idx), tuple(cols), val, aggfunc, guard_mode)
         if generate_pivot:
             if not idx or not cols or not val:
+                st.session_state.pop('custom_pivot_spec', None)
                 st.markdown("""
                 <div style='background:linear-gradient(135deg,#FFCDD2 0%,#EF9A9A 100%);padding:15px;border-radius:10px;border-left:4px solid #E53935;margin:15px 0;'>
                     <span style='color:#B71C1C;font-weight:600;'>❌ Please select at least one row, one column, and a value.</span>
                 </div>
                 """, unsafe_allow_html=True)
-            else:
-                try:
-                    with st.spinner("🔄 Generating custom pivot..."):
-                        # ✅ GENERATE CUSTOM PIVOT
-                        @st.cache_data(ttl=1800, show_spinner=False, max_entries=5)
-                        def generate_custom_pivot(df, idx_cols, col_cols, val_col, agg_func, cache_key):
-                            """Vectorized custom pivot generation"""
-                            pivot_data = df.copy()
-                            
-                            # Calculate derived metrics if needed
-                            if val_col in ['ctr', 'conversion_rate']:
-                                pivot_data['Counts'] = pd.to_numeric(pivot_data['Counts'], errors='coerce').fillna(0)
-                                pivot_data['clicks'] = pd.to_numeric(pivot_data['clicks'], errors='coerce').fillna(0)
-                                pivot_data['conversions'] = pd.to_numeric(pivot_data['conversions'], errors='coerce').fillna(0)
-                                
-                                pivot_data['ctr'] = np.where(
-                                    pivot_data['Counts'] > 0,
-                                    (pivot_data['clicks'] / pivot_data['Counts']) * 100,
-                                    0
-                                )
-                                pivot_data['conversion_rate'] = np.where(
-                                    pivot_data['Counts'] > 0,
-                                    (pivot_data['conversions'] / pivot_data['Counts']) * 100,
-                                    0
-                                )
-                            
-                            # Handle brand column if present
-                            if 'brand' in pivot_data.columns:
-                                pivot_data['brand'] = pivot_data['brand'].astype(str).replace('nan', '')
-                                pivot_data = pivot_data[pivot_data['brand'].str.lower() != 'other']
-                            
-                            # Create pivot table
-                            pivot = pd.pivot_table(
-                                pivot_data,
-                                values=val_col,
-                                index=idx_cols,
-                                columns=col_cols,
-                                aggfunc=agg_func,
-                                fill_value=0
-                            )
-                            
-                            return pivot
-                        
-                        custom_pivot_key = pivot_cache_key + str(idx) + str(cols) + str(val) + str(aggfunc)
-                        pivot = generate_custom_pivot(queries, idx, cols, val, aggfunc, custom_pivot_key)
+            else:
+                st.session_state['custom_pivot_spec'] = current_pivot_spec
+        
+        if idx and cols and val and st.session_state.get('custom_pivot_spec') == current_pivot_spec:
+            try:
+                with st.spinner("🔄 Generating custom pivot..."):
+                    # ✅ GENERATE CUSTOM PIVOT (categorical codes, ratios after aggregation, size guard)
+                    custom_pivot_key = pivot_cache_key + str(idx) + str(cols)
+                    custom_pivot = build_custom_pivot(queries, tuple(idx), tuple(cols), val, aggfunc, custom_pivot_key, guard=guard_mode)
+                    pivot = custom_pivot['pivot']
+                    
+                    if custom_pivot['mode'] == 'refused':
+                        st.markdown(f"""
+                        <div style='background:linear-gradient(135deg,#FFF9C4 0%,#FFF59D 100%);padding:15px;border-radius:10px;border-left:4px solid #FBC02D;margin:15px 0;'>
+                            <span style='color:#F57F17;font-weight:600;'>⚠️ Pivot not built: {custom_pivot['n_rows']:,} rows × {custom_pivot['n_cols']:,} columns exceeds the {PIVOT_MAX_CELLS:,}-cell limit. Choose fewer / coarser columns or another size option.</span>
+                        </div>
+                        """, unsafe_allow_html=True)
+                    else:
+                        size_messages = {
+                            'dense': f"Shape: {pivot.shape[0]:,} rows × {pivot.shape[1]:,} columns",
+                            'truncated': f"Truncated to the top {custom_pivot['kept_rows']:,} of {custom_pivot['n_rows']:,} rows × top {custom_pivot['kept_cols']:,} of {custom_pivot['n_cols']:,} columns by search volume",
+                            'sparse': f"Sparse result: {custom_pivot['cells']:,} non-empty cells of {custom_pivot['n_rows']:,} rows × {custom_pivot['n_cols']:,} columns"
+                        }
                         
                         # Success message
                         st.markdown(f"""
                         <div style='background:linear-gradient(135deg,#C8E6C9 0%,#A5D6A7 100%);padding:15px;border-radius:10px;border-left:4px solid #4CAF50;margin:15px 0;'>
-                            <span style='color:#1B5E20;font-weight:600;'>✅ Custom pivot generated successfully! Shape: {pivot.shape[0]:,} rows × {pivot.shape[1]:,} columns</span>
+                            <span style='color:#1B5E20;font-weight:600;'>✅ Custom pivot generated successfully! {size_messages[custom_pivot['mode']]}</span>
                         </div>
                         """, unsafe_allow_html=True)
                         
-                        if AGGRID_OK:
-                            pivot_display = pivot.reset_index()
+                        if custom_pivot['mode'] == 'sparse':
+                            pivot = pivot.set_index(list(idx) + list(cols))
+                        
+                        pivot_display = pivot.reset_index()
+                        if len(pivot_display) > PAGED_TABLE_THRESHOLD:
+                            # Large result: keep it server-side and send one page at a time
+                            display_paged_table(
+                                pivot_display,
+                                key="custom_pivot_table",
+                                cache_key=f"{custom_pivot_key}|{val}|{aggfunc}|{guard_mode}",
+                                formatters={
+                                    c: (lambda x: f"{x:,.2f}" if pd.notna(x) else "")
+                                    for c in pivot_display.columns
+                                    if pd.api.types.is_float_dtype(pivot_display[c])
+                                },
+                                align="left"
+                            )
+                        elif AGGRID_OK:
                             gb = GridOptionsBuilder.from_dataframe(pivot_display)
                             gb.configure_default_column(filterable=True, sortable=True, resizable=True)
                             gb.configure_grid_options(enableRangeSelection=True, pagination=True, paginationPageSize=20)
                             AgGrid(pivot_display, gridOptions=gb.build(), height=500, theme='material', fit_columns_on_grid_load=True)
                         else:
                             display_styled_table(
-                                df=pivot.reset_index(),
+                                df=pivot_display,
                                 align="left",
                                 scrollable=True,
                                 max_height="500px"
@@ -15257,20 +17339,20 @@ with tab_pivot:
                             mime="text/csv",
                             key="custom_pivot_download"
                         )
+            
+            except Exception as e:
+                st.markdown(f"""
+                <div style='background:linear-gradient(135deg,#FFCDD2 0%,#EF9A9A 100%);padding:15px;border-radius:10px;border-left:4px solid #E53935;margin:15px 0;'>
+                    <span style='color:#B71C1C;font-weight:600;'>❌ Pivot generation error: {str(e)}</span>
+                </div>
+                """, unsafe_allow_html=True)
                 
-                except Exception as e:
-                    st.markdown(f"""
-                    <div style='background:linear-gradient(135deg,#FFCDD2 0%,#EF9A9A 100%);padding:15px;border-radius:10px;border-left:4px solid #E53935;margin:15px 0;'>
-                        <span style='color:#B71C1C;font-weight:600;'>❌ Pivot generation error: {str(e)}</span>
-                    </div>
-                    """, unsafe_allow_html=True)
-                    
-                    st.markdown("""
-                    <div style='background:linear-gradient(135deg,#E3F2FD 0%,#BBDEFB 100%);padding:15px;border-radius:10px;border-left:4px solid #2196F3;margin:15px 0;'>
-                        <span style='color:#0D47A1;font-weight:600;'>💡 Ensure selected columns and values are valid and contain data.</span>
-                    </div>
-                    """, unsafe_allow_html=True)
-        
+                st.markdown("""
+                <div style='background:linear-gradient(135deg,#E3F2FD 0%,#BBDEFB 100%);padding:15px;border-radius:10px;border-left:4px solid #2196F3;margin:15px 0;'>
+                    <span style='color:#0D47A1;font-weight:600;'>💡 Ensure selected columns and values are valid and contain data.</span>
+                </div>
+                """, unsafe_allow_html=True)
+    
         # ✅ PIVOT INSIGHTS SECTION
         st.markdown("---")
         st.subheader("💡 Pivot Insights & Recommendations")
@@ -15354,49 +17436,21 @@ with tab_insights:
         """, unsafe_allow_html=True)
         st.session_state.insights_css_loaded = True
     
-    # ✅ CACHED DATA PREPROCESSING
-    @st.cache_data(ttl=3600, show_spinner=False, max_entries=3)
+    # ✅ ZERO-COPY INSIGHTS DATA
     def preprocess_insights_data(df):
-        """Fully vectorized data preprocessing"""
-        df_clean = df.copy()
-        
-        # Batch numeric conversion
-        numeric_cols = ['Counts', 'clicks', 'conversions']
-        for col in numeric_cols:
-            df_clean[col] = pd.to_numeric(df_clean[col], errors='coerce').fillna(0).astype(np.int64)
-        
-        # Vectorized CTR and CR calculations
-        df_clean['ctr_calculated'] = np.where(
-            df_clean['Counts'] > 0,
-            (df_clean['clicks'] / df_clean['Counts']) * 100,
-            0
-        )
-        df_clean['cr_calculated'] = np.where(
-            df_clean['Counts'] > 0,
-            (df_clean['conversions'] / df_clean['Counts']) * 100,
-            0
-        )
-        
-        # Clean brand column
-        if 'Brand' in df_clean.columns:
-            df_clean['brand'] = df_clean['Brand'].astype(str).replace(['nan', 'None', ''], 'Other').str.strip()
-        else:
-            df_clean['brand'] = 'Other'
-        
-        # Handle date columns
-        if 'start_date' in df_clean.columns:
-            df_clean['start_date'] = pd.to_datetime(df_clean['start_date'], errors='coerce')
-        
-        # Handle position
-        if 'averageClickPosition' in df_clean.columns:
-            df_clean['averageclickposition'] = pd.to_numeric(df_clean['averageClickPosition'], errors='coerce')
-        
-        return df_clean
+        """The canonical frame itself - Counts / clicks / conversions are already numeric, ctr / cr and
+        brand already exist, and build_insights_engine reads only the columns it needs (no copy)."""
+        missing = [col for col in ['search'] + METRIC_COLS if col not in df.columns]
+        if missing:
+            raise ValueError(f"missing columns: {', '.join(missing)}")
+        return df
     
-    # Load preprocessed data
+    # Load Insights data (a reference to the canonical frame, not a copy)
     try:
-        insights_cache_key = f"{queries.shape}_{hash(str(queries['Counts'].sum()))}"
+        insights_cache_key = f"insights_{get_filter_fingerprint(queries)}"
         df_insights = preprocess_insights_data(queries)
+        # ✅ One aggregation answers all fifteen questions
+        insights_engine = build_insights_engine(df_insights, insights_cache_key)
         st.sidebar.success(f"✅ Insights data loaded: {len(df_insights):,} rows")
     except Exception as e:
         st.error(f"⚠️ Data preprocessing error: {e}")
@@ -15404,6 +17458,28 @@ with tab_insights:
     
     st.markdown("---")
     
+    # ✅ OPTIONAL SIGNIFICANCE COLUMNS (computed in batch for the rows being shown)
+    show_significance = st.checkbox(
+        "📐 Show 95% confidence intervals and significance vs the rest of the queries",
+        value=False, key="insights_significance"
+    )
+    insights_totals = insights_engine['queries'][METRIC_COLS].sum().to_numpy(dtype=np.float64)
+    
+    # ✅ Q1-Q4 ranking basis: raw rates behind the volume cut-off, or smoothed rates over every query
+    rate_basis = st.radio(
+        "Rank Q1-Q4 by:",
+        ["Raw CTR / CR (volume >= 200)", "Smoothed CTR / CR (all queries, shrunk toward brand rate)"],
+        horizontal=True, key="insights_rate_basis"
+    )
+    use_smoothed_rates = rate_basis.startswith("Smoothed")
+    ranking_answers = insights_engine['smoothed'] if use_smoothed_rates else insights_engine
+    
+    def with_significance(display_df, out, metric_cols=tuple(METRIC_COLS)):
+        if not show_significance:
+            return display_df
+        flagged = add_significance_columns(out, totals=insights_totals, metric_cols=metric_cols)
+        return pd.concat([display_df.reset_index(drop=True), significance_display_columns(flagged)], axis=1)
+    
     # ✅ HELPER FUNCTION FOR EXPANDABLE QUESTIONS
     def q_expand(title, explanation, render_fn, icon="💡"):
         with st.expander(f"{icon} {title}", expanded=False):
@@ -15416,24 +17492,7 @@ with tab_insights:
     # ==================== Q1: Top 20 Search Queries by CTR and CR ====================
     def q1():
         """Top 20 search queries based on both CTR and CR performance"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q1(df, cache_key):
-            filtered = df[
-                (df['brand'] != 'Other') &
-                (df['Counts'] >= 200)
-            ].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            # Get top 20
-            out = filtered.nlargest(20, ['ctr_calculated', 'cr_calculated'])[
-                ['search', 'brand', 'Counts', 'clicks', 'conversions', 'ctr_calculated', 'cr_calculated']
-            ].copy()
-            
-            return out
-        
-        out = compute_q1(df_insights, insights_cache_key)
+        out = ranking_answers['q1']
         
         if out is not None:
             # Format for display
@@ -15441,12 +17500,16 @@ with tab_insights:
             display_df['Counts_fmt'] = display_df['Counts'].apply(format_number)
             display_df['clicks_fmt'] = display_df['clicks'].apply(format_number)
             display_df['conversions_fmt'] = display_df['conversions'].apply(format_number)
-            display_df['ctr_fmt'] = display_df['ctr_calculated'].apply(lambda x: f"{x:.1f}%")
-            display_df['cr_fmt'] = display_df['cr_calculated'].apply(lambda x: f"{x:.1f}%")
+            display_df['ctr_fmt'] = display_df['ctr'].apply(lambda x: f"{x:.1f}%")
+            display_df['cr_fmt'] = display_df['cr'].apply(lambda x: f"{x:.1f}%")
             
             display_df = display_df[['search', 'brand', 'Counts_fmt', 'clicks_fmt', 'conversions_fmt', 'ctr_fmt', 'cr_fmt']]
             display_df.columns = ['Search Query', 'Brand', 'Search Volume', 'Clicks', 'Conversions', 'CTR', 'CR']
+            if use_smoothed_rates:
+                display_df['Smoothed CTR'] = out['ctr_smoothed'].apply(lambda x: f"{x:.1f}%")
+                display_df['Smoothed CR'] = out['cr_smoothed'].apply(lambda x: f"{x:.1f}%")
             
+            display_df = with_significance(display_df, out)
             display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
             
             st.download_button("📥 Download Data", out.to_csv(index=False),
@@ -15454,7 +17517,7 @@ with tab_insights:
                              "text/csv", key="q1_dl")
             
             # Visualization
-            fig = px.scatter(out, x='ctr_calculated', y='cr_calculated', size='Counts', color='cr_calculated',
+            fig = px.scatter(out, x='ctr', y='cr', size='Counts', color='cr',
                            hover_data=['search', 'brand', 'clicks', 'conversions'],
                            title='Top 20 Search Queries: CTR vs CR Performance',
                            color_continuous_scale='Greens', text='search')
@@ -15473,24 +17536,7 @@ with tab_insights:
     # ==================== Q2: Bottom 20 Search Queries by CTR and CR ====================
     def q2():
         """Bottom 20 search queries based on both CTR and CR performance"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q2(df, cache_key):
-            filtered = df[
-                (df['brand'] != 'Other') &
-                (df['Counts'] >= 200)
-            ].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            # Get bottom 20
-            out = filtered.nsmallest(20, ['ctr_calculated', 'cr_calculated'])[
-                ['search', 'brand', 'Counts', 'clicks', 'conversions', 'ctr_calculated', 'cr_calculated']
-            ].copy()
-            
-            return out
-        
-        out = compute_q2(df_insights, insights_cache_key)
+        out = ranking_answers['q2']
         
         if out is not None:
             # Format for display
@@ -15498,12 +17544,16 @@ with tab_insights:
             display_df['Counts_fmt'] = display_df['Counts'].apply(format_number)
             display_df['clicks_fmt'] = display_df['clicks'].apply(format_number)
             display_df['conversions_fmt'] = display_df['conversions'].apply(format_number)
-            display_df['ctr_fmt'] = display_df['ctr_calculated'].apply(lambda x: f"{x:.1f}%")
-            display_df['cr_fmt'] = display_df['cr_calculated'].apply(lambda x: f"{x:.1f}%")
+            display_df['ctr_fmt'] = display_df['ctr'].apply(lambda x: f"{x:.1f}%")
+            display_df['cr_fmt'] = display_df['cr'].apply(lambda x: f"{x:.1f}%")
             
             display_df = display_df[['search', 'brand', 'Counts_fmt', 'clicks_fmt', 'conversions_fmt', 'ctr_fmt', 'cr_fmt']]
             display_df.columns = ['Search Query', 'Brand', 'Search Volume', 'Clicks', 'Conversions', 'CTR', 'CR']
+            if use_smoothed_rates:
+                display_df['Smoothed CTR'] = out['ctr_smoothed'].apply(lambda x: f"{x:.1f}%")
+                display_df['Smoothed CR'] = out['cr_smoothed'].apply(lambda x: f"{x:.1f}%")
             
+            display_df = with_significance(display_df, out)
             display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
             
             # Warning callout
@@ -15515,7 +17565,7 @@ with tab_insights:
                              "text/csv", key="q2_dl")
             
             # Visualization
-            fig = px.scatter(out, x='ctr_calculated', y='cr_calculated', size='Counts', color='cr_calculated',
+            fig = px.scatter(out, x='ctr', y='cr', size='Counts', color='cr',
                            hover_data=['search', 'brand', 'clicks', 'conversions'],
                            title='Bottom 20 Search Queries: CTR vs CR Performance',
                            color_continuous_scale='Reds_r', text='search')
@@ -15534,24 +17584,7 @@ with tab_insights:
     # ==================== Q3: Top 20 Search Queries by CR ====================
     def q3():
         """Top 20 search queries based on Conversion Rate (CR)"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q3(df, cache_key):
-            filtered = df[
-                (df['brand'] != 'Other') &
-                (df['Counts'] >= 200)
-            ].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            # Get top 20 by CR
-            out = filtered.nlargest(20, 'cr_calculated')[
-                ['search', 'brand', 'Counts', 'clicks', 'conversions', 'ctr_calculated', 'cr_calculated']
-            ].copy()
-            
-            return out
-        
-        out = compute_q3(df_insights, insights_cache_key)
+        out = ranking_answers['q3']
         
         if out is not None:
             # Format for display
@@ -15559,24 +17592,28 @@ with tab_insights:
             display_df['Counts_fmt'] = display_df['Counts'].apply(format_number)
             display_df['clicks_fmt'] = display_df['clicks'].apply(format_number)
             display_df['conversions_fmt'] = display_df['conversions'].apply(format_number)
-            display_df['ctr_fmt'] = display_df['ctr_calculated'].apply(lambda x: f"{x:.1f}%")
-            display_df['cr_fmt'] = display_df['cr_calculated'].apply(lambda x: f"{x:.1f}%")
+            display_df['ctr_fmt'] = display_df['ctr'].apply(lambda x: f"{x:.1f}%")
+            display_df['cr_fmt'] = display_df['cr'].apply(lambda x: f"{x:.1f}%")
             
             display_df = display_df[['search', 'brand', 'Counts_fmt', 'clicks_fmt', 'conversions_fmt', 'ctr_fmt', 'cr_fmt']]
             display_df.columns = ['Search Query', 'Brand', 'Search Volume', 'Clicks', 'Conversions', 'CTR', 'CR']
+            if use_smoothed_rates:
+                display_df['Smoothed CTR'] = out['ctr_smoothed'].apply(lambda x: f"{x:.1f}%")
+                display_df['Smoothed CR'] = out['cr_smoothed'].apply(lambda x: f"{x:.1f}%")
             
+            display_df = with_significance(display_df, out)
             display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
             
             # Success callout
             top_query = out.iloc[0]
-            st.success(f"🎯 **Top Converting Query:** '{top_query['search']}' ({top_query['brand']}) with {top_query['cr_calculated']:.1f}% CR and {format_number(int(top_query['conversions']))} conversions!")
+            st.success(f"🎯 **Top Converting Query:** '{top_query['search']}' ({top_query['brand']}) with {top_query['cr']:.1f}% CR and {format_number(int(top_query['conversions']))} conversions!")
             
             st.download_button("📥 Download Data", out.to_csv(index=False),
                              f"q3_top20_cr_{pd.Timestamp.now().strftime('%Y%m%d')}.csv",
                              "text/csv", key="q3_dl")
             
             # Visualization
-            fig = px.bar(out, x='search', y='cr_calculated', color='cr_calculated',
+            fig = px.bar(out, x='search', y='cr', color='cr',
                         title='Top 20 Search Queries by Conversion Rate',
                         color_continuous_scale='Greens',
                         hover_data=['brand', 'Counts', 'clicks', 'conversions'])
@@ -15594,24 +17631,7 @@ with tab_insights:
     # ==================== Q4: Top 20 Search Queries by CTR ====================
     def q4():
         """Top 20 search queries based on Click-Through Rate (CTR)"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q4(df, cache_key):
-            filtered = df[
-                (df['brand'] != 'Other') &
-                (df['Counts'] >= 200)
-            ].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            # Get top 20 by CTR
-            out = filtered.nlargest(20, 'ctr_calculated')[
-                ['search', 'brand', 'Counts', 'clicks', 'conversions', 'ctr_calculated', 'cr_calculated']
-            ].copy()
-            
-            return out
-        
-        out = compute_q4(df_insights, insights_cache_key)
+        out = ranking_answers['q4']
         
         if out is not None:
             # Format for display
@@ -15619,24 +17639,28 @@ with tab_insights:
             display_df['Counts_fmt'] = display_df['Counts'].apply(format_number)
             display_df['clicks_fmt'] = display_df['clicks'].apply(format_number)
             display_df['conversions_fmt'] = display_df['conversions'].apply(format_number)
-            display_df['ctr_fmt'] = display_df['ctr_calculated'].apply(lambda x: f"{x:.1f}%")
-            display_df['cr_fmt'] = display_df['cr_calculated'].apply(lambda x: f"{x:.1f}%")
+            display_df['ctr_fmt'] = display_df['ctr'].apply(lambda x: f"{x:.1f}%")
+            display_df['cr_fmt'] = display_df['cr'].apply(lambda x: f"{x:.1f}%")
             
             display_df = display_df[['search', 'brand', 'Counts_fmt', 'clicks_fmt', 'conversions_fmt', 'ctr_fmt', 'cr_fmt']]
             display_df.columns = ['Search Query', 'Brand', 'Search Volume', 'Clicks', 'Conversions', 'CTR', 'CR']
+            if use_smoothed_rates:
+                display_df['Smoothed CTR'] = out['ctr_smoothed'].apply(lambda x: f"{x:.1f}%")
+                display_df['Smoothed CR'] = out['cr_smoothed'].apply(lambda x: f"{x:.1f}%")
             
+            display_df = with_significance(display_df, out)
             display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
             
             # Success callout
             top_query = out.iloc[0]
-            st.success(f"👆 **Most Clicked Query:** '{top_query['search']}' ({top_query['brand']}) with {top_query['ctr_calculated']:.1f}% CTR and {format_number(int(top_query['clicks']))} clicks!")
+            st.success(f"👆 **Most Clicked Query:** '{top_query['search']}' ({top_query['brand']}) with {top_query['ctr']:.1f}% CTR and {format_number(int(top_query['clicks']))} clicks!")
             
             st.download_button("📥 Download Data", out.to_csv(index=False),
                              f"q4_top20_ctr_{pd.Timestamp.now().strftime('%Y%m%d')}.csv",
                              "text/csv", key="q4_dl")
             
             # Visualization
-            fig = px.bar(out, x='search', y='ctr_calculated', color='ctr_calculated',
+            fig = px.bar(out, x='search', y='ctr', color='ctr',
                         title='Top 20 Search Queries by Click-Through Rate',
                         color_continuous_scale='Blues',
                         hover_data=['brand', 'Counts', 'clicks', 'conversions'])
@@ -15654,34 +17678,7 @@ with tab_insights:
     # ==================== Q5: High Search Volume, Low CR ====================
     def q5():
         """High search volume but low conversion rate - optimization opportunities"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q5(df, cache_key):
-            filtered = df[
-                (df['Counts'] >= 200) &
-                (df['brand'] != 'Other')
-            ].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            threshold = filtered['Counts'].quantile(0.70)
-            median_cr = filtered['cr_calculated'].median()
-            
-            opportunities = filtered[
-                (filtered['Counts'] >= threshold) &
-                (filtered['cr_calculated'] < median_cr)
-            ].copy()
-            
-            if len(opportunities) == 0:
-                return None
-            
-            out = opportunities.nlargest(20, 'Counts')[
-                ['search', 'brand', 'Counts', 'clicks', 'conversions', 'cr_calculated']
-            ].copy()
-            
-            return out
-        
-        out = compute_q5(df_insights, insights_cache_key)
+        out = insights_engine['q5']
         
         if out is not None:
             # Format for display
@@ -15689,11 +17686,12 @@ with tab_insights:
             display_df['Counts_fmt'] = display_df['Counts'].apply(format_number)
             display_df['clicks_fmt'] = display_df['clicks'].apply(format_number)
             display_df['conversions_fmt'] = display_df['conversions'].apply(format_number)
-            display_df['cr_fmt'] = display_df['cr_calculated'].apply(lambda x: f"{x:.1f}%")
+            display_df['cr_fmt'] = display_df['cr'].apply(lambda x: f"{x:.1f}%")
             
             display_df = display_df[['search', 'brand', 'Counts_fmt', 'clicks_fmt', 'conversions_fmt', 'cr_fmt']]
             display_df.columns = ['Search Query', 'Brand', 'Search Volume', 'Clicks', 'Current Conversions', 'Current CR']
             
+            display_df = with_significance(display_df, out)
             display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
             
             # Warning callout
@@ -15704,7 +17702,7 @@ with tab_insights:
                              "text/csv", key="q5_dl")
             
             # Visualization
-            fig = px.bar(out.head(15), x='search', y='Counts', color='cr_calculated',
+            fig = px.bar(out.head(15), x='search', y='Counts', color='cr',
                         title='Top 15 Conversion Optimization Opportunities',
                         color_continuous_scale='Reds_r',
                         hover_data=['brand', 'clicks', 'conversions'])
@@ -15722,34 +17720,7 @@ with tab_insights:
     # ==================== Q6: High CTR, Low CR ====================
     def q6():
         """High CTR but low CR - post-click experience problems"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q6(df, cache_key):
-            filtered = df[
-                (df['Counts'] >= 200) &
-                (df['brand'] != 'Other')
-            ].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            high_ctr = filtered['ctr_calculated'].quantile(0.70)
-            low_cr = filtered['cr_calculated'].quantile(0.30)
-            
-            issues = filtered[
-                (filtered['ctr_calculated'] >= high_ctr) &
-                (filtered['cr_calculated'] <= low_cr)
-            ].copy()
-            
-            if len(issues) == 0:
-                return None
-            
-            out = issues.nlargest(30, 'Counts')[
-                ['search', 'brand', 'Counts', 'clicks', 'conversions', 'ctr_calculated', 'cr_calculated']
-            ].copy()
-            
-            return out
-        
-        out = compute_q6(df_insights, insights_cache_key)
+        out = insights_engine['q6']
         
         if out is not None:
             # Format for display
@@ -15757,12 +17728,13 @@ with tab_insights:
             display_df['Counts_fmt'] = display_df['Counts'].apply(format_number)
             display_df['clicks_fmt'] = display_df['clicks'].apply(format_number)
             display_df['conversions_fmt'] = display_df['conversions'].apply(format_number)
-            display_df['ctr_fmt'] = display_df['ctr_calculated'].apply(lambda x: f"{x:.1f}%")
-            display_df['cr_fmt'] = display_df['cr_calculated'].apply(lambda x: f"{x:.1f}%")
+            display_df['ctr_fmt'] = display_df['ctr'].apply(lambda x: f"{x:.1f}%")
+            display_df['cr_fmt'] = display_df['cr'].apply(lambda x: f"{x:.1f}%")
             
             display_df = display_df[['search', 'brand', 'Counts_fmt', 'clicks_fmt', 'conversions_fmt', 'ctr_fmt', 'cr_fmt']]
             display_df.columns = ['Search Query', 'Brand', 'Search Volume', 'Clicks', 'Conversions', 'CTR', 'CR']
             
+            display_df = with_significance(display_df, out)
             display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
             
             # Warning callout
@@ -15773,8 +17745,8 @@ with tab_insights:
                              "text/csv", key="q6_dl")
             
             # Visualization
-            fig = px.scatter(out.head(20), x='ctr_calculated', y='cr_calculated',
-                           size='Counts', color='ctr_calculated',
+            fig = px.scatter(out.head(20), x='ctr', y='cr',
+                           size='Counts', color='ctr',
                            hover_data=['search', 'brand', 'clicks', 'conversions'],
                            title='High CTR, Low CR: Post-Click Experience Issues (Top 20)',
                            color_continuous_scale='Oranges', text='search')
@@ -15806,29 +17778,7 @@ with tab_insights:
     # ==================== Q7: Brand Performance ====================
     def q7():
         """Branded vs Generic search intent comparison"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q7(df, cache_key):
-            df_temp = df.copy()
-            df_temp['brand_type'] = df_temp['brand'].apply(
-                lambda x: 'Generic' if str(x).lower() == 'other' else 'Branded'
-            )
-            
-            agg = df_temp.groupby('brand_type', as_index=False).agg({
-                'Counts': 'sum',
-                'clicks': 'sum',
-                'conversions': 'sum'
-            })
-            
-            agg['ctr'] = np.where(agg['Counts'] > 0, (agg['clicks'] / agg['Counts']) * 100, 0)
-            agg['cr'] = np.where(agg['Counts'] > 0, (agg['conversions'] / agg['Counts']) * 100, 0)
-            total_sv = agg['Counts'].sum()
-            agg['search_share'] = np.where(total_sv > 0, (agg['Counts'] / total_sv) * 100, 0)
-            
-            out = agg.sort_values('Counts', ascending=False)
-            
-            return out
-        
-        out = compute_q7(df_insights, insights_cache_key)
+        out = insights_engine['q7']
         
         if out is not None and len(out) > 0:
             # Format for display
@@ -15882,33 +17832,7 @@ with tab_insights:
     # ==================== Q8: Seasonal Trends ====================
     def q8():
         """Month-over-month performance trends"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q8(df, cache_key):
-            if 'start_date' not in df.columns:
-                return None
-            
-            filtered = df[df['start_date'].notna()].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            df_temp = filtered.copy()
-            df_temp['month'] = df_temp['start_date'].dt.to_period('M').astype(str)
-            
-            agg = df_temp.groupby('month', as_index=False).agg({
-                'Counts': 'sum',
-                'clicks': 'sum',
-                'conversions': 'sum'
-            })
-            
-            agg['ctr'] = np.where(agg['Counts'] > 0, (agg['clicks'] / agg['Counts']) * 100, 0)
-            agg['cr'] = np.where(agg['Counts'] > 0, (agg['conversions'] / agg['Counts']) * 100, 0)
-            
-            out = agg.sort_values('month')
-            
-            return out
-        
-        out = compute_q8(df_insights, insights_cache_key)
+        out = insights_engine['q8']
         
         if out is not None and len(out) > 0:
             # Format for display
@@ -15949,6 +17873,29 @@ with tab_insights:
             fig2.update_layout(title='CTR & CR Trends Over Time',
                              xaxis_title='Month', yaxis_title='Percentage (%)', hovermode='x unified')
             st.plotly_chart(fig2, use_container_width=True)
+            
+            # Latest month-over-month risers / fallers across every query, brand or category
+            mover_levels = {col: label for col, label in (('search', 'Query'), ('brand', 'Brand'), ('category', 'Category'))
+                            if col in df_insights.columns}
+            if 'month' in df_insights.columns and mover_levels:
+                mover_level = st.radio("Movers by:", list(mover_levels), format_func=mover_levels.get,
+                                       horizontal=True, key="q8_mover_level")
+                movers, mover_months = detect_entity_movers(df_insights, mover_level, insights_cache_key, min_volume=200)
+                significant = movers[movers['direction'] != 'Stable'] if len(mover_months) >= 2 else movers.iloc[0:0]
+                if not significant.empty:
+                    top_moves = pd.concat([significant.nlargest(10, 'mom_z'), significant.nsmallest(10, 'mom_z')]).drop_duplicates(subset=[mover_level])
+                    moves_df = pd.DataFrame({
+                        mover_levels[mover_level]: top_moves[mover_level].astype(str),
+                        'Direction': top_moves['direction'],
+                        mover_months[-2]: top_moves['prev'].apply(format_number),
+                        mover_months[-1]: top_moves['last'].apply(format_number),
+                        'Change %': top_moves['mom_pct'].apply(lambda x: f"{x:+.1f}%" if pd.notna(x) else "New"),
+                        'Z-Score': top_moves['mom_z'].apply(lambda x: f"{x:+.1f}")
+                    })
+                    st.markdown(f"**🚨 Significant movers ({mover_months[-2]} → {mover_months[-1]}, volume ≥ 200)**")
+                    display_styled_table(df=moves_df, align="center", scrollable=True, max_height="500px")
+                else:
+                    st.info("📊 No significant month-over-month movers")
         else:
             st.info("📊 No data found with valid dates")
     
@@ -15961,32 +17908,13 @@ with tab_insights:
     # ==================== Q9: Brand Comparison ====================
     def q9():
         """Top brands comparison by key metrics"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q9(df, cache_key):
-            filtered = df[df['brand'] != 'Other'].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            agg = filtered.groupby('brand', as_index=False).agg({
-                'search': 'count',
-                'Counts': 'sum',
-                'clicks': 'sum',
-                'conversions': 'sum'
+        out = insights_engine['q9']
+        if out is not None:
+            out = out.rename(columns={
+                'brand': 'Brand', 'n_queries': '# Unique Queries', 'avg_volume': 'Avg Search Volume',
+                'Counts': 'Total Search Volume', 'clicks': 'Total Clicks', 'conversions': 'Total Conversions',
+                'ctr': 'CTR', 'cr': 'CR'
             })
-            
-            agg.columns = ['Brand', '# Unique Queries', 'Total Search Volume', 'Total Clicks', 'Total Conversions']
-            agg['Avg Search Volume'] = (agg['Total Search Volume'] / agg['# Unique Queries']).round(0)
-            agg['CTR'] = np.where(agg['Total Search Volume'] > 0,
-                                 (agg['Total Clicks'] / agg['Total Search Volume']) * 100, 0)
-            agg['CR'] = np.where(agg['Total Search Volume'] > 0,
-                                (agg['Total Conversions'] / agg['Total Search Volume']) * 100, 0)
-            
-            out = agg.nlargest(20, 'Total Search Volume')
-            
-            return out
-        
-        out = compute_q9(df_insights, insights_cache_key)
         
         if out is not None and len(out) > 0:
             # Format for display
@@ -16004,8 +17932,20 @@ with tab_insights:
             display_df.columns = ['Brand', '# Unique Queries', 'Avg Search Volume', 'Total Search Volume',
                                 'Total Clicks', 'Total Conversions', 'CTR', 'CR']
             
+            display_df = with_significance(display_df, out, metric_cols=('Total Search Volume', 'Total Clicks', 'Total Conversions'))
             display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
             
+            # Brand concentration from the shared concentration table ('Other' excluded)
+            brand_concentration = concentration_metrics(
+                compute_concentration_table(df_insights, insights_cache_key, dimensions={'brand': 'Brand'}), 'brand'
+            )
+            if brand_concentration:
+                st.markdown(
+                    f"**🎯 Brand concentration:** top 5 brands hold {brand_concentration['top_5_share']:.1f}% of branded volume · "
+                    f"{int(brand_concentration['pareto_count']):,} of {int(brand_concentration['n_entities']):,} brands make up 80% · "
+                    f"HHI {brand_concentration['hhi']:.3f} · Gini {brand_concentration['gini']:.3f}"
+                )
+            
             st.download_button("📥 Download Data", out.to_csv(index=False),
                              f"q9_brand_comparison_{pd.Timestamp.now().strftime('%Y%m%d')}.csv",
                              "text/csv", key="q9_dl")
@@ -16037,29 +17977,7 @@ with tab_insights:
     # ==================== Q10: Zero-Click Searches ====================
     def q10():
         """Queries with high search volume but zero or very low clicks"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q10(df, cache_key):
-            filtered = df[
-                (df['Counts'] >= 200) &
-                (df['brand'] != 'Other')
-            ].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            # Zero or very low CTR (< 1%)
-            zero_click = filtered[filtered['ctr_calculated'] < 1.0].copy()
-            
-            if len(zero_click) == 0:
-                return None
-            
-            out = zero_click.nlargest(20, 'Counts')[
-                ['search', 'brand', 'Counts', 'clicks', 'conversions', 'ctr_calculated']
-            ].copy()
-            
-            return out
-        
-        out = compute_q10(df_insights, insights_cache_key)
+        out = insights_engine['q10']
         
         if out is not None:
             # Format for display
@@ -16067,11 +17985,12 @@ with tab_insights:
             display_df['Counts_fmt'] = display_df['Counts'].apply(format_number)
             display_df['clicks_fmt'] = display_df['clicks'].apply(format_number)
             display_df['conversions_fmt'] = display_df['conversions'].apply(format_number)
-            display_df['ctr_fmt'] = display_df['ctr_calculated'].apply(lambda x: f"{x:.1f}%")
+            display_df['ctr_fmt'] = display_df['ctr'].apply(lambda x: f"{x:.1f}%")
             
             display_df = display_df[['search', 'brand', 'Counts_fmt', 'clicks_fmt', 'conversions_fmt', 'ctr_fmt']]
             display_df.columns = ['Search Query', 'Brand', 'Search Volume', 'Clicks', 'Conversions', 'CTR']
             
+            display_df = with_significance(display_df, out)
             display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
             
             # Warning callout
@@ -16083,7 +18002,7 @@ with tab_insights:
                              "text/csv", key="q10_dl")
             
             # Visualization
-            fig = px.bar(out.head(15), x='search', y='Counts', color='ctr_calculated',
+            fig = px.bar(out.head(15), x='search', y='Counts', color='ctr',
                         title='Top 15 Zero/Low-Click Queries (CTR < 1%)',
                         color_continuous_scale='Reds',
                         hover_data=['brand', 'clicks', 'conversions'])
@@ -16113,35 +18032,7 @@ with tab_insights:
     # ==================== Q11: High Position, Low CTR ====================
     def q11():
         """Queries ranking well but not getting clicks"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q11(df, cache_key):
-            if 'averageclickposition' not in df.columns:
-                return None
-            
-            filtered = df[
-                (df['Counts'] >= 200) &
-                (df['brand'] != 'Other') &
-                (df['averageclickposition'].notna()) &
-                (df['averageclickposition'] <= 5)  # Top 5 positions
-            ].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            # Low CTR despite good position
-            median_ctr = filtered['ctr_calculated'].median()
-            low_ctr = filtered[filtered['ctr_calculated'] < median_ctr].copy()
-            
-            if len(low_ctr) == 0:
-                return None
-            
-            out = low_ctr.nlargest(20, 'Counts')[
-                ['search', 'brand', 'Counts', 'clicks', 'conversions', 'averageclickposition', 'ctr_calculated']
-            ].copy()
-            
-            return out
-        
-        out = compute_q11(df_insights, insights_cache_key)
+        out = insights_engine['q11']
         
         if out is not None:
             # Format for display
@@ -16149,12 +18040,13 @@ with tab_insights:
             display_df['Counts_fmt'] = display_df['Counts'].apply(format_number)
             display_df['clicks_fmt'] = display_df['clicks'].apply(format_number)
             display_df['conversions_fmt'] = display_df['conversions'].apply(format_number)
-            display_df['position_fmt'] = display_df['averageclickposition'].apply(lambda x: f"{x:.1f}")
-            display_df['ctr_fmt'] = display_df['ctr_calculated'].apply(lambda x: f"{x:.1f}%")
+            display_df['position_fmt'] = display_df['avg_position'].apply(lambda x: f"{x:.1f}")
+            display_df['ctr_fmt'] = display_df['ctr'].apply(lambda x: f"{x:.1f}%")
             
             display_df = display_df[['search', 'brand', 'Counts_fmt', 'clicks_fmt', 'conversions_fmt', 'position_fmt', 'ctr_fmt']]
             display_df.columns = ['Search Query', 'Brand', 'Search Volume', 'Clicks', 'Conversions', 'Avg Position', 'CTR']
             
+            display_df = with_significance(display_df, out)
             display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
             
             # Warning callout
@@ -16165,8 +18057,8 @@ with tab_insights:
                              "text/csv", key="q11_dl")
             
             # Visualization
-            fig = px.scatter(out, x='averageclickposition', y='ctr_calculated',
-                           size='Counts', color='ctr_calculated',
+            fig = px.scatter(out, x='avg_position', y='ctr',
+                           size='Counts', color='ctr',
                            hover_data=['search', 'brand', 'clicks', 'conversions'],
                            title='High Position, Low CTR: Ranking Well But Not Getting Clicks',
                            color_continuous_scale='Reds_r', text='search')
@@ -16197,39 +18089,13 @@ with tab_insights:
     # ==================== Q12: Conversion Rate by Search Volume Segments ====================
     def q12():
         """Conversion rate analysis across different search volume segments"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q12(df, cache_key):
-            filtered = df[df['brand'] != 'Other'].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            # Create volume segments
-            filtered['volume_segment'] = pd.cut(
-                filtered['Counts'],
-                bins=[0, 100, 500, 1000, 5000, float('inf')],
-                labels=['0-100', '101-500', '501-1K', '1K-5K', '5K+']
-            )
-            
-            agg = filtered.groupby('volume_segment', as_index=False).agg({
-                'search': 'count',
-                'Counts': 'sum',
-                'clicks': 'sum',
-                'conversions': 'sum'
+        out = insights_engine['q12']
+        if out is not None:
+            out = out.rename(columns={
+                'segment': 'Volume Segment', 'n_queries': '# Queries', 'avg_volume': 'Avg Search Volume',
+                'Counts': 'Total Search Volume', 'clicks': 'Total Clicks', 'conversions': 'Total Conversions',
+                'ctr': 'CTR', 'cr': 'CR'
             })
-            
-            agg.columns = ['Volume Segment', '# Queries', 'Total Search Volume', 'Total Clicks', 'Total Conversions']
-            agg['CTR'] = np.where(agg['Total Search Volume'] > 0,
-                                 (agg['Total Clicks'] / agg['Total Search Volume']) * 100, 0)
-            agg['CR'] = np.where(agg['Total Search Volume'] > 0,
-                                (agg['Total Conversions'] / agg['Total Search Volume']) * 100, 0)
-            agg['Avg Search Volume'] = (agg['Total Search Volume'] / agg['# Queries']).round(0)
-            
-            out = agg.sort_values('Volume Segment')
-            
-            return out
-        
-        out = compute_q12(df_insights, insights_cache_key)
         
         if out is not None and len(out) > 0:
             # Format for display
@@ -16293,42 +18159,13 @@ with tab_insights:
     # ==================== Q13: Query Length Analysis ====================
     def q13():
         """Performance analysis by query length (word count)"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q13(df, cache_key):
-            filtered = df[df['brand'] != 'Other'].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            # Calculate word count
-            filtered['word_count'] = filtered['search'].astype(str).apply(lambda x: len(x.split()))
-            
-            # Create length segments
-            filtered['length_segment'] = pd.cut(
-                filtered['word_count'],
-                bins=[0, 1, 2, 3, 4, float('inf')],
-                labels=['1 word', '2 words', '3 words', '4 words', '5+ words']
-            )
-            
-            agg = filtered.groupby('length_segment', as_index=False).agg({
-                'search': 'count',
-                'Counts': 'sum',
-                'clicks': 'sum',
-                'conversions': 'sum'
+        out = insights_engine['q13']
+        if out is not None:
+            out = out.rename(columns={
+                'length': 'Query Length', 'n_queries': '# Queries', 'avg_volume': 'Avg Search Volume',
+                'Counts': 'Total Search Volume', 'clicks': 'Total Clicks', 'conversions': 'Total Conversions',
+                'ctr': 'CTR', 'cr': 'CR'
             })
-            
-            agg.columns = ['Query Length', '# Queries', 'Total Search Volume', 'Total Clicks', 'Total Conversions']
-            agg['CTR'] = np.where(agg['Total Search Volume'] > 0,
-                                 (agg['Total Clicks'] / agg['Total Search Volume']) * 100, 0)
-            agg['CR'] = np.where(agg['Total Search Volume'] > 0,
-                                (agg['Total Conversions'] / agg['Total Search Volume']) * 100, 0)
-            agg['Avg Search Volume'] = (agg['Total Search Volume'] / agg['# Queries']).round(0)
-            
-            out = agg.sort_values('Query Length')
-            
-            return out
-        
-        out = compute_q13(df_insights, insights_cache_key)
         
         if out is not None and len(out) > 0:
             # Format for display
@@ -16393,31 +18230,7 @@ with tab_insights:
     # ==================== Q14: Click-to-Conversion Efficiency ====================
     def q14():
         """Queries with best click-to-conversion efficiency (Classic CVR)"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q14(df, cache_key):
-            filtered = df[
-                (df['brand'] != 'Other') &
-                (df['clicks'] >= 50)  # Minimum clicks for statistical significance
-            ].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            # Calculate classic CVR (conversions / clicks)
-            filtered['classic_cvr'] = np.where(
-                filtered['clicks'] > 0,
-                (filtered['conversions'] / filtered['clicks']) * 100,
-                0
-            )
-            
-            # Get top 20 by classic CVR
-            out = filtered.nlargest(20, 'classic_cvr')[
-                ['search', 'brand', 'Counts', 'clicks', 'conversions', 'ctr_calculated', 'cr_calculated', 'classic_cvr']
-            ].copy()
-            
-            return out
-        
-        out = compute_q14(df_insights, insights_cache_key)
+        out = insights_engine['q14']
         
         if out is not None:
             # Format for display
@@ -16425,8 +18238,8 @@ with tab_insights:
             display_df['Counts_fmt'] = display_df['Counts'].apply(format_number)
             display_df['clicks_fmt'] = display_df['clicks'].apply(format_number)
             display_df['conversions_fmt'] = display_df['conversions'].apply(format_number)
-            display_df['ctr_fmt'] = display_df['ctr_calculated'].apply(lambda x: f"{x:.1f}%")
-            display_df['cr_fmt'] = display_df['cr_calculated'].apply(lambda x: f"{x:.1f}%")
+            display_df['ctr_fmt'] = display_df['ctr'].apply(lambda x: f"{x:.1f}%")
+            display_df['cr_fmt'] = display_df['cr'].apply(lambda x: f"{x:.1f}%")
             display_df['classic_cvr_fmt'] = display_df['classic_cvr'].apply(lambda x: f"{x:.1f}%")
             
             display_df = display_df[['search', 'brand', 'Counts_fmt', 'clicks_fmt', 'conversions_fmt',
@@ -16434,6 +18247,7 @@ with tab_insights:
             display_df.columns = ['Search Query', 'Brand', 'Search Volume', 'Clicks', 'Conversions',
                                 'CTR', 'CR', 'Classic CVR']
             
+            display_df = with_significance(display_df, out)
             display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
             
             # Success callout
@@ -16482,42 +18296,7 @@ with tab_insights:
     # ==================== Q15: Untapped Potential - High Volume, Low Engagement ====================
     def q15():
         """High search volume but low clicks AND low conversions - untapped potential"""
-        @st.cache_data(ttl=1800, show_spinner=False)
-        def compute_q15(df, cache_key):
-            filtered = df[
-                (df['Counts'] >= 500) &  # High volume threshold
-                (df['brand'] != 'Other')
-            ].copy()
-            
-            if len(filtered) == 0:
-                return None
-            
-            # Low engagement: both CTR and CR below median
-            median_ctr = filtered['ctr_calculated'].median()
-            median_cr = filtered['cr_calculated'].median()
-            
-            untapped = filtered[
-                (filtered['ctr_calculated'] < median_ctr) &
-                (filtered['cr_calculated'] < median_cr)
-            ].copy()
-            
-            if len(untapped) == 0:
-                return None
-            
-            # Calculate potential conversions if they performed at median levels
-            untapped['potential_clicks'] = (untapped['Counts'] * median_ctr / 100).round(0)
-            untapped['potential_conversions'] = (untapped['Counts'] * median_cr / 100).round(0)
-            untapped['missed_clicks'] = untapped['potential_clicks'] - untapped['clicks']
-            untapped['missed_conversions'] = untapped['potential_conversions'] - untapped['conversions']
-            
-            out = untapped.nlargest(20, 'missed_conversions')[
-                ['search', 'brand', 'Counts', 'clicks', 'conversions', 'ctr_calculated', 'cr_calculated',
-                 'potential_clicks', 'potential_conversions', 'missed_clicks', 'missed_conversions']
-            ].copy()
-            
-            return out
-        
-        out = compute_q15(df_insights, insights_cache_key)
+        out = insights_engine['q15']
         
         if out is not None:
             # Format for display
@@ -16525,8 +18304,8 @@ with tab_insights:
             display_df['Counts_fmt'] = display_df['Counts'].apply(format_number)
             display_df['clicks_fmt'] = display_df['clicks'].apply(format_number)
             display_df['conversions_fmt'] = display_df['conversions'].apply(format_number)
-            display_df['ctr_fmt'] = display_df['ctr_calculated'].apply(lambda x: f"{x:.1f}%")
-            display_df['cr_fmt'] = display_df['cr_calculated'].apply(lambda x: f"{x:.1f}%")
+            display_df['ctr_fmt'] = display_df['ctr'].apply(lambda x: f"{x:.1f}%")
+            display_df['cr_fmt'] = display_df['cr'].apply(lambda x: f"{x:.1f}%")
             display_df['potential_clicks_fmt'] = display_df['potential_clicks'].apply(format_number)
             display_df['potential_conversions_fmt'] = display_df['potential_conversions'].apply(format_number)
             display_df['missed_clicks_fmt'] = display_df['missed_clicks'].apply(format_number)
@@ -16539,6 +18318,7 @@ with tab_insights:
                                 'Current CTR', 'Current CR', 'Potential Clicks', 'Potential Conversions',
                                 'Missed Clicks', 'Missed Conversions']
             
+            display_df = with_significance(display_df, out)
             display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
             
             # Warning callout
@@ -16592,6 +18372,77 @@ with tab_insights:
         "Identifies high-volume queries (>= 500 searches) with both CTR and CR below median. **Calculates missed conversions** if these queries performed at median levels. These represent the biggest revenue opportunities - prioritize optimization here!",
         q15, "💰"
     )
+    
+    # ==================== Q16: Composite Opportunity Score ====================
+    def q16():
+        """Weighted, normalized opportunity score over every query or brand with tunable weights"""
+        col_level, col_preset, col_volume, col_k = st.columns([1, 2, 1, 1])
+        with col_level:
+            level = st.radio("Score", ["Queries", "Brands"], horizontal=True, key="opp_level")
+        with col_preset:
+            preset = st.selectbox("Preset", list(OPPORTUNITY_PRESETS), key="opp_preset")
+        with col_volume:
+            min_volume = st.number_input("Min search volume", min_value=0, value=INSIGHTS_MIN_VOLUME, step=50, key="opp_min_volume")
+        with col_k:
+            top_k = st.number_input("Top k", min_value=5, max_value=500, value=INSIGHTS_TOP_N, step=5, key="opp_top_k")
+        
+        # Sliders are keyed by preset so switching preset reloads its weights
+        preset_weights = OPPORTUNITY_PRESETS[preset]
+        weight_cols = st.columns(len(OPPORTUNITY_SIGNALS))
+        weights = {}
+        for weight_col, (signal, label) in zip(weight_cols, OPPORTUNITY_SIGNALS.items()):
+            with weight_col:
+                weights[signal] = st.slider(label, 0.0, 1.0, float(preset_weights.get(signal, 0.0)), 0.05,
+                                            key=f"opp_w_{signal}_{list(OPPORTUNITY_PRESETS).index(preset)}")
+        
+        if level == "Queries":
+            population = insights_engine['queries']
+            population = population[(population['brand'] != 'Other') & (population['Counts'] >= min_volume)]
+            label_cols, label_names = ['search', 'brand'], ['Search Query', 'Brand']
+        else:
+            population = insights_engine['brands']
+            population = population[population['Counts'] >= min_volume] if population is not None else None
+            label_cols, label_names = ['brand'], ['Brand']
+        
+        if population is None or population.empty:
+            st.info(f"📊 No {level.lower()} with search volume >= {min_volume:,}")
+            return
+        
+        signals = build_opportunity_signals(population, f"{insights_cache_key}_{level}_{min_volume}")
+        out = top_k_opportunities(population, signals, weights, k=top_k)
+        if out is None:
+            st.info("🎛️ Set at least one weight above zero to score opportunities")
+            return
+        
+        display_df = out[label_cols].copy()
+        display_df.columns = label_names
+        display_df['Search Volume'] = out['Counts'].apply(format_number)
+        display_df['Clicks'] = out['clicks'].apply(format_number)
+        display_df['Conversions'] = out['conversions'].apply(format_number)
+        display_df['CTR'] = out['ctr'].apply(lambda x: f"{x:.1f}%")
+        display_df['CR'] = out['cr'].apply(lambda x: f"{x:.1f}%")
+        display_df['Score'] = out['opportunity_score'].apply(lambda x: f"{x:.1f}")
+        display_df['Main Driver'] = out['main_driver']
+        
+        st.caption(f"Scored {len(population):,} {level.lower()} · showing top {len(out):,}")
+        display_df = with_significance(display_df, out)
+        display_styled_table(df=display_df, align="center", scrollable=True, max_height="600px")
+        
+        st.download_button("📥 Download Data", out.to_csv(index=False),
+                         f"q16_opportunity_scores_{pd.Timestamp.now().strftime('%Y%m%d')}.csv",
+                         "text/csv", key="q16_dl")
+        
+        fig = px.bar(out.head(15), x=label_cols[0], y='opportunity_score', color='main_driver',
+                    title=f'Top 15 {level} by Opportunity Score',
+                    hover_data=['Counts', 'clicks', 'conversions'])
+        fig.update_layout(xaxis_tickangle=-45, xaxis_title=label_names[0], yaxis_title="Opportunity Score (0-100)")
+        st.plotly_chart(fig, use_container_width=True)
+    
+    q_expand(
+        "Q16 — 🎛️ Composite Opportunity Score - Tunable Weights",
+        "Scores every query (or brand) on normalized signals - volume, CTR / CR gaps, click-to-conversion efficiency and missed clicks / conversions at median rates - and ranks by the weighted mean. **Pick a preset matching Q5, Q6, Q10, Q14 or Q15, then tune the weights** instead of relying on fixed cut-offs.",
+        q16, "🎛️"
+    )
 
 
 # ----------------- Footer -----------------